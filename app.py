@@ -1,67 +1,2257 @@
-from flask import Flask, render_template, request, jsonify, send_file
-import fitz  # PyMuPDF
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context
 import os
 from dotenv import load_dotenv
-from together import Together
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.enums import TA_LEFT
-from io import BytesIO
+from io import BytesIO, StringIO
 import re
 import json
+import pstats
+import cProfile
+import contextvars
+import functools
+import gzip
+import importlib
+import importlib.util
+import itertools
+import math
+import random
+import select
+import socket
+import hashlib
+import hmac
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+import wave
+import zlib
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import time as _time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeout  # only the builtin TimeoutError from 3.11 on
 from datetime import datetime, timedelta
-from gtts import gTTS
-import requests
+from urllib.parse import quote_plus, urlparse
+from types import SimpleNamespace
+from xml.sax.saxutils import escape as xml_escape
+
+try:
+    import fcntl  # cross-process file locks for the embedding index (POSIX only)
+except ImportError:
+    fcntl = None
+
+
+class LazyModule:
+    """Module proxy that imports on first attribute access, keeping heavy SDKs out of startup."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# Heavy dependencies load on first use (see warm_up() for preloading servers)
+fitz = LazyModule("fitz")  # PyMuPDF
+requests = LazyModule("requests")
+bs4 = LazyModule("bs4")
+gtts = LazyModule("gtts")
+elevenlabs = LazyModule("elevenlabs")
+httpx = LazyModule("httpx")
+together = LazyModule("together")
+np = LazyModule("numpy")
+# optional: OCR fallback for scanned PDFs
+pytesseract = LazyModule("pytesseract") if importlib.util.find_spec("pytesseract") else None
+
+# ReportLab is imported inside the PDF export handlers, on the first export
+_REPORTLAB_MODULES = ("reportlab.lib.pagesizes", "reportlab.lib.styles", "reportlab.lib.units",
+                      "reportlab.lib.enums", "reportlab.lib.colors", "reportlab.platypus")
+_lazy_lock = threading.Lock()
 
 
 app = Flask(__name__)
 load_dotenv()
-from elevenlabs import ElevenLabs
-
-# Initialize ElevenLabs client (if API key exists)
-ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
-eleven_client = None
-if ELEVENLABS_API_KEY:
-    try:
-        eleven_client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
-        print("✅ ElevenLabs client initialized")
-    except Exception as e:
-        print(f"⚠️ ElevenLabs initialization failed: {e}")
 
 # ✅ Load Together API key from .env
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
 # ✅ Load ElevenLabs API key (used in conditionals and client init)
 ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
+# Upstream overrides (e.g. the mock server in bench.py). The Together SDK reads TOGETHER_BASE_URL itself.
+ELEVENLABS_BASE_URL = os.getenv("ELEVENLABS_BASE_URL") or None
+SEARCH_URL = os.getenv("SEARCH_URL", "https://html.duckduckgo.com/html/")
+
+# ✅ Together client, created on the first LLM call (tests and benchmarks may assign a stand-in)
+client = None
+
+
+def llm_client():
+    global client
+    if client is None:
+        with _lazy_lock:
+            if client is None:
+                client = together.Together(api_key=TOGETHER_API_KEY)
+    return client
+
+
+def warm_up():
+    """Import the heavy dependencies now instead of on first request (gunicorn calls this before forking)."""
+    start = _time.perf_counter()
+    for module in (fitz, requests, bs4, gtts, elevenlabs, httpx, together, np, pytesseract):
+        if module is not None:
+            getattr(module, "__name__")
+    for module_name in _REPORTLAB_MODULES:
+        importlib.import_module(module_name)
+    print(f"✅ Warmed up in {_time.perf_counter() - start:.2f}s")
+
+
+# ---------------------------------------------------------------------------
+# Metrics: per-endpoint histograms/counters, exposed in Prometheus text format
+# ---------------------------------------------------------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 2048, 4096, 8192, 16384, 32768)
+
+# Estimated USD per 1M tokens as (input, output). Override with LLM_PRICES='{"model": [in, out]}'.
+LLM_PRICES = {
+    "openai/gpt-oss-20b": (0.05, 0.20),
+    "openai/gpt-oss-120b": (0.15, 0.60),
+    "meta-llama/Llama-3.3-70B-Instruct-Turbo": (0.88, 0.88),
+    "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo": (0.88, 0.88),
+    "meta-llama/Llama-3.1-70B-Instruct-Turbo": (0.88, 0.88),
+    "meta-llama/Meta-Llama-3-70B-Instruct": (0.88, 0.88),
+    **{model: tuple(price) for model, price in json.loads(os.getenv("LLM_PRICES") or "{}").items()},
+}
+
+# Endpoint label for metrics recorded on this request (and worker threads it hands work to)
+_metrics_endpoint = contextvars.ContextVar("metrics_endpoint", default="background")
+
+
+def current_endpoint():
+    return _metrics_endpoint.get()
+
+
+def submit_in_context(pool, fn, *args, **kwargs):
+    """pool.submit that carries the caller's context (endpoint label) into the worker thread."""
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def _format_labels(names, values, extra=""):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter keyed by label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value:g}" for key, value in items]
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        lines = []
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%g"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series[-2]:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+HTTP_SECONDS = metrics.histogram("http_request_seconds", "Inbound request handling time (until the view returns).",
+                                 ("endpoint", "method", "status"))
+LLM_QUEUE_SECONDS = metrics.histogram("llm_queue_seconds", "Time spent waiting for the gateway rate limit and concurrency slots.",
+                                      ("endpoint", "model"))
+LLM_UPSTREAM_SECONDS = metrics.histogram("llm_upstream_seconds", "Upstream chat completion latency (whole stream for streamed calls).",
+                                         ("endpoint", "model", "status"))
+LLM_TTFT_SECONDS = metrics.histogram("llm_time_to_first_token_seconds", "Time to the first streamed content token.",
+                                     ("endpoint", "model"))
+LLM_PROMPT_TOKENS = metrics.histogram("llm_prompt_tokens", "Prompt tokens per upstream call.",
+                                      ("endpoint", "model"), TOKEN_BUCKETS)
+LLM_COMPLETION_TOKENS = metrics.histogram("llm_completion_tokens", "Completion tokens per upstream call.",
+                                          ("endpoint", "model"), TOKEN_BUCKETS)
+LLM_COST_USD = metrics.counter("llm_estimated_cost_usd_total", "Estimated LLM spend from LLM_PRICES.", ("endpoint", "model"))
+LLM_COALESCED = metrics.counter("llm_coalesced_total", "Calls answered by an identical in-flight request.", ("endpoint", "model"))
+LLM_RETRIES = metrics.counter("llm_retries_total", "Upstream calls retried after a 429/5xx.", ("endpoint", "model"))
+LLM_CONTINUATIONS = metrics.counter("llm_continuations_total", "Follow-up calls made after a completion stopped at max_tokens.",
+                                    ("endpoint", "model"))
+LLM_ROUTED = metrics.counter("llm_routed_total", "Completions per model tier chosen by the routing policy.", ("endpoint", "tier"))
+TTS_SECONDS = metrics.histogram("tts_seconds", "TTS engine synthesis latency.", ("endpoint", "engine", "status"))
+TTS_CHARACTERS = metrics.counter("tts_characters_total", "Characters sent to each TTS engine.", ("endpoint", "engine"))
+WEB_SECONDS = metrics.histogram("web_request_seconds", "Outbound web request latency.", ("endpoint", "host", "status"))
+CACHE_LOOKUPS = metrics.counter("cache_lookups_total", "Cache lookups by cache and result (hit/miss).",
+                                ("endpoint", "cache", "result"))
+TEXT_TOKENS_SAVED = metrics.counter("text_normalization_tokens_saved_total",
+                                    "Estimated prompt tokens removed from extracted PDF text by normalization.", ("endpoint",))
+PROMPT_TOKENS_SAVED = metrics.counter("prompt_compression_tokens_saved_total",
+                                      "Estimated prompt tokens removed by context compression.", ("endpoint",))
+ARTIFACT_SECONDS = metrics.histogram("artifact_store_seconds", "Artifact store operation latency.", ("endpoint", "op"))
+
+
+def record_llm_usage(model, usage):
+    """Record token counts and estimated cost from a completion's `usage` block."""
+    if usage is None:
+        return
+    endpoint = current_endpoint()
+    prompt = getattr(usage, "prompt_tokens", None) or 0
+    completion = getattr(usage, "completion_tokens", None) or 0
+    LLM_PROMPT_TOKENS.observe(prompt, endpoint, model)
+    LLM_COMPLETION_TOKENS.observe(completion, endpoint, model)
+    price_in, price_out = LLM_PRICES.get(model, (0.0, 0.0))
+    LLM_COST_USD.inc(endpoint, model, amount=(prompt * price_in + completion * price_out) / 1_000_000)
+
+
+def timed_get(url, **kwargs):
+    """requests.get with latency recorded per endpoint and target host."""
+    host = urlparse(url).netloc
+    start = _time.perf_counter()
+    status = "error"
+    try:
+        response = requests.get(url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        WEB_SECONDS.observe(_time.perf_counter() - start, current_endpoint(), host, status)
+        add_span("http.get", start, _time.perf_counter(), host=host, status=status)
+
+
+@app.before_request
+def _start_request_metrics():
+    _metrics_endpoint.set(request.endpoint or "unknown")
+    _model_routes.set([])
+    request._metrics_start = _time.perf_counter()
+
+
+@app.after_request
+def _finish_request_metrics(response):
+    start = getattr(request, "_metrics_start", None)
+    if start is not None:
+        HTTP_SECONDS.observe(_time.perf_counter() - start, request.endpoint or "unknown",
+                             request.method, str(response.status_code))
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# ---------------------------------------------------------------------------
+# Tracing: per-request trace ids, nested spans, waterfall view, Chrome export
+# ---------------------------------------------------------------------------
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.1))  # fraction of requests that record spans
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", 200))    # recent sampled traces kept in memory
+TRACE_MAX_SPANS = 2000                                          # per trace, to bound memory
+TRACE_LOG_IDS = os.getenv("TRACE_LOG_IDS", "1") != "0"          # prefix printed log lines with the trace id
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_recent_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+_recent_traces_lock = threading.Lock()
+
+
+class Trace:
+    """Spans recorded for one sampled request (and the background work it started)."""
+
+    def __init__(self, trace_id, name):
+        self.id = trace_id
+        self.name = name
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self.start = _time.perf_counter()
+        self.end = None
+        self.status = None
+        self.spans = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._span_ids = 0
+
+    def new_span_id(self):
+        with self._lock:
+            self._span_ids += 1
+            return self._span_ids
+
+    def record(self, span_id, name, start, end, parent, attrs):
+        with self._lock:
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped += 1
+                return
+            self.spans.append({
+                "id": span_id, "parent": parent, "name": name, "start": start, "end": end,
+                "thread": threading.current_thread().name, "attrs": attrs,
+            })
+
+    @property
+    def duration(self):
+        with self._lock:
+            ends = [s["end"] for s in self.spans] + [self.end or _time.perf_counter()]
+        return max(ends) - self.start
+
+    def to_dict(self):
+        """Spans in start order with depth and offsets (ms) relative to the request start."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s["start"])
+        depth = {}
+        rows = []
+        for s in spans:
+            depth[s["id"]] = depth.get(s["parent"], -1) + 1 if s["parent"] else 0
+            rows.append({
+                "id": s["id"], "parent": s["parent"], "name": s["name"], "depth": depth[s["id"]],
+                "offsetMs": round((s["start"] - self.start) * 1000, 2),
+                "durationMs": round((s["end"] - s["start"]) * 1000, 2),
+                "thread": s["thread"], "attrs": s["attrs"],
+            })
+        return {
+            "traceId": self.id, "name": self.name, "startedAt": self.started_at, "status": self.status,
+            "durationMs": round(self.duration * 1000, 2), "spans": rows, "droppedSpans": self.dropped,
+        }
+
+    def chrome_events(self, pid=1):
+        """Chrome trace-event ("X" complete events, microseconds) for chrome://tracing / Perfetto."""
+        events = [{"name": self.name, "ph": "X", "pid": pid, "tid": "request", "ts": 0,
+                   "dur": round(self.duration * 1e6), "args": {"traceId": self.id, "status": self.status}}]
+        for row in self.to_dict()["spans"]:
+            events.append({"name": row["name"], "ph": "X", "pid": pid, "tid": row["thread"],
+                           "ts": round(row["offsetMs"] * 1000), "dur": round(row["durationMs"] * 1000),
+                           "args": row["attrs"]})
+        return events
+
+
+@contextmanager
+def span(name, **attrs):
+    """Record a nested span on the current sampled trace; a no-op when the request is not sampled."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = trace.new_span_id()
+    parent = _current_span.get()
+    token = _current_span.set(span_id)
+    start = _time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        attrs["error"] = str(e)[:200]
+        raise
+    finally:
+        try:
+            _current_span.reset(token)
+        except ValueError:  # closed from a different context (e.g. a generator resumed elsewhere)
+            _current_span.set(parent)
+        trace.record(span_id, name, start, _time.perf_counter(), parent, attrs)
+
+
+def add_span(name, start, end, **attrs):
+    """Record an already-measured interval (perf_counter seconds) under the current span."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record(trace.new_span_id(), name, start, end, _current_span.get(), attrs)
+
+
+def traced(name):
+    """Decorator form of span()."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _TraceIdStream:
+    """stdout wrapper that prefixes each printed line with the active trace id."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def write(self, text):
+        trace_id = _trace_id.get()
+        if trace_id and text:
+            at_line_start = getattr(self._local, "at_line_start", True)
+            lines = text.split("\n")
+            text = "\n".join(
+                f"[{trace_id}] {line}" if line and (i or at_line_start) else line
+                for i, line in enumerate(lines)
+            )
+        if text:
+            self._local.at_line_start = text.endswith("\n")
+        return self._stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def install_trace_log_ids():
+    """Prefix printed lines with the trace id (TRACE_LOG_IDS). Called by the server entry points, not on import."""
+    if TRACE_LOG_IDS and not isinstance(sys.stdout, _TraceIdStream):
+        sys.stdout = _TraceIdStream(sys.stdout)
+
+
+@app.before_request
+def _start_trace():
+    incoming = request.headers.get("X-Trace-Id", "")
+    trace_id = incoming if re.fullmatch(r"[0-9a-f]{8,32}", incoming) else os.urandom(8).hex()
+    _trace_id.set(trace_id)
+    _current_span.set(None)
+    sampled = (random.random() < TRACE_SAMPLE_RATE
+               and not request.path.startswith("/debug/") and request.endpoint not in ("static", "prometheus_metrics"))
+    _current_trace.set(Trace(trace_id, f"{request.method} {request.path}") if sampled else None)
+
+
+@app.after_request
+def _tag_trace(response):
+    trace_id = _trace_id.get()
+    if trace_id:
+        response.headers["X-Trace-Id"] = trace_id
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def _finish_trace(error=None):
+    # Runs after streamed responses finish, so streaming endpoints are fully covered
+    trace = _current_trace.get()
+    if trace is not None and trace.end is None:
+        trace.end = _time.perf_counter()
+        with _recent_traces_lock:
+            _recent_traces.append(trace)
+    _current_trace.set(None)
+    _trace_id.set(None)
+
+
+def recent_traces():
+    with _recent_traces_lock:
+        return list(_recent_traces)
+
+
+# Debug views (traces, profiles) expose request paths, timings and span attributes: admin only
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def admin_required(view):
+    """Gate a debug view behind ADMIN_TOKEN, sent as the X-Admin-Token header (never in the URL, where
+    access logs and browser history would keep it); disabled when unset."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({"error": "Not found"}), 404
+        supplied = request.headers.get("X-Admin-Token") or ""
+        if not hmac.compare_digest(supplied.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+            return jsonify({"error": "Admin token required"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@app.route('/debug/traces/view')
+def debug_traces_view():
+    """Waterfall page; it asks for the admin token and loads the traces itself"""
+    return render_template('traces.html')
+
+
+@app.route('/debug/traces')
+@admin_required
+def debug_traces():
+    """The slowest recent sampled requests, as JSON for the waterfall page"""
+    limit = request.args.get('limit', 20, type=int)
+    traces = sorted(recent_traces(), key=lambda t: t.duration, reverse=True)[:limit]
+    return jsonify({"sampleRate": TRACE_SAMPLE_RATE, "traces": [t.to_dict() for t in traces]})
+
+
+@app.route('/debug/traces/chrome.json')
+@admin_required
+def debug_traces_chrome():
+    """All recent sampled traces as Chrome trace-event JSON (one pid per request)"""
+    events = []
+    for pid, trace in enumerate(recent_traces(), 1):
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"{trace.name} [{trace.id}]"}})
+        events.extend(trace.chrome_events(pid))
+    return jsonify({"traceEvents": events, "displayTimeUnit": "ms"})
+
+
+@app.route('/debug/traces/<trace_id>.json')
+@admin_required
+def debug_trace_chrome(trace_id):
+    """One trace as Chrome trace-event JSON"""
+    for trace in recent_traces():
+        if trace.id == trace_id:
+            return jsonify({"traceEvents": trace.chrome_events(), "displayTimeUnit": "ms"})
+    return jsonify({"error": "Trace not found (not sampled or already evicted)"}), 404
+
+
+# ---------------------------------------------------------------------------
+# On-demand profiling (admin only): sampling profiler and per-route cProfile
+# ---------------------------------------------------------------------------
+PROFILE_MAX_SECONDS = 120
+PROFILE_MAX_REQUESTS = 100
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """Samples every thread's stack via sys._current_frames() and counts collapsed stacks.
+
+    Output is Brendan Gregg's collapsed format ("thread;outer;...;inner count"), ready for
+    flamegraph.pl or speedscope. Cost is one stack walk per thread per interval, off the request path.
+    """
+
+    def __init__(self, interval=0.005, thread_filter=None):
+        self.interval = max(0.001, interval)
+        self.thread_filter = thread_filter
+        self.stacks = {}
+        self.samples = 0
+
+    def run(self, seconds):
+        own = threading.get_ident()
+        deadline = _time.monotonic() + seconds
+        while _time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                thread_name = names.get(ident, str(ident))
+                if self.thread_filter and self.thread_filter not in thread_name:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                key = ";".join([thread_name.replace(";", "_")] + stack[::-1])
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+            _time.sleep(self.interval)
+        return self
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.stacks.items(), key=lambda kv: -kv[1]))
+
+    def top_functions(self, limit=30):
+        """Self-time (leaf frame) sample counts."""
+        leaves = {}
+        for stack, count in self.stacks.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        return sorted(leaves.items(), key=lambda kv: -kv[1])[:limit]
+
+
+_sampling_lock = threading.Lock()
+_request_profile = None  # {"target", "remaining", "completed", "stats", "armedAt"} while armed or finished
+_request_profile_lock = threading.Lock()
+
+
+@app.route('/debug/profile/sample', methods=['POST'])
+@admin_required
+def debug_profile_sample():
+    """Run the sampling profiler for a time window and return collapsed stacks"""
+    seconds = min(PROFILE_MAX_SECONDS, max(0.1, request.args.get('seconds', 10, type=float)))
+    interval = request.args.get('interval', 0.005, type=float)
+    if not _sampling_lock.acquire(blocking=False):
+        return jsonify({"error": "A sampling profile is already running"}), 409
+    try:
+        profiler = SamplingProfiler(interval, request.args.get('thread')).run(seconds)
+    finally:
+        _sampling_lock.release()
+
+    if request.args.get('format') == 'json':
+        return jsonify({
+            "seconds": seconds,
+            "samples": profiler.samples,
+            "topFunctions": [{"frame": frame, "samples": count} for frame, count in profiler.top_functions()],
+            "collapsed": profiler.collapsed(),
+        })
+    return Response(profiler.collapsed() + "\n", mimetype="text/plain")
+
+
+@app.route('/debug/profile/requests', methods=['POST'])
+@admin_required
+def debug_profile_requests_arm():
+    """cProfile the next N requests to a route (endpoint name or path)"""
+    global _request_profile
+    data = request.get_json(silent=True) or {}
+    target = (data.get('route') or '').strip()
+    try:
+        count = min(PROFILE_MAX_REQUESTS, max(1, int(data.get('count') or 1)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "count must be an integer"}), 400
+    if not target:
+        return jsonify({"error": "route is required (endpoint name like 'process_pdf' or a path like '/api/process')"}), 400
+    with _request_profile_lock:
+        _request_profile = {"target": target, "remaining": count, "completed": 0, "stats": None,
+                            "armedAt": datetime.now().isoformat(timespec="seconds")}
+    return jsonify({"armed": target, "count": count}), 202
+
+
+@app.route('/debug/profile/requests', methods=['GET'])
+@admin_required
+def debug_profile_requests_result():
+    """Aggregated cProfile stats for the armed route (text, or ?format=pstats for snakeviz)"""
+    out = StringIO()
+    with _request_profile_lock:
+        state = dict(_request_profile) if _request_profile else None
+        if state is None:
+            return jsonify({"error": "No request profile armed"}), 404
+        if state["stats"] is None:
+            return jsonify({"target": state["target"], "remaining": state["remaining"], "completed": 0})
+        # Snapshot, since profiled requests may still be adding to the shared stats
+        stats = pstats.Stats(stream=out)
+        stats.add(state["stats"])
+
+    if request.args.get('format') == 'pstats':
+        with tempfile.NamedTemporaryFile(suffix=".pstats", delete=False) as f:
+            path = f.name
+        try:
+            stats.dump_stats(path)
+            with open(path, "rb") as f:
+                payload = f.read()
+        finally:
+            os.remove(path)
+        return Response(payload, mimetype="application/octet-stream",
+                        headers={"Content-Disposition": "attachment; filename=requests.pstats"})
+
+    stats.sort_stats(request.args.get('sort', 'cumulative')).print_stats(request.args.get('limit', 50, type=int))
+    header = f"# {state['target']}: {state['completed']} request(s) profiled, {state['remaining']} remaining\n"
+    return Response(header + out.getvalue(), mimetype="text/plain")
+
+
+@app.before_request
+def _start_request_profile():
+    if _request_profile is None or _request_profile["remaining"] <= 0:
+        return
+    with _request_profile_lock:
+        state = _request_profile
+        if state is None or state["remaining"] <= 0 or state["target"] not in (request.endpoint, request.path):
+            return
+        state["remaining"] -= 1
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler is active on this interpreter
+        with _request_profile_lock:
+            state["remaining"] += 1
+        return
+    request._profiler = profiler
+
+
+@app.teardown_request
+def _finish_request_profile(error=None):
+    profiler = getattr(request, "_profiler", None)
+    if profiler is None:
+        return
+    profiler.disable()
+    with _request_profile_lock:
+        state = _request_profile
+        if state is None:
+            return
+        if state["stats"] is None:
+            state["stats"] = pstats.Stats(profiler)
+        else:
+            state["stats"].add(profiler)
+        state["completed"] += 1
+
+
+# ---------------------------------------------------------------------------
+# Outbound LLM gateway: concurrency caps, rate limiting, coalescing, retries
+# ---------------------------------------------------------------------------
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+LLM_MODEL_CONCURRENCY = int(os.getenv("LLM_MODEL_CONCURRENCY", 4))
+LLM_RATE_PER_SEC = float(os.getenv("LLM_RATE_PER_SEC", 5))
+LLM_BURST = int(os.getenv("LLM_BURST", 10))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", 1.0))
+
+
+class TokenBucket:
+    """Blocking token bucket: `rate` tokens per second, up to `burst` saved up."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = _time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = _time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            job_sleep(delay)
+            waited += delay
+
+
+def _is_retryable(error):
+    """429s and 5xx responses are worth retrying; everything else fails fast."""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    message = str(error).lower()
+    return any(token in message for token in ("429", "rate limit", "502", "503", "504", "timed out"))
+
+
+class _GatedStream:
+    """Iterates an upstream stream while holding the gateway slots; releases them exactly once.
+
+    Also records time-to-first-token, total stream latency and the usage block of the final chunk.
+    """
+
+    def __init__(self, stream, release, model="", started=None):
+        self._stream = stream
+        self._release = release
+        self._model = model
+        self._started = started if started is not None else _time.perf_counter()
+        self._endpoint = current_endpoint()
+        self._job = active_job()
+
+    def __iter__(self):
+        first = True
+        status = "ok"
+        try:
+            for chunk in self._stream:
+                if self._job is not None:
+                    self._job.check()  # leaving the loop closes the upstream connection
+                if first and chunk.choices and getattr(chunk.choices[0].delta, "content", None):
+                    first = False
+                    LLM_TTFT_SECONDS.observe(_time.perf_counter() - self._started, self._endpoint, self._model)
+                if getattr(chunk, "usage", None):
+                    record_llm_usage(self._model, chunk.usage)
+                yield chunk
+        except Exception as e:
+            status = "cancelled" if isinstance(e, JobCancelled) else "error"
+            raise
+        finally:
+            end = _time.perf_counter()
+            LLM_UPSTREAM_SECONDS.observe(end - self._started, self._endpoint, self._model, status)
+            add_span("llm.stream", self._started, end, model=self._model, status=status)
+            self.close()
+
+    def close(self):
+        release, self._release = self._release, None
+        if release:
+            close = getattr(self._stream, "close", None)
+            if close:
+                close()
+            release()
+
+    def __del__(self):
+        self.close()
+
+
+def collect_stream(stream):
+    """Read a streamed completion into the shape of a non-streaming one (checking the current job between chunks)."""
+    parts, finish_reason, usage = [], None, None
+    for chunk in in_job(stream):
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        if chunk.choices:
+            choice = chunk.choices[0]
+            parts.append(getattr(choice.delta, "content", None) or "")
+            finish_reason = getattr(choice, "finish_reason", None) or finish_reason
+    message = SimpleNamespace(role="assistant", content="".join(parts))
+    return SimpleNamespace(choices=[SimpleNamespace(index=0, message=message, finish_reason=finish_reason)], usage=usage)
+
+
+class LLMGateway:
+    """Single outbound path for chat completions.
+
+    Applies a global and per-model concurrency cap plus a token-bucket rate limit, coalesces
+    identical in-flight (non-streaming) requests into one upstream call, and retries 429/5xx
+    with exponential backoff and full jitter.
+    """
+
+    def __init__(self):
+        self._global = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+        self._models = {}
+        self._bucket = TokenBucket(LLM_RATE_PER_SEC, LLM_BURST)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.retries = 0
+
+    def _model_semaphore(self, model):
+        with self._lock:
+            if model not in self._models:
+                self._models[model] = threading.BoundedSemaphore(LLM_MODEL_CONCURRENCY)
+            return self._models[model]
+
+    def _acquire(self, model):
+        start = _time.perf_counter()
+        self._bucket.acquire()
+        model_semaphore = self._model_semaphore(model)
+        # Model slot first: callers queued behind a saturated model must not hold global slots other models need
+        acquire_in_job(model_semaphore)
+        try:
+            acquire_in_job(self._global)
+        except BaseException:
+            model_semaphore.release()
+            raise
+        end = _time.perf_counter()
+        LLM_QUEUE_SECONDS.observe(end - start, current_endpoint(), model)
+        add_span("llm.queue", start, end, model=model)
+
+        def release():
+            model_semaphore.release()
+            self._global.release()
+        return release
+
+    def _call(self, stream, kwargs):
+        model = kwargs.get("model", "")
+        job = active_job()
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            if job is not None:
+                job.check(JOB_MIN_CALL_SECONDS)
+            release = self._acquire(model)
+            started = _time.perf_counter()
+            try:
+                with self._lock:
+                    self.upstream_calls += 1
+                # Inside a job the HTTP call may not outlive the request's deadline
+                call_kwargs = dict(kwargs, timeout=max(1.0, job.remaining())) if job is not None else kwargs
+                if stream:
+                    return _GatedStream(llm_client().chat.completions.create(stream=True, **call_kwargs), release, model, started)
+                try:
+                    if job is not None and JOB_STREAM_UPSTREAM:
+                        # Streamed so a cancel closes the connection instead of paying for the rest of the completion
+                        response = collect_stream(llm_client().chat.completions.create(stream=True, **call_kwargs))
+                    else:
+                        response = llm_client().chat.completions.create(**call_kwargs)
+                finally:
+                    release()
+                end = _time.perf_counter()
+                LLM_UPSTREAM_SECONDS.observe(end - started, current_endpoint(), model, "ok")
+                usage = getattr(response, "usage", None)
+                add_span("llm.call", started, end, model=model, attempt=attempt,
+                         completionTokens=getattr(usage, "completion_tokens", None))
+                record_llm_usage(model, usage)
+                return response
+            except Exception as e:
+                if stream:
+                    release()
+                cancelled = isinstance(e, JobCancelled)
+                LLM_UPSTREAM_SECONDS.observe(_time.perf_counter() - started, current_endpoint(), model,
+                                             "cancelled" if cancelled else "error")
+                add_span("llm.call", started, _time.perf_counter(), model=model, attempt=attempt, error=str(e)[:200])
+                if cancelled or attempt >= LLM_MAX_RETRIES or not _is_retryable(e):
+                    raise
+                delay = random.uniform(0, LLM_RETRY_BASE_SECONDS * (2 ** attempt))
+                if job is not None and delay + JOB_MIN_CALL_SECONDS > job.remaining():
+                    raise  # a retry could not finish before the deadline
+                with self._lock:
+                    self.retries += 1
+                LLM_RETRIES.inc(current_endpoint(), model)
+                print(f"⚠️ LLM call failed ({e}); retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+                job_sleep(delay)
+
+    def create(self, stream=False, route=False, **kwargs):
+        """Drop-in replacement for client.chat.completions.create.
+
+        With route=True the model comes from route_model(); the given `model` is the fallback when
+        routing is switched off.
+        """
+        if route:
+            kwargs["model"] = route_model(kwargs.get("messages", []), kwargs.get("max_tokens"), kwargs.get("model"))
+        if stream:
+            return self._call(True, kwargs)
+
+        key = hashlib.sha256(json.dumps(kwargs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None or future.done()
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.coalesced += 1
+        if not leader:
+            LLM_COALESCED.inc(current_endpoint(), kwargs.get("model", ""))
+            with span("llm.coalesced", model=kwargs.get("model", "")):
+                try:
+                    return wait_for_future(future)
+                except JobCancelled as e:
+                    if e.job is active_job():
+                        raise
+            # The leader's request was cancelled, not ours: make the call ourselves
+            return self.create(**kwargs)
+
+        try:
+            result = self._call(False, kwargs)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "upstreamCalls": self.upstream_calls,
+                "coalesced": self.coalesced,
+                "retries": self.retries,
+                "inFlight": len(self._inflight),
+                "maxConcurrency": LLM_MAX_CONCURRENCY,
+                "modelConcurrency": LLM_MODEL_CONCURRENCY,
+                "ratePerSec": LLM_RATE_PER_SEC,
+            }
+
+
+llm = LLMGateway()
+
+
+# ---------------------------------------------------------------------------
+# Model routing: cheapest tier that fits the call's input and output size
+# ---------------------------------------------------------------------------
+# Tiers cheapest first. A call goes to the first tier whose limits fit its estimated prompt tokens and
+# max_tokens; the last tier takes everything else. Override with MODEL_TIERS='[{"name": ..., "model": ...}]'.
+MODEL_TIERS = json.loads(os.getenv("MODEL_TIERS") or "null") or [
+    {"name": "small", "model": "openai/gpt-oss-20b", "maxInputTokens": 8000, "maxOutputTokens": 4000},
+    {"name": "large", "model": "openai/gpt-oss-120b"},
+]
+# Per-endpoint policy: a tier name pins the endpoint, {"min": tier} / {"max": tier} bound the choice.
+# e.g. MODEL_ROUTES='{"process_pdf": {"min": "large"}, "chat": "small"}'
+MODEL_ROUTES = json.loads(os.getenv("MODEL_ROUTES") or "{}")
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "1") != "0"
+
+_model_routes = contextvars.ContextVar("model_routes", default=None)
+
+
+def _tier_index(name, default):
+    return next((i for i, tier in enumerate(MODEL_TIERS) if tier["name"] == name), default)
+
+
+def route_model(messages, max_tokens, default=None, endpoint=None):
+    """Model for one completion: the first tier that fits, within the endpoint's MODEL_ROUTES bounds.
+
+    `default` is the model the call site used before routing existed; it is returned unchanged when
+    MODEL_ROUTING=0. The decision is counted per tier and kept for routing_stats().
+    """
+    if not MODEL_ROUTING and default:
+        return default
+    endpoint = endpoint or current_endpoint()
+    input_tokens = sum(estimate_tokens(str(m.get("content", ""))) for m in messages)
+
+    route = MODEL_ROUTES.get(endpoint, {})
+    if isinstance(route, str):
+        route = {"min": route, "max": route}
+    low = _tier_index(route.get("min"), 0)
+    high = _tier_index(route.get("max"), len(MODEL_TIERS) - 1)
+    index, reason = high, "largest allowed tier"
+    for i in range(low, high + 1):
+        tier = MODEL_TIERS[i]
+        if input_tokens > tier.get("maxInputTokens", float("inf")):
+            reason = f"input {input_tokens} > {tier['name']} limit {tier['maxInputTokens']}"
+        elif (max_tokens or 0) > tier.get("maxOutputTokens", float("inf")):
+            reason = f"max_tokens {max_tokens} > {tier['name']} limit {tier['maxOutputTokens']}"
+        else:
+            index, reason = i, "pinned" if low == high else ("fits" if i == low else reason)
+            break
+    tier = MODEL_TIERS[index]
+    LLM_ROUTED.inc(endpoint, tier["name"])
+    decisions = _model_routes.get()
+    if decisions is not None:
+        decisions.append({"tier": tier["name"], "model": tier["model"], "inputTokens": input_tokens,
+                          "maxTokens": max_tokens, "reason": reason})
+    return tier["model"]
+
+
+def routing_stats():
+    """Routing decisions made for the current request, one entry per tier used, for the response `stats`."""
+    by_tier = {}
+    for decision in _model_routes.get() or []:
+        entry = by_tier.setdefault(decision["tier"], {**decision, "calls": 0})
+        entry["calls"] += 1
+        entry["inputTokens"] = max(entry["inputTokens"], decision["inputTokens"])
+    return list(by_tier.values())
+
+
+# ---------------------------------------------------------------------------
+# Continuation: completions cut off at max_tokens are resumed and stitched together
+# ---------------------------------------------------------------------------
+LLM_CONTINUATION_ROUNDS = int(os.getenv("LLM_CONTINUATION_ROUNDS", 2))  # follow-up calls after a length stop
+CONTINUATION_TAIL_CHARS = 2000  # end of the cut-off text sent back so the model knows where it stopped
+CONTINUATION_OVERLAP_CHARS = 400  # how far back a restated overlap is looked for
+
+CONTINUE_PROMPT = (
+    "Your previous reply was cut off by the length limit; its last part is above. Continue exactly where it "
+    "stops, mid-word or mid-line if needed. Do not repeat earlier text, do not add a preamble, and keep the "
+    "same format (for JSON, continue the same object)."
+)
+
+
+def _stopped_for_length(choice):
+    reason = getattr(choice, "finish_reason", None)
+    return getattr(reason, "value", reason) == "length"
+
+
+def continuation_messages(messages, text):
+    """The original prompt, the tail of the cut-off reply, and the request to carry on from it."""
+    return [*messages, {"role": "assistant", "content": text[-CONTINUATION_TAIL_CHARS:]},
+            {"role": "user", "content": CONTINUE_PROMPT}]
+
+
+def join_continuation(text, piece):
+    """Append a continuation to `text`, dropping a reopened code fence or restated overlap."""
+    if text.lstrip().startswith("```") and text.count("```") % 2 == 1:
+        piece = re.sub(r"^\s*```[a-zA-Z]*[ \t]*\n", "", piece, count=1)
+    for candidate in (piece, piece.lstrip()):
+        for size in range(min(len(text), len(candidate), CONTINUATION_OVERLAP_CHARS), 15, -1):
+            if text.endswith(candidate[:size]):
+                return text + candidate[size:]
+    return text + piece
+
+
+def _resolve_model(kwargs):
+    """Route once up front, so every round of a continued completion uses the same model."""
+    if kwargs.pop("route", False):
+        kwargs["model"] = route_model(kwargs.get("messages", []), kwargs.get("max_tokens"), kwargs.get("model"))
+    return kwargs
+
+
+def complete_text(**kwargs):
+    """llm.create that keeps going when the model stops at max_tokens.
+
+    Up to LLM_CONTINUATION_ROUNDS follow-up calls are made, each given the tail of the text so far.
+    Returns (text, {"continuations": n, "truncated": bool}); truncated means the last round still hit the limit.
+    """
+    kwargs = _resolve_model(dict(kwargs))
+    messages = kwargs.pop("messages")
+    text, rounds = "", 0
+    while True:
+        response = llm.create(messages=continuation_messages(messages, text) if rounds else messages, **kwargs)
+        choice = response.choices[0]
+        piece = choice.message.content or ""
+        text = join_continuation(text, piece) if rounds else piece
+        if not _stopped_for_length(choice) or rounds >= LLM_CONTINUATION_ROUNDS or not piece:
+            break
+        rounds += 1
+        LLM_CONTINUATIONS.inc(current_endpoint(), kwargs.get("model", ""))
+        print(f"✂️ Completion hit max_tokens ({len(text)} chars so far); continuing ({rounds}/{LLM_CONTINUATION_ROUNDS})")
+    return text, {"continuations": rounds, "truncated": _stopped_for_length(choice)}
+
+
+def stream_text(**kwargs):
+    """Content deltas of a streamed completion, continued across length stops like complete_text().
+
+    The start of each continuation is held back until a restated overlap can be trimmed from it.
+    """
+    kwargs = _resolve_model(dict(kwargs))
+    messages = kwargs.pop("messages")
+    text, rounds = "", 0
+    while True:
+        stream = llm.create(stream=True, messages=continuation_messages(messages, text) if rounds else messages, **kwargs)
+        pending, finished, length_stop = "", rounds == 0, False
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            length_stop = length_stop or _stopped_for_length(chunk.choices[0])
+            delta = chunk.choices[0].delta.content or ""
+            if finished:
+                text += delta
+                yield delta
+                continue
+            pending += delta
+            if len(pending) > CONTINUATION_OVERLAP_CHARS:
+                joined = join_continuation(text, pending)
+                yield joined[len(text):]
+                text, finished = joined, True
+        if not finished:
+            joined = join_continuation(text, pending)
+            yield joined[len(text):]
+            text = joined
+        if not length_stop or rounds >= LLM_CONTINUATION_ROUNDS:
+            return
+        rounds += 1
+        LLM_CONTINUATIONS.inc(current_endpoint(), kwargs.get("model", ""))
+        print(f"✂️ Streamed completion hit max_tokens; continuing ({rounds}/{LLM_CONTINUATION_ROUNDS})")
+
+
+# ---------------------------------------------------------------------------
+# Structured LLM output: incremental JSON parsing, repair and validation
+# ---------------------------------------------------------------------------
+# Per-endpoint schemas: top-level keys that must exist, the array whose items are
+# streamed to the client as they complete, and the keys every item must carry.
+JSON_SCHEMAS = {
+    "slides": {
+        "required": ["slides"],
+        "items": "slides",
+        "item_required": ["title", "content", "narration"],
+    },
+    "schedule": {
+        "required": ["schedule"],
+        "items": "schedule",
+        "item_required": ["day", "topics"],
+    },
+    "flashcards": {
+        "required": ["flashcards"],
+        "items": "flashcards",
+        "item_required": ["question", "answer"],
+    },
+    "outline": {
+        "required": ["outline"],
+        "items": "outline",
+        "item_required": ["title"],
+    },
+    "slide": {
+        "required": ["title", "content", "narration"],
+    },
+}
+
+_CODE_FENCE_RE = re.compile(r"^```[a-zA-Z]*\s*|\s*```$")  # a fence around the whole payload only
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+
+def _loads_lenient(candidate: str):
+    """json.loads that tolerates trailing commas and missing commas between objects."""
+    for attempt in (
+        candidate,
+        _TRAILING_COMMA_RE.sub(r"\1", candidate),
+        re.sub(r"}\s*{", "},{", _TRAILING_COMMA_RE.sub(r"\1", candidate)),
+    ):
+        try:
+            return json.loads(attempt)
+        except ValueError:
+            continue
+    return None
+
+
+class IncrementalJSONParser:
+    """Consume LLM output chunk by chunk and emit complete array items as soon as they close.
+
+    Text before the first '{' (prose, code fences) is ignored. With `items_key` set, every
+    object inside the top-level array of that name is parsed the moment its closing brace
+    arrives, so callers can stream slides/cards/days before the completion finishes.
+    `result()` returns the full object, repairing truncation by closing whatever is still open.
+    """
+
+    def __init__(self, items_key=None):
+        self.items_key = items_key
+        self.text = ""
+        self.done = False
+        self._pos = 0
+        self._root = -1
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = -1
+        self._last_string = None
+        self._pending_key = None
+        self._items_depth = None
+        self._item_start = -1
+        self._safe_cuts = []  # (position, stack snapshot) just before each comma
+        self.items = []
+
+    def feed(self, chunk: str):
+        """Append a chunk and return the list of items completed by it."""
+        if not chunk or self.done:
+            return []
+        self.text += chunk
+        new_items = []
+        text = self.text
+        i = self._pos
+        while i < len(text) and not self.done:
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last_string = text[self._string_start + 1:i]
+            elif self._root == -1:
+                if ch == "{":
+                    self._root = i
+                    self._stack.append("{")
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch == ":":
+                if len(self._stack) == 1:
+                    self._pending_key = self._last_string
+            elif ch == ",":
+                self._safe_cuts.append((i, tuple(self._stack)))
+                if len(self._stack) == 1:
+                    self._pending_key = None
+            elif ch in "{[":
+                self._stack.append(ch)
+                depth = len(self._stack)
+                if ch == "[" and depth == 2 and self.items_key and self._pending_key == self.items_key:
+                    self._items_depth = depth
+                elif ch == "{" and self._items_depth and depth == self._items_depth + 1:
+                    self._item_start = i
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                depth = len(self._stack)
+                if ch == "}" and self._items_depth and depth == self._items_depth and self._item_start >= 0:
+                    item = _loads_lenient(text[self._item_start:i + 1])
+                    if isinstance(item, dict):
+                        self.items.append(item)
+                        new_items.append(item)
+                    self._item_start = -1
+                elif ch == "]" and self._items_depth and depth == self._items_depth - 1:
+                    self._items_depth = None
+                if not self._stack:
+                    self.done = True
+            i += 1
+        self._pos = i
+        return new_items
+
+    def result(self):
+        """Return the parsed object, closing open strings/arrays/objects if the text was cut off."""
+        if self._root == -1:
+            return None
+        body = self.text[self._root:self._pos]
+        if self.done:
+            return _loads_lenient(body)
+
+        # Truncated: first try closing everything at the current position...
+        tail = '"' if self._in_string else ""
+        attempt = _loads_lenient(body + tail + _closers(self._stack))
+        if attempt is not None:
+            return attempt
+        # ...then back off to the last complete element before each comma.
+        for pos, stack in reversed(self._safe_cuts):
+            attempt = _loads_lenient(self.text[self._root:pos] + _closers(stack))
+            if attempt is not None:
+                return attempt
+        return None
+
+
+def _closers(stack) -> str:
+    return "".join("}" if opener == "{" else "]" for opener in reversed(stack))
+
+
+def validate_json(data, schema_name=None):
+    """Check parsed output against a JSON_SCHEMAS entry, dropping malformed items."""
+    if not isinstance(data, dict):
+        return None
+    schema = JSON_SCHEMAS.get(schema_name)
+    if not schema:
+        return data
+    if any(key not in data for key in schema["required"]):
+        return None
+    if "items" not in schema:
+        return data
+    items = data.get(schema["items"])
+    if not isinstance(items, list):
+        return None
+    data[schema["items"]] = [
+        item for item in items
+        if isinstance(item, dict) and all(key in item for key in schema["item_required"])
+    ]
+    return data
+
+
+@traced("json.parse")
+def parse_llm_json(text: str, schema_name=None):
+    """Parse (and if necessary repair) a JSON object from raw LLM output."""
+    if not text:
+        return None
+    cleaned = _CODE_FENCE_RE.sub("", text.strip()).strip()
+    start = cleaned.find("{")
+    end = cleaned.rfind("}")
+    data = None
+    if start != -1 and end > start:
+        data = _loads_lenient(cleaned[start:end + 1])
+    if data is None:
+        parser = IncrementalJSONParser()
+        parser.feed(cleaned)
+        data = parser.result()
+    return validate_json(data, schema_name)
 
-# ✅ Initialize Together client
-client = Together(api_key=TOGETHER_API_KEY)
 
 def extract_json_object(text: str):
     """Best-effort extraction of the first top-level JSON object from a text blob."""
-    if not text:
+    return parse_llm_json(text)
+
+
+def stream_json_completion(schema_name, finalize=None, artifact=None, **completion_kwargs):
+    """Stream a JSON completion to the client as NDJSON, one line per completed item.
+
+    Emits {"type": "item", ...} for each finished array element, then a single
+    {"type": "done", "data": ...} (or {"type": "error", ...}) once the stream ends.
+    `finalize` may post-process or replace the final object (e.g. a fallback schedule).
+    `artifact` is an artifact_spec() the final object is saved under.
+    """
+    schema = JSON_SCHEMAS[schema_name]
+
+    def generate():
+        parser = IncrementalJSONParser(items_key=schema["items"])
+        try:
+            for delta in stream_text(**completion_kwargs):
+                for item in parser.feed(delta):
+                    if all(key in item for key in schema["item_required"]):
+                        yield json.dumps({
+                            "type": "item",
+                            "key": schema["items"],
+                            "index": len(parser.items) - 1,
+                            "item": item,
+                        }) + "\n"
+        except Exception as e:
+            yield json.dumps({"type": "error", "error": f"AI model error: {str(e)}"}) + "\n"
+            return
+
+        data = validate_json(parser.result(), schema_name)
+        if finalize:
+            data = finalize(data)
+        if not data:
+            yield json.dumps({
+                "type": "error",
+                "error": "Failed to parse AI response as JSON",
+                "raw_response": parser.text[:800],
+            }) + "\n"
+            return
+        artifact_id = save_artifact(artifact, data)
+        yield json.dumps({"type": "done", "repaired": not parser.done, "data": data, "artifactId": artifact_id,
+                          "stats": {"routing": routing_stats()}}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+# ---------------------------------------------------------------------------
+# PDF text extraction with OCR fallback for scanned (image-only) pages
+# ---------------------------------------------------------------------------
+DATA_DIR = os.getenv("DATA_DIR", "data")
+OCR_ENABLED = os.getenv("OCR_ENABLED", "1") != "0"
+OCR_DPI = int(os.getenv("OCR_DPI", 200))
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", os.cpu_count() or 2))
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", os.path.join(DATA_DIR, "ocr_cache"))
+
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+
+
+def _get_ocr_pool():
+    """Create the OCR process pool on first use."""
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            _ocr_pool = ProcessPoolExecutor(max_workers=max(1, OCR_WORKERS))
+        return _ocr_pool
+
+
+def _ocr_png(png_bytes: bytes, lang: str) -> str:
+    """Run Tesseract on one rendered page (executes inside the process pool)."""
+    from PIL import Image
+    return pytesseract.image_to_string(Image.open(BytesIO(png_bytes)), lang=lang)
+
+
+def _ocr_cache_get(key: str):
+    # Disk only: re-uploads are served by the whole-document text cache, so pages are rarely read twice
+    path = os.path.join(OCR_CACHE_DIR, f"{key}.txt")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    return None
+
+
+def _ocr_cache_put(key: str, text: str):
+    try:
+        os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+        with open(os.path.join(OCR_CACHE_DIR, f"{key}.txt"), "w", encoding="utf-8") as f:
+            f.write(text)
+    except OSError as e:
+        print(f"⚠️ Could not write OCR cache: {e}")
+
+
+# Text cleanup before prompting: running headers/footers, page numbers, hyphenation, ligatures
+TEXT_NORMALIZE = os.getenv("TEXT_NORMALIZE", "1") != "0"
+TEXT_CACHE_DIR = os.getenv("TEXT_CACHE_DIR", os.path.join(DATA_DIR, "text_cache"))
+TEXT_EDGE_LINES = 3  # lines at the top and bottom of each page checked for running headers/footers
+TEXT_REPEAT_RATIO = 0.4  # share of pages a top/bottom line must appear on to count as boilerplate
+TEXT_NORMALIZE_VERSION = 1
+
+_LIGATURES = {
+    "\ufb00": "ff", "\ufb01": "fi", "\ufb02": "fl", "\ufb03": "ffi", "\ufb04": "ffl", "\ufb05": "st", "\ufb06": "st",
+    "\u00ad": "", "\u200b": "", "\ufeff": "", "\u00a0": " ", "\u2010": "-", "\u2011": "-",
+}
+_LIGATURE_RE = re.compile("|".join(_LIGATURES))
+_PAGE_NUMBER_RE = re.compile(r"^\s*(page|slide|p\.)?\s*\d{1,4}(\s*(of|/)\s*\d{1,4})?\s*$", re.IGNORECASE)
+
+
+def _boilerplate_key(line):
+    """Compare lines ignoring case, spacing and digits, so "Page 3 of 40" matches "Page 4 of 40"."""
+    return re.sub(r"\d+", "#", re.sub(r"\s+", " ", line.strip().lower()))
+
+
+def normalize_pages(page_texts):
+    """Strip per-page boilerplate and extraction artifacts. Returns (cleaned page texts, report).
+
+    Lines that recur in the top or bottom TEXT_EDGE_LINES of at least TEXT_REPEAT_RATIO of the pages
+    (running headers, footers, course names, copyright lines) and bare page numbers are dropped.
+    Words hyphenated across line breaks are rejoined and ligatures/whitespace are normalized.
+    """
+    pages = [_LIGATURE_RE.sub(lambda m: _LIGATURES[m.group(0)], text) for text in page_texts]
+    lines_per_page = [[line.rstrip() for line in text.splitlines()] for text in pages]
+
+    counts = defaultdict(int)
+    for lines in lines_per_page:
+        content = [line for line in lines if line.strip()]
+        edges = content[:TEXT_EDGE_LINES] + content[-TEXT_EDGE_LINES:]
+        for key in {_boilerplate_key(line) for line in edges}:
+            counts[key] += 1
+    min_pages = max(3, math.ceil(TEXT_REPEAT_RATIO * len(pages)))
+    repeated = {key for key, n in counts.items() if n >= min_pages and key.strip("# ") and len(key) <= 120}
+
+    removed = hyphenations = 0
+    cleaned = []
+    for lines in lines_per_page:
+        content_idx = [i for i, line in enumerate(lines) if line.strip()]
+        edge_idx = set(content_idx[:TEXT_EDGE_LINES] + content_idx[-TEXT_EDGE_LINES:])
+        kept = []
+        for i, line in enumerate(lines):
+            if i in edge_idx and (_boilerplate_key(line) in repeated or _PAGE_NUMBER_RE.match(line)):
+                removed += 1
+                continue
+            kept.append(line)
+        text = "\n".join(kept)
+        text, joins = re.subn(r"(\w)-\n[ \t]*([a-z])", r"\1\2", text)
+        hyphenations += joins
+        text = re.sub(r"[ \t]+", " ", text)
+        text = re.sub(r" ?\n ?", "\n", text)
+        text = re.sub(r"\n{3,}", "\n\n", text)
+        cleaned.append(text.strip())
+
+    before = sum(estimate_tokens(t) for t in page_texts)
+    after = sum(estimate_tokens(t) for t in cleaned)
+    report = {
+        "tokensBefore": before,
+        "tokensAfter": after,
+        "tokensSaved": before - after,
+        "savedPercent": round(100 * (before - after) / before, 1) if before else 0.0,
+        "boilerplateLinesRemoved": removed,
+        "hyphenationsJoined": hyphenations,
+    }
+    return cleaned, report
+
+
+def _text_cache_key(pdf_bytes):
+    settings = f"|{TEXT_NORMALIZE}|{TEXT_NORMALIZE_VERSION}|{OCR_ENABLED}|{OCR_DPI}|{OCR_LANG}"
+    return hashlib.sha256(pdf_bytes + settings.encode("utf-8")).hexdigest()
+
+
+def _text_cache_get(key):
+    path = os.path.join(TEXT_CACHE_DIR, f"{key}.json.gz")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            cached = json.loads(gzip.decompress(f.read()))
+        return cached["text"], cached["stats"]
+    except (OSError, EOFError, ValueError, KeyError, zlib.error) as e:
+        print(f"⚠️ Ignoring unreadable text cache entry {key[:12]}: {e}")
         return None
-    # Remove common code fences
-    cleaned = re.sub(r'^```json\s*', '', text.strip(), flags=re.IGNORECASE)
-    cleaned = re.sub(r'^```\s*', '', cleaned)
-    cleaned = re.sub(r'```\s*$', '', cleaned)
-    cleaned = cleaned.strip()
-    # Find first '{' and last '}' to isolate an object
-    start = cleaned.find('{')
-    end = cleaned.rfind('}')
-    if start == -1 or end == -1 or end <= start:
+
+
+def _text_cache_put(key, text, stats):
+    try:
+        os.makedirs(TEXT_CACHE_DIR, exist_ok=True)
+        tmp = os.path.join(TEXT_CACHE_DIR, f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(gzip.compress(json.dumps({"text": text, "stats": stats}).encode("utf-8"), compresslevel=6))
+        os.replace(tmp, os.path.join(TEXT_CACHE_DIR, f"{key}.json.gz"))
+    except OSError as e:
+        print(f"⚠️ Could not write text cache: {e}")
+
+
+@traced("pdf.extract")
+def extract_pdf_text(pdf_bytes: bytes):
+    """Extract text from a PDF, OCR-ing only the pages that have no text layer.
+
+    Returns (text, stats). Pages that already carry text are read directly; image-only
+    pages are rendered at OCR_DPI and sent to Tesseract in a process pool, with results
+    cached per rendered-page hash so re-uploads skip OCR entirely. The text is then
+    normalized (see normalize_pages) and the result cached per PDF hash.
+    """
+    cache_key = _text_cache_key(pdf_bytes)
+    cached = _text_cache_get(cache_key)
+    CACHE_LOOKUPS.inc(current_endpoint(), "text", "miss" if cached is None else "hit")
+    if cached is not None:
+        text, stats = cached
+        return text, {**stats, "textCacheHit": True}
+
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    page_texts = []
+    pending = {}  # page index -> (cache key, png bytes)
+    stats = {"pages": len(doc), "ocrPages": 0, "ocrCacheHits": 0, "ocrAvailable": pytesseract is not None}
+    ocr_failed = 0
+
+    for i, page in enumerate(doc):
+        text = page.get_text()
+        page_texts.append(text)
+        if text.strip() or not OCR_ENABLED or not page.get_images(full=False):
+            continue
+
+        pix = page.get_pixmap(dpi=OCR_DPI)
+        key = hashlib.sha256(
+            pix.samples + f"|{OCR_DPI}|{OCR_LANG}".encode("utf-8")
+        ).hexdigest()
+        stats["ocrPages"] += 1
+
+        cached = _ocr_cache_get(key)
+        CACHE_LOOKUPS.inc(current_endpoint(), "ocr", "miss" if cached is None else "hit")
+        if cached is not None:
+            page_texts[i] = cached
+            stats["ocrCacheHits"] += 1
+        elif pytesseract is not None:
+            pending[i] = (key, pix.tobytes("png"))
+
+    if pending:
+        with span("pdf.ocr", pages=len(pending)):
+            pool = _get_ocr_pool()
+            futures = {i: pool.submit(_ocr_png, png, OCR_LANG) for i, (_, png) in pending.items()}
+            for i, future in futures.items():
+                try:
+                    text = wait_for_future(future)
+                except JobCancelled:
+                    for pending_future in futures.values():
+                        pending_future.cancel()
+                    raise
+                except Exception as e:
+                    print(f"⚠️ OCR failed on page {i + 1}: {e}")
+                    ocr_failed += 1
+                    continue
+                page_texts[i] = text
+                _ocr_cache_put(pending[i][0], text)
+
+    if stats["ocrPages"] and pytesseract is None:
+        print("⚠️ Scanned pages detected but pytesseract is not installed; skipping OCR")
+
+    if TEXT_NORMALIZE:
+        with span("pdf.normalize", pages=len(page_texts)):
+            page_texts, report = normalize_pages(page_texts)
+        stats["normalization"] = report
+        TEXT_TOKENS_SAVED.inc(current_endpoint(), amount=report["tokensSaved"])
+        print(f"🧹 Normalized {len(page_texts)} pages: {report['tokensSaved']} tokens saved ({report['savedPercent']}%)")
+        text = "\n\n".join(t for t in page_texts if t)
+    else:
+        text = "".join(page_texts)
+
+    # Don't pin text for scanned pages that could not be OCR'd yet
+    if not ocr_failed and not (stats["ocrPages"] and pytesseract is None):
+        _text_cache_put(cache_key, text, stats)
+    return text, {**stats, "textCacheHit": False}
+
+
+# ---------------------------------------------------------------------------
+# Artifact store: saved podcasts and generated study material (SQLite, WAL)
+# ---------------------------------------------------------------------------
+ARTIFACT_DB = os.getenv("ARTIFACT_DB", os.path.join(DATA_DIR, "artifacts.db"))
+ARTIFACT_AUTOSAVE = os.getenv("ARTIFACT_AUTOSAVE", "1") != "0"
+ARTIFACT_COMPRESS_MIN_BYTES = int(os.getenv("ARTIFACT_COMPRESS_MIN_BYTES", 1024))
+ARTIFACT_LIST_LIMIT = 200
+
+_ARTIFACT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    doc_id TEXT,
+    kind TEXT NOT NULL,
+    title TEXT,
+    format TEXT NOT NULL,
+    encoding TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    body BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_user_recent ON artifacts (user_id, updated_at DESC);
+CREATE INDEX IF NOT EXISTS artifacts_user_kind ON artifacts (user_id, kind, updated_at DESC);
+CREATE INDEX IF NOT EXISTS artifacts_user_doc ON artifacts (user_id, doc_id, kind, updated_at DESC);
+"""
+_ARTIFACT_META = "id, user_id, doc_id, kind, title, format, size, created_at, updated_at"
+
+
+class ArtifactStore:
+    """Per-user artifacts in SQLite (WAL mode). Each thread gets its own connection; bodies over
+    ARTIFACT_COMPRESS_MIN_BYTES are zlib-compressed. Reads by id are a single primary-key lookup."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(_ARTIFACT_SCHEMA)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _encode(data):
+        fmt = "markdown" if isinstance(data, str) else "json"
+        raw = (data if fmt == "markdown" else json.dumps(data, ensure_ascii=False)).encode("utf-8")
+        if len(raw) >= ARTIFACT_COMPRESS_MIN_BYTES:
+            return fmt, "zlib", len(raw), zlib.compress(raw, 6)
+        return fmt, "raw", len(raw), raw
+
+    @staticmethod
+    def _decode(row):
+        body = bytes(row["body"])
+        if row["encoding"] == "zlib":
+            body = zlib.decompress(body)
+        text = body.decode("utf-8")
+        return text if row["format"] == "markdown" else json.loads(text)
+
+    @staticmethod
+    def _meta(row):
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "docId": row["doc_id"],
+            "title": row["title"],
+            "format": row["format"],
+            "size": row["size"],
+            "createdAt": datetime.fromtimestamp(row["created_at"]).isoformat(),
+            "updatedAt": datetime.fromtimestamp(row["updated_at"]).isoformat(),
+        }
+
+    def _timed(self, op):
+        start = _time.perf_counter()
+        return lambda: ARTIFACT_SECONDS.observe(_time.perf_counter() - start, current_endpoint(), op)
+
+    def save(self, user_id, kind, data, doc_id=None, title=None, artifact_id=None):
+        """Insert or replace an artifact; returns its id (a fresh one if `artifact_id` is another user's)."""
+        artifact_id = artifact_id or os.urandom(8).hex()
+        fmt, encoding, size, body = self._encode(data)
+        now = _time.time()
+        done = self._timed("save")
+        with span("artifact.save", kind=kind, bytes=size, stored=len(body)):
+            cursor = self._conn().execute(
+                "INSERT INTO artifacts (id, user_id, doc_id, kind, title, format, encoding, size, body, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET doc_id = COALESCE(excluded.doc_id, artifacts.doc_id), "
+                "title = COALESCE(excluded.title, artifacts.title), "
+                "format = excluded.format, encoding = excluded.encoding, size = excluded.size, "
+                "body = excluded.body, updated_at = excluded.updated_at "
+                "WHERE artifacts.user_id = excluded.user_id AND artifacts.kind = excluded.kind",
+                (artifact_id, user_id, doc_id, kind, title, fmt, encoding, size, sqlite3.Binary(body), now, now),
+            )
+        done()
+        if cursor.rowcount == 0:
+            return self.save(user_id, kind, data, doc_id=doc_id, title=title)
+        return artifact_id
+
+    def update(self, user_id, artifact_id, kind, fn):
+        """Read-modify-write an artifact's data in one write transaction, so concurrent updates from other
+        threads or workers are never lost. `fn(data)` returns the new data, or None to leave it as is.
+        Returns the stored data, or None if the user has no such artifact (or `fn` declined)."""
+        conn = self._conn()
+        done = self._timed("update")
+        with span("artifact.update", kind=kind):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT format, encoding, body FROM artifacts WHERE id = ? AND user_id = ? AND kind = ?",
+                    (artifact_id, user_id, kind),
+                ).fetchone()
+                data = None if row is None else fn(self._decode(row))
+                if data is not None:
+                    fmt, encoding, size, body = self._encode(data)
+                    conn.execute("UPDATE artifacts SET format = ?, encoding = ?, size = ?, body = ?, updated_at = ? WHERE id = ?",
+                                 (fmt, encoding, size, sqlite3.Binary(body), _time.time(), artifact_id))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        done()
+        return data
+
+    def exists(self, user_id, artifact_id):
+        row = self._conn().execute("SELECT 1 FROM artifacts WHERE id = ? AND user_id = ?", (artifact_id, user_id)).fetchone()
+        return row is not None
+
+    def get(self, user_id, artifact_id):
+        """Metadata plus decoded `data`, or None if the user has no such artifact."""
+        done = self._timed("get")
+        with span("artifact.get"):
+            row = self._conn().execute(
+                f"SELECT {_ARTIFACT_META}, encoding, body FROM artifacts WHERE id = ? AND user_id = ?",
+                (artifact_id, user_id),
+            ).fetchone()
+            result = None if row is None else {**self._meta(row), "data": self._decode(row)}
+        done()
+        return result
+
+    def list(self, user_id, kind=None, doc_id=None, limit=50, offset=0):
+        """Newest-first metadata (no bodies), optionally filtered by kind and document."""
+        sql = f"SELECT {_ARTIFACT_META} FROM artifacts WHERE user_id = ?"
+        params = [user_id]
+        if doc_id:
+            sql += " AND doc_id = ?"
+            params.append(doc_id)
+        if kind:
+            sql += " AND kind = ?"
+            params.append(kind)
+        sql += " ORDER BY updated_at DESC LIMIT ? OFFSET ?"
+        params += [limit, offset]
+        done = self._timed("list")
+        with span("artifact.list"):
+            rows = self._conn().execute(sql, params).fetchall()
+        done()
+        return [self._meta(row) for row in rows]
+
+    def delete(self, user_id, artifact_id):
+        done = self._timed("delete")
+        cursor = self._conn().execute("DELETE FROM artifacts WHERE id = ? AND user_id = ?", (artifact_id, user_id))
+        done()
+        return cursor.rowcount > 0
+
+
+artifact_store = ArtifactStore(ARTIFACT_DB)
+
+
+USER_COOKIE = "omb_user"
+USER_COOKIE_MAX_AGE = 365 * 24 * 3600
+USER_SECRET_FILE = os.path.join(DATA_DIR, "user_secret")
+
+
+_user_secret = os.getenv("USER_SECRET_KEY", "").encode("utf-8") or None
+
+
+def user_secret():
+    """USER_SECRET_KEY, else a random key kept in DATA_DIR so every worker and restart signs ids the same way."""
+    global _user_secret
+    if _user_secret is None:
+        with _lazy_lock:
+            if _user_secret is None:
+                os.makedirs(DATA_DIR, exist_ok=True)
+                try:
+                    fd = os.open(USER_SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                except FileExistsError:
+                    with open(USER_SECRET_FILE, "rb") as f:
+                        _user_secret = f.read().strip()
+                else:
+                    secret = os.urandom(32).hex().encode("ascii")
+                    with os.fdopen(fd, "wb") as f:
+                        f.write(secret)
+                    _user_secret = secret
+    return _user_secret
+
+
+def _user_token(user_id):
+    signature = hmac.new(user_secret(), user_id.encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+    return f"{user_id}.{signature}"
+
+
+def _verified_user(token):
+    user_id, _, signature = (token or "").partition(".")
+    if re.fullmatch(r"[0-9a-f]{32}", user_id) and hmac.compare_digest(_user_token(user_id), token):
+        return user_id
+    return None
+
+
+def current_user_id():
+    """Caller identity for artifacts and jobs: a random id the server issued in a signed cookie.
+
+    API clients without cookies can send the same token back in X-User-Token. A caller without a
+    valid token gets a fresh id (set as a cookie on the response), never a shared bucket.
+    """
+    user_id = getattr(request, "_user_id", None)
+    if user_id is None:
+        user_id = _verified_user(request.headers.get("X-User-Token") or request.cookies.get(USER_COOKIE))
+        if user_id is None:
+            user_id = os.urandom(16).hex()
+            request._issue_user_token = _user_token(user_id)
+        request._user_id = user_id
+    return user_id
+
+
+@app.after_request
+def _issue_user_cookie(response):
+    token = getattr(request, "_issue_user_token", None)
+    if token:
+        response.set_cookie(USER_COOKIE, token, max_age=USER_COOKIE_MAX_AGE, httponly=True, samesite="Lax",
+                            secure=request.is_secure)
+        response.headers["X-User-Token"] = token
+    return response
+
+
+def document_id(text):
+    """Stable id for a document's text, so artifacts from the same upload group together."""
+    return hashlib.sha256((text or "").strip().encode("utf-8")).hexdigest()[:16]
+
+
+def artifact_spec(kind, doc_id=None, title=None, variant=""):
+    """Describe where a generator's output is saved. Captured while the request context is live.
+
+    The id is derived from (user, kind, document, variant), so regenerating the same thing
+    replaces the previous copy instead of piling up duplicates.
+    """
+    user_id = current_user_id()
+    key = "|".join([user_id, kind, doc_id or "", str(variant)])
+    return {
+        "user_id": user_id,
+        "kind": kind,
+        "doc_id": doc_id,
+        "title": title,
+        "artifact_id": hashlib.sha256(key.encode("utf-8")).hexdigest()[:16],
+    }
+
+
+def save_artifact(spec, data):
+    """Auto-save generated output; returns the artifact id, or None if disabled or the write failed."""
+    if not ARTIFACT_AUTOSAVE or spec is None or not data:
+        return None
+    try:
+        return artifact_store.save(data=data, **spec)
+    except sqlite3.Error as e:
+        print(f"⚠️ Could not save {spec['kind']} artifact: {e}")
         return None
-    candidate = cleaned[start:end+1]
+
+
+@app.route('/api/artifacts', methods=['GET'])
+def list_artifacts():
+    """List the caller's saved artifacts (metadata only), newest first."""
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), ARTIFACT_LIST_LIMIT))
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+    try:
+        items = artifact_store.list(current_user_id(), kind=request.args.get('kind'),
+                                    doc_id=request.args.get('docId'), limit=limit, offset=offset)
+    except sqlite3.Error as e:
+        return jsonify({"error": f"Artifact store error: {str(e)}"}), 500
+    return jsonify({"artifacts": items, "count": len(items), "limit": limit, "offset": offset})
+
+
+@app.route('/api/artifacts/<artifact_id>', methods=['GET'])
+def get_artifact(artifact_id):
+    """Return one saved artifact with its content; no LLM calls involved."""
+    try:
+        artifact = artifact_store.get(current_user_id(), artifact_id)
+    except sqlite3.Error as e:
+        return jsonify({"error": f"Artifact store error: {str(e)}"}), 500
+    if artifact is None:
+        return jsonify({"error": "Artifact not found"}), 404
+    return jsonify(artifact)
+
+
+@app.route('/api/artifacts/<artifact_id>', methods=['DELETE'])
+def delete_artifact(artifact_id):
     try:
-        return json.loads(candidate)
-    except Exception:
-        # Last resort: remove trailing commas
-        candidate2 = re.sub(r',\s*([}\]])', r'\1', candidate)
+        deleted = artifact_store.delete(current_user_id(), artifact_id)
+    except sqlite3.Error as e:
+        return jsonify({"error": f"Artifact store error: {str(e)}"}), 500
+    if not deleted:
+        return jsonify({"error": "Artifact not found"}), 404
+    return jsonify({"success": True, "id": artifact_id})
+
+
+# ---------------------------------------------------------------------------
+# Jobs: stop in-flight LLM/TTS work on client disconnect, /api/jobs/<id>/cancel or a request deadline
+# ---------------------------------------------------------------------------
+REQUEST_CANCELLATION = os.getenv("REQUEST_CANCELLATION", "1") != "0"
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", 300))
+# Per-endpoint overrides, e.g. REQUEST_DEADLINES='{"chat": 60, "generate_research_paper": 240}'
+REQUEST_DEADLINES = json.loads(os.getenv("REQUEST_DEADLINES") or "{}")
+JOB_MIN_CALL_SECONDS = float(os.getenv("JOB_MIN_CALL_SECONDS", 2))  # no new upstream call with less time left
+JOB_STREAM_UPSTREAM = os.getenv("JOB_STREAM_UPSTREAM", "1") != "0"   # stream non-streaming calls so a cancel can cut them off
+JOB_POLL_SECONDS = 0.25  # how often sockets, deadlines and cancel markers are checked
+JOB_DIR = os.getenv("JOB_DIR", os.path.join(DATA_DIR, "jobs"))  # cancel markers for jobs owned by other workers
+
+JOB_ERRORS = {
+    "cancelled": (499, "Request cancelled"),
+    "disconnected": (499, "Client disconnected"),
+    "deadline": (504, "Request deadline exceeded"),
+}
+JOBS_CANCELLED = metrics.counter("jobs_cancelled_total", "Requests whose LLM/TTS work was stopped early.", ("endpoint", "reason"))
+
+_current_job = contextvars.ContextVar("current_job", default=None)
+_jobs = {}
+_jobs_lock = threading.Lock()
+_job_watcher = None
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's work once it is cancelled, its client is gone or its deadline has passed."""
+
+    def __init__(self, job):
+        super().__init__(JOB_ERRORS[job.reason][1])
+        self.job = job
+        self.reason = job.reason
+
+
+class Job:
+    """One in-flight request whose upstream work can be stopped early."""
+
+    def __init__(self, job_id, user_id, endpoint, timeout, sock=None):
+        self.id = job_id
+        self.user_id = user_id
+        self.endpoint = endpoint
+        self.sock = sock
+        self.started = _time.monotonic()
+        self.started_at = datetime.now().isoformat()
+        self.started_wall = _time.time()
+        self.deadline = self.started + timeout
+        self.reason = None
+        self.closed = False
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        return self.deadline - _time.monotonic()
+
+    def cancel(self, reason):
+        """Mark the job cancelled; work notices at its next check. False if it already finished or stopped."""
+        with self._lock:
+            if self.closed or self.reason:
+                return False
+            self.reason = reason
+        self._event.set()
+        JOBS_CANCELLED.inc(self.endpoint, reason)
+        print(f"🛑 Job {self.id} ({self.endpoint}): {JOB_ERRORS[reason][1].lower()} after "
+              f"{_time.monotonic() - self.started:.1f}s; stopping upstream work")
+        return True
+
+    def close(self):
+        """The response is done: later cancels are ignored. Returns the reason if it was cancelled first."""
+        with self._lock:
+            self.closed = True
+            return self.reason
+
+    def check(self, needed=0.0):
+        """Raise JobCancelled if the job was cancelled or has less than `needed` seconds left."""
+        if self.reason is None and self.remaining() <= needed:
+            self.cancel("deadline")
+        if self.reason:
+            raise JobCancelled(self)
+
+    def wait(self, seconds):
+        """Sleep up to `seconds`, waking early with JobCancelled if the job is cancelled meanwhile."""
+        self._event.wait(max(0.0, min(seconds, self.remaining())))
+        self.check()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "startedAt": self.started_at,
+            "elapsed": round(_time.monotonic() - self.started, 2),
+            "remaining": round(self.remaining(), 2),
+            "status": self.reason or "running",
+        }
+
+
+def active_job():
+    """The current request's job while its response is still being produced, else None."""
+    job = _current_job.get()
+    return job if job is not None and not job.closed else None
+
+
+def check_job(needed=0.0):
+    job = active_job()
+    if job is not None:
+        job.check(needed)
+
+
+def job_sleep(seconds):
+    """time.sleep that is cut short (with JobCancelled) when the current job is cancelled."""
+    job = active_job()
+    if job is None:
+        _time.sleep(seconds)
+    else:
+        job.wait(seconds)
+
+
+def acquire_in_job(lock):
+    """lock.acquire() that gives up with JobCancelled once the current job is cancelled."""
+    job = active_job()
+    if job is None:
+        lock.acquire()
+        return
+    while not lock.acquire(timeout=JOB_POLL_SECONDS):
+        job.check()
+
+
+def wait_for_future(future):
+    """future.result() that stops waiting with JobCancelled once the current job is cancelled."""
+    job = active_job()
+    if job is None:
+        return future.result()
+    while True:
         try:
-            return json.loads(candidate2)
-        except Exception:
-            return None
+            return future.result(timeout=JOB_POLL_SECONDS)
+        except FuturesTimeout:
+            job.check()
+
+
+def in_job(chunks):
+    """Pass an upstream stream through, checking the current job between chunks and closing the stream on exit."""
+    job = active_job()
+    try:
+        for chunk in chunks:
+            if job is not None:
+                job.check()
+            yield chunk
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+
+
+def _client_disconnected(sock):
+    """True once the client has closed its end: the socket is readable but has nothing to read."""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError:  # TLS sockets cannot peek; treat as connected
+        return False
+    except OSError:
+        return True
+
+
+def _cancel_marker(job_id):
+    return os.path.join(JOB_DIR, f"{hashlib.sha256(job_id.encode('utf-8')).hexdigest()[:32]}.cancel")
+
+
+def _marked_cancelled(job):
+    """A marker left by another worker's /api/jobs/<id>/cancel (ignored if it predates this job)."""
+    path = _cancel_marker(job.id)
+    try:
+        if os.path.getmtime(path) < job.started_wall - 1:
+            return False
+        with open(path, encoding="utf-8") as f:
+            return f.read().strip() == job.user_id
+    except OSError:
+        return False
+
+
+def _prune_cancel_markers():
+    """Markers nobody picked up (the job had already finished) are dropped once no job could still be running."""
+    cutoff = _time.time() - max([REQUEST_DEADLINE_SECONDS, *map(float, REQUEST_DEADLINES.values())])
+    try:
+        for entry in os.scandir(JOB_DIR):
+            if entry.name.endswith(".cancel") and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+    except OSError:
+        pass
+
+
+def _watch_jobs():
+    """Background loop: cancel jobs whose deadline passed, whose client went away or that another worker cancelled."""
+    while True:
+        _time.sleep(JOB_POLL_SECONDS)
+        with _jobs_lock:
+            jobs = list(_jobs.values())
+        for job in jobs:
+            if job.closed or job.reason:
+                continue
+            if job.remaining() <= 0:
+                job.cancel("deadline")
+            elif job.sock is not None and _client_disconnected(job.sock):
+                job.cancel("disconnected")
+            elif _marked_cancelled(job):
+                job.cancel("cancelled")
+
+
+def _ensure_job_watcher():
+    global _job_watcher
+    if _job_watcher is None:
+        with _jobs_lock:
+            if _job_watcher is None:
+                _job_watcher = threading.Thread(target=_watch_jobs, name="job-watcher", daemon=True)
+                _job_watcher.start()
+
+
+@app.before_request
+def _start_job():
+    # Jobs cover the POST routes: every LLM/TTS generator is one, and reads have nothing worth cancelling
+    if not REQUEST_CANCELLATION or request.method != "POST" or request.endpoint == "cancel_job":
+        return
+    incoming = request.headers.get("X-Job-Id", "")
+    job_id = incoming if re.fullmatch(r"[A-Za-z0-9_-]{8,64}", incoming) else (_trace_id.get() or os.urandom(8).hex())
+    timeout = float(REQUEST_DEADLINES.get(request.endpoint, REQUEST_DEADLINE_SECONDS))
+    try:
+        timeout = min(timeout, float(request.headers.get("X-Deadline-Seconds") or timeout))
+    except ValueError:
+        pass
+    sock = request.environ.get("gunicorn.socket") or request.environ.get("werkzeug.socket")
+    job = Job(job_id, current_user_id(), request.endpoint or "unknown", timeout, sock)
+    with _jobs_lock:
+        if job.id in _jobs:
+            job.id = f"{job.id}-{os.urandom(3).hex()}"
+        _jobs[job.id] = job
+    _current_job.set(job)
+    _ensure_job_watcher()
+
+
+@app.after_request
+def _finish_job(response):
+    job = _current_job.get()
+    if job is None:
+        return response
+    if not response.is_streamed:
+        # Whatever the handler made of the JobCancelled (usually a 500), answer with what actually happened;
+        # a response that completed before the watcher fired is left alone
+        reason = job.close()
+        if reason and response.status_code >= 500:
+            status, message = JOB_ERRORS[reason]
+            response = jsonify({"error": message, "reason": reason, "jobId": job.id})
+            response.status_code = status
+    response.headers["X-Job-Id"] = job.id
+    return response
+
+
+@app.teardown_request
+def _end_job(error=None):
+    # Runs after streamed responses finish, so NDJSON streams stay cancellable until the last line
+    job = _current_job.get()
+    if job is None:
+        return
+    job.close()
+    with _jobs_lock:
+        if _jobs.get(job.id) is job:
+            del _jobs[job.id]
+    if job.reason == "cancelled":
+        try:
+            os.remove(_cancel_marker(job.id))
+        except OSError:
+            pass
+    _current_job.set(None)
+
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """The caller's in-flight requests in this worker"""
+    user_id = current_user_id()
+    with _jobs_lock:
+        jobs = [job.to_dict() for job in _jobs.values() if job.user_id == user_id and not job.closed]
+    return jsonify({"jobs": jobs, "count": len(jobs)})
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Stop a running request (its X-Job-Id) and the LLM/TTS calls it has in flight"""
+    user_id = current_user_id()
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is not None and job.user_id == user_id:
+        if not job.cancel("cancelled") and job.reason is None:
+            return jsonify({"error": "Job already finished", "id": job_id}), 409
+        return jsonify({"success": True, "id": job_id, "status": job.reason})
+    # Possibly running in another worker process: leave a marker its watcher picks up
+    _prune_cancel_markers()
+    try:
+        os.makedirs(JOB_DIR, exist_ok=True)
+        with open(_cancel_marker(job_id), "w", encoding="utf-8") as f:
+            f.write(user_id)
+    except OSError as e:
+        return jsonify({"error": f"Could not record cancellation: {str(e)}"}), 500
+    return jsonify({"success": True, "id": job_id, "status": "requested"}), 202
+
 
 @app.route('/teacher')
 def teacher():
@@ -93,56 +2283,94 @@ def about():
     """Simple About Us page"""
     return render_template('about.html')
 
-@app.route('/api/generate-professor-slides', methods=['POST'])
-def generate_professor_slides():
-    """Generate AI-powered teaching slides with deep, detailed content"""
-    try:
-        data = request.get_json(silent=True) or {}
-        
-        summary_text = data.get('summaryText', '')
-        slide_count = data.get('slideCount', 5)
-        teaching_style = data.get('teachingStyle', 'comprehensive')
-        
-        if not summary_text:
-            return jsonify({"error": "No content provided"}), 400
-        
-        # Teaching style configurations
-        style_configs = {
-            'comprehensive': {
-                'approach': 'Provide thorough explanations with multiple examples, analogies, and step-by-step breakdowns',
-                'depth': 'Deep dive into concepts with historical context, practical applications, and theoretical foundations',
-                'tone': 'Academic but accessible, like a passionate university professor'
-            },
-            'storytelling': {
-                'approach': 'Frame concepts as narratives with characters, conflicts, and resolutions',
-                'depth': 'Use real-world scenarios, case studies, and journey-based explanations',
-                'tone': 'Engaging and dramatic, building anticipation and excitement'
-            },
-            'socratic': {
-                'approach': 'Pose thought-provoking questions and guide learners to discover answers',
-                'depth': 'Challenge assumptions, explore implications, and develop critical thinking',
-                'tone': 'Inquisitive and contemplative, encouraging reflection'
-            },
-            'technical': {
-                'approach': 'Precise definitions, mathematical foundations, and systematic explanations',
-                'depth': 'Rigorous analysis with formulas, proofs, and technical specifications',
-                'tone': 'Professional and exact, emphasizing accuracy and completeness'
-            }
-        }
-        
-        style_config = style_configs.get(teaching_style, style_configs['comprehensive'])
-        
-        system_prompt = (
-            "You are a master educator who creates exceptional teaching content. "
-            "Your slides are comprehensive, engaging, and designed to maximize learning. "
-            "Output ONLY valid JSON, no markdown formatting."
-        )
-        
-        user_prompt = f"""Create {slide_count} deeply educational slides for a professor-led lecture.
+# Teaching style configurations
+SLIDE_STYLE_CONFIGS = {
+    'comprehensive': {
+        'approach': 'Provide thorough explanations with multiple examples, analogies, and step-by-step breakdowns',
+        'depth': 'Deep dive into concepts with historical context, practical applications, and theoretical foundations',
+        'tone': 'Academic but accessible, like a passionate university professor'
+    },
+    'storytelling': {
+        'approach': 'Frame concepts as narratives with characters, conflicts, and resolutions',
+        'depth': 'Use real-world scenarios, case studies, and journey-based explanations',
+        'tone': 'Engaging and dramatic, building anticipation and excitement'
+    },
+    'socratic': {
+        'approach': 'Pose thought-provoking questions and guide learners to discover answers',
+        'depth': 'Challenge assumptions, explore implications, and develop critical thinking',
+        'tone': 'Inquisitive and contemplative, encouraging reflection'
+    },
+    'technical': {
+        'approach': 'Precise definitions, mathematical foundations, and systematic explanations',
+        'depth': 'Rigorous analysis with formulas, proofs, and technical specifications',
+        'tone': 'Professional and exact, emphasizing accuracy and completeness'
+    }
+}
+
+SLIDE_SYSTEM_PROMPT = (
+    "You are a master educator who creates exceptional teaching content. "
+    "Your slides are comprehensive, engaging, and designed to maximize learning. "
+    "Output ONLY valid JSON, no markdown formatting."
+)
+
+# Slides are generated concurrently after a quick outline call
+SLIDE_CONCURRENCY = int(os.getenv("SLIDE_CONCURRENCY", 6))
+MAX_SLIDES = int(os.getenv("MAX_SLIDES", 40))
+
+
+@traced("slides.outline")
+def generate_slide_outline(summary_text, slide_count, teaching_style):
+    """Phase 1: one fast call that fixes the title and focus of every slide."""
+    user_prompt = f"""Plan a {slide_count}-slide professor-led lecture ({teaching_style} style) on this content.
+
+CONTENT TO TEACH:
+{summary_text}
+
+Return ONLY this JSON:
+{{
+  "outline": [
+    {{"slideNumber": 1, "title": "Clear, Descriptive Title", "focus": "One sentence on what this slide teaches"}}
+  ]
+}}
+
+Exactly {slide_count} entries. Build concepts progressively from fundamentals to applications."""
+
+    outline_text, _ = complete_text(
+        model="openai/gpt-oss-20b",
+        route=True,
+        messages=[
+            {"role": "system", "content": SLIDE_SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt}
+        ],
+        max_tokens=min(4000, 300 + slide_count * 60),
+        temperature=0.3
+    )
+    outline_data = parse_llm_json(outline_text, "outline")
+    if not outline_data or not outline_data["outline"]:
+        raise ValueError("Failed to parse slide outline")
+    return outline_data["outline"][:slide_count]
+
+
+@traced("slides.slide")
+def generate_single_slide(index, outline, summary_text, teaching_style):
+    """Phase 2: write the full JSON for one slide, with the whole outline as shared context."""
+    style_config = SLIDE_STYLE_CONFIGS.get(teaching_style, SLIDE_STYLE_CONFIGS['comprehensive'])
+    entry = outline[index]
+    outline_text = "\n".join(
+        f"{i + 1}. {item.get('title', '')} - {item.get('focus', '')}" for i, item in enumerate(outline)
+    )
+
+    user_prompt = f"""You are writing slide {index + 1} of {len(outline)} for a professor-led lecture.
 
 CONTENT TO TEACH:
 {summary_text}
 
+LECTURE OUTLINE:
+{outline_text}
+
+THIS SLIDE: {entry.get('title', '')}
+FOCUS: {entry.get('focus', '')}
+
 TEACHING STYLE: {teaching_style.upper()}
 - Approach: {style_config['approach']}
 - Depth: {style_config['depth']}
@@ -150,80 +2378,138 @@ TEACHING STYLE: {teaching_style.upper()}
 
 Generate a JSON response with this EXACT structure:
 {{
-  "slides": [
-    {{
-      "slideNumber": 1,
-      "title": "Clear, Descriptive Title",
-      "content": [
-        "First teaching point - detailed explanation (2-3 sentences)",
-        "Second teaching point - with examples and context (2-3 sentences)",
-        "Third teaching point - connecting to previous concepts (2-3 sentences)",
-        "Fourth teaching point - practical applications (2-3 sentences)"
-      ],
-      "narration": "Complete spoken script for this slide. This is what the professor will actually SAY - make it natural, conversational, and thorough. Include transitions, emphasis points, and engaging language. Should be 200-300 words for proper pacing.",
-      "example": {{
-        "title": "🎯 Real-World Example",
-        "content": "Concrete example that illustrates the concept"
-      }},
-      "visuals": [
-        {{
-          "icon": "📊",
-          "title": "Visual Element 1",
-          "description": "Brief description"
-        }},
-        {{
-          "icon": "🔬",
-          "title": "Visual Element 2",
-          "description": "Brief description"
-        }}
-      ],
-      "keyTakeaway": "One crucial insight from this slide"
-    }}
-  ]
+  "slideNumber": {index + 1},
+  "title": "{entry.get('title', '')}",
+  "content": [
+    "First teaching point - detailed explanation (2-3 sentences)",
+    "Second teaching point - with examples and context (2-3 sentences)",
+    "Third teaching point - connecting to previous concepts (2-3 sentences)",
+    "Fourth teaching point - practical applications (2-3 sentences)"
+  ],
+  "narration": "Complete spoken script for this slide. This is what the professor will actually SAY - make it natural, conversational, and thorough. Include transitions from the previous slide and into the next one. Should be 200-300 words for proper pacing.",
+  "example": {{
+    "title": "🎯 Real-World Example",
+    "content": "Concrete example that illustrates the concept"
+  }},
+  "visuals": [
+    {{"icon": "📊", "title": "Visual Element 1", "description": "Brief description"}},
+    {{"icon": "🔬", "title": "Visual Element 2", "description": "Brief description"}}
+  ],
+  "keyTakeaway": "One crucial insight from this slide"
 }}
 
 CRITICAL REQUIREMENTS:
-1. Each slide should have 4-6 content points
-2. The "narration" field is THE ACTUAL SPOKEN SCRIPT (200-300 words per slide)
-3. Use analogies, examples, and clear explanations
-4. Build concepts progressively across slides
-5. Include at least 1 example per slide
-6. Use appropriate emojis for visual icons
-7. Return ONLY the JSON, no markdown code blocks
-
-Output the complete JSON now:"""
+1. 4-6 content points, covering only this slide's focus (other slides cover the rest of the outline)
+2. The "narration" field is THE ACTUAL SPOKEN SCRIPT (200-300 words)
+3. Include at least 1 example and appropriate emojis for visual icons
+4. Return ONLY the JSON, no markdown code blocks"""
 
+    last_error = None
+    for _ in range(2):  # one retry per slide, so a bad slide never costs the whole deck
         try:
-            response = client.chat.completions.create(
+            slide_text, _ = complete_text(
                 model="openai/gpt-oss-20b",
+                route=True,
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": SLIDE_SYSTEM_PROMPT},
                     {"role": "user", "content": user_prompt}
                 ],
-                max_tokens=2500,
+                max_tokens=1200,
                 temperature=0.3
             )
+            slide = parse_llm_json(slide_text, "slide")
+            if slide:
+                slide["slideNumber"] = index + 1
+                return slide
+            last_error = "Failed to parse AI response as JSON"
         except Exception as e:
-            return jsonify({"error": f"Slides generation failed: {str(e)}"}), 500
-        
-        slides_json_str = response.choices[0].message.content.strip()
+            last_error = str(e)
+    raise ValueError(last_error)
+
+
+def _placeholder_slide(index, entry, error):
+    """Minimal slide built from the outline when a slide cannot be generated."""
+    title = entry.get('title', f'Slide {index + 1}')
+    focus = entry.get('focus', '')
+    return {
+        "slideNumber": index + 1,
+        "title": title,
+        "content": [focus] if focus else [],
+        "narration": f"{title}. {focus}",
+        "keyTakeaway": focus,
+        "error": error
+    }
+
+
+@app.route('/api/generate-professor-slides', methods=['POST'])
+def generate_professor_slides():
+    """Generate AI-powered teaching slides with deep, detailed content"""
+    try:
+        data = request.get_json(silent=True) or {}
         
-        # Robust JSON extraction
-        slide_data = extract_json_object(slides_json_str)
-        if not slide_data or 'slides' not in slide_data:
-            return jsonify({
-                "error": "Failed to parse AI response as JSON",
-                "raw_response": slides_json_str[:800]
-            }), 500
+        summary_text = data.get('summaryText', '')
+        try:
+            slide_count = max(1, min(int(data.get('slideCount', 5) or 5), MAX_SLIDES))
+        except (TypeError, ValueError):
+            return jsonify({"error": "slideCount must be a whole number"}), 400
+        teaching_style = data.get('teachingStyle', 'comprehensive')
         
+        if not summary_text:
+            return jsonify({"error": "No content provided"}), 400
+
+        start = datetime.now()
+        try:
+            outline = generate_slide_outline(summary_text, slide_count, teaching_style)
+        except Exception as e:
+            return jsonify({"error": f"Slides generation failed: {str(e)}"}), 500
+
+        def run_slides():
+            """Yield (index, slide, error) as each slide finishes, bounded by SLIDE_CONCURRENCY."""
+            workers = max(1, min(SLIDE_CONCURRENCY, len(outline)))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    submit_in_context(pool, generate_single_slide, i, outline, summary_text, teaching_style): i
+                    for i in range(len(outline))
+                }
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        yield i, future.result(), None
+                    except Exception as e:
+                        print(f"⚠️ Slide {i + 1} failed: {e}")
+                        yield i, _placeholder_slide(i, outline[i], str(e)), str(e)
+
+        def assemble(results):
+            slides = [results[i] for i in sorted(results)]
+            return {
+                "slides": slides,
+                "outline": outline,
+                "stats": {
+                    "slideCount": len(slides),
+                    "failedSlides": [s["slideNumber"] for s in slides if s.get("error")],
+                    "generationTime": round((datetime.now() - start).total_seconds(), 2),
+                    "routing": routing_stats()
+                }
+            }
+
+        # Stream slides to the client as each one finishes (may arrive out of order)
+        if data.get('stream'):
+            def generate():
+                yield json.dumps({"type": "outline", "outline": outline}) + "\n"
+                results = {}
+                for i, slide, error in run_slides():
+                    results[i] = slide
+                    yield json.dumps({"type": "item", "key": "slides", "index": i, "item": slide}) + "\n"
+                yield json.dumps({"type": "done", "data": assemble(results)}) + "\n"
+
+            return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+        results = {i: slide for i, slide, _ in run_slides()}
+        slide_data = assemble(results)
+        if len(slide_data["stats"]["failedSlides"]) == len(outline):
+            return jsonify({"error": "Slide generation failed for every slide"}), 500
         return jsonify(slide_data)
         
-    except json.JSONDecodeError as e:
-        return jsonify({
-            "error": "Failed to parse AI response as JSON",
-            "details": str(e),
-            "raw_response": slides_json_str[:500] if 'slides_json_str' in locals() else ""
-        }), 500
     except Exception as e:
         return jsonify({"error": f"Slide generation failed: {str(e)}"}), 500
 
@@ -275,55 +2561,31 @@ def generate_professor_audio():
         # ✅ FIXED: Better error handling and fallback logic
         os.makedirs("static/audio", exist_ok=True)
         
-        # Try ElevenLabs first if client is available
-        if eleven_client and ELEVENLABS_API_KEY:
-            try:
-                print(f"Attempting ElevenLabs TTS with voice: {voice_id}")
-                
-                audio = eleven_client.text_to_speech.convert(
-                    voice_id=voice_id,
-                    model_id="eleven_turbo_v2",
-                    text=full_script,
-                    output_format="mp3_44100_128"
-                )
-
-                filename = f"professor_{int(datetime.now().timestamp())}.mp3"
-                filepath = os.path.join("static/audio", filename)
-                
-                with open(filepath, "wb") as f:
-                    for chunk in audio:
-                        f.write(chunk)
-
-                audio_url = f"/static/audio/{filename}"
-                
-                return jsonify({
-                    "message": "Professor audio generated successfully (ElevenLabs)",
-                    "audioUrl": audio_url,
-                    "timestamps": timestamps,
-                    "totalDuration": current_time,
-                    "voiceId": voice_id,
-                    "script": full_script
-                })
-                
-            except Exception as e:
-                print(f"ElevenLabs failed: {str(e)}, falling back to gTTS")
-                # Fall through to gTTS
-        
-        # Fallback to gTTS
-        print("Using gTTS fallback")
-        tts = gTTS(text=full_script, lang='en', slow=False)
-        filename = f"professor_gtts_{int(datetime.now().timestamp())}.mp3"
+        # ElevenLabs first (or the engine named in voiceId), then the configured fallbacks
+        try:
+            engine, voice = resolve_voice(voice_id, default_engine="elevenlabs")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        print(f"Attempting TTS with engine: {engine}, voice: {voice}")
+        audio, served_by = tts_synthesize(full_script, engine=engine, voice=voice)
+
+        prefix = "professor" if served_by == "elevenlabs" else f"professor_{served_by}"
+        filename = f"{prefix}_{int(datetime.now().timestamp())}.{audio_extension(audio)}"
         filepath = os.path.join("static/audio", filename)
-        tts.save(filepath)
-        
+        with open(filepath, "wb") as f:
+            f.write(audio)
+
         audio_url = f"/static/audio/{filename}"
-        
+        engine_labels = {"elevenlabs": "ElevenLabs", "gtts": "gTTS", "local": "local"}
+        fallback_note = "" if served_by == engine else " fallback"
+
         return jsonify({
-            "message": "Professor audio generated successfully (gTTS fallback)",
+            "message": f"Professor audio generated successfully ({engine_labels.get(served_by, served_by)}{fallback_note})",
             "audioUrl": audio_url,
             "timestamps": timestamps,
             "totalDuration": current_time,
-            "voiceId": "gtts",
+            "voiceId": voice_id if served_by == engine else served_by,
+            "engine": served_by,
             "script": full_script
         })
         
@@ -335,6 +2597,55 @@ def generate_professor_audio():
 @app.route('/smart')
 def smart_page():
     return render_template('smart.html')
+
+
+def build_fallback_schedule(exam_date, daily_hours):
+    """Basic default schedule used when the AI response cannot be parsed."""
+    exam_dt = datetime.strptime(exam_date, '%Y-%m-%d')
+    days_until_exam = max(3, min(14, (exam_dt - datetime.now()).days))
+
+    fallback_schedule = {
+        "title": "AI Study Plan (Fallback Mode)",
+        "totalTopics": 10,
+        "examDate": exam_date,
+        "dailyHours": daily_hours,
+        "schedule": [],
+        "cheatSheets": [
+            {
+                "title": "Quick Reference - Key Concepts",
+                "content": "Review your document for key formulas and definitions",
+                "type": "general"
+            }
+        ]
+    }
+
+    # Generate simple daily schedule
+    start_date = datetime.now()
+    for i in range(min(days_until_exam, 7)):
+        day_date = start_date + timedelta(days=i)
+        fallback_schedule["schedule"].append({
+            "day": i + 1,
+            "date": day_date.strftime('%Y-%m-%d'),
+            "topics": [
+                {
+                    "time": "9:00 AM - 10:00 AM",
+                    "topic": f"Study Session {i+1}",
+                    "description": "Review key concepts from your materials",
+                    "type": "theory" if i < 3 else "review",
+                    "music": "lofi"
+                }
+            ],
+            "goals": [
+                "Review main concepts",
+                "Practice problems",
+                "Take notes"
+            ]
+        })
+
+    print("✅ Fallback schedule generated")
+    return fallback_schedule
+
+
 @app.route('/api/generate-schedule', methods=['POST'])
 def generate_schedule():
     """Generate AI-powered study schedule from uploaded PDFs"""
@@ -350,6 +2661,14 @@ def generate_schedule():
         
         if not exam_date:
             return jsonify({"error": "Exam date is required"}), 400
+        try:
+            exam_dt = datetime.strptime(exam_date, '%Y-%m-%d')
+        except (TypeError, ValueError):
+            return jsonify({"error": "examDate must be a date in YYYY-MM-DD format"}), 400
+        try:
+            compression_ratio = parse_compression_ratio(data.get('compressionRatio'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         # Fallback: allow direct PDF upload (multipart/form-data)
         if not summary_text and not source_text:
@@ -362,11 +2681,8 @@ def generate_schedule():
 
             if uploaded_file and uploaded_file.filename:
                 try:
-                    doc = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-                    extracted = []
-                    for page in doc:
-                        extracted.append(page.get_text())
-                    source_text = "\n".join(extracted).strip()
+                    source_text, _ = extract_pdf_text(uploaded_file.read())
+                    source_text = source_text.strip()
                 except Exception as pe:
                     return jsonify({
                         "error": f"Failed to read uploaded PDF: {str(pe)}"
@@ -378,12 +2694,20 @@ def generate_schedule():
                 "hint": "Pass summaryText/sourceText as JSON or upload a PDF in 'file'"
             }), 400
         
-        # Build context
+        doc_id = data.get('docId') or document_id(source_text or summary_text)
+        artifact = artifact_spec("schedule", doc_id, f"Study plan until {exam_date}",
+                                 variant=f"{exam_date}:{daily_hours}:{study_preference}")
+
+        # Build context (the prompt keeps 3000 chars; a long source contributes its most on-topic passages,
+        # minus the sentences the summary already covers)
+        budget = 3000 - (len(summary_text) + len("DOCUMENT SUMMARY:\n\n\n") if summary_text else 0) - len("FULL DOCUMENT TEXT:\n")
+        selected = select_source_text(source_text, summary_text, budget) if source_text and budget > 0 else ""
+        summary_part, selected, compression = compressed_context(summary_text, selected, compression_ratio)
         context = ""
-        if summary_text:
-            context += f"DOCUMENT SUMMARY:\n{summary_text}\n\n"
-        if source_text:
-            context += f"FULL DOCUMENT TEXT:\n{source_text}\n\n"
+        if summary_part:
+            context += f"DOCUMENT SUMMARY:\n{summary_part}\n\n"
+        if selected:
+            context += f"FULL DOCUMENT TEXT:\n{selected}\n\n"
         
         # AI prompt for schedule generation
         system_prompt = (
@@ -435,7 +2759,7 @@ Required JSON structure (output THIS EXACT format):
 
 RULES:
 1. Extract 8-15 key topics from the content
-2. Create {max(3, min(14, (datetime.strptime(exam_date, '%Y-%m-%d') - datetime.now()).days))} days of schedule
+2. Create {max(3, min(14, (exam_dt - datetime.now()).days))} days of schedule
 3. Each day: {daily_hours} total hours split across topics
 4. Use times like "9:00 AM - 10:00 AM"
 5. types: "theory", "practice", "review"
@@ -446,21 +2770,33 @@ RULES:
 
 Start with {{ now:"""
 
+        completion_kwargs = dict(
+            model="openai/gpt-oss-20b",
+            route=True,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            max_tokens=2500,
+            temperature=0.3
+        )
+
+        # Stream schedule days to the client as each one finishes parsing
+        if data.get('stream'):
+            return stream_json_completion(
+                "schedule",
+                finalize=lambda parsed: parsed or build_fallback_schedule(exam_date, daily_hours),
+                artifact=artifact,
+                **completion_kwargs
+            )
+
         # Call Together AI (stable model and settings for JSON fidelity)
         try:
-            response = client.chat.completions.create(
-                model="openai/gpt-oss-20b",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                max_tokens=2500,
-                temperature=0.3
-            )
+            schedule_json_str, _ = complete_text(**completion_kwargs)
         except Exception as ai_error:
             return jsonify({"error": f"AI model error: {str(ai_error)}"}), 500
         
-        schedule_json_str = response.choices[0].message.content.strip()
+        schedule_json_str = schedule_json_str.strip()
         
         print(f"\n{'='*60}")
         print("📅 SCHEDULE GENERATION DEBUG")
@@ -468,99 +2804,19 @@ Start with {{ now:"""
         print(f"First 200 chars: {schedule_json_str[:200]}")
         print(f"{'='*60}\n")
 
-        # Robust JSON extraction using helper (handles code fences and trailing commas)
-        schedule_data = extract_json_object(schedule_json_str)
+        # Robust JSON extraction (handles code fences, trailing commas and truncation)
+        schedule_data = parse_llm_json(schedule_json_str, "schedule")
         
         if not schedule_data:
-            # Try one more aggressive cleanup
-            try:
-                # Remove ALL markdown artifacts
-                cleaned = re.sub(r'```[a-z]*\n?', '', schedule_json_str)
-                cleaned = re.sub(r'\n```', '', cleaned)
-                cleaned = cleaned.strip()
-                
-                # Try to find JSON bounds more aggressively
-                start = cleaned.find('{')
-                end = cleaned.rfind('}')
-                
-                if start != -1 and end != -1:
-                    json_str = cleaned[start:end+1]
-                    # Fix common JSON issues
-                    json_str = re.sub(r',(\s*[}\]])', r'\1', json_str)  # Remove trailing commas
-                    json_str = re.sub(r'}\s*{', '},{', json_str)  # Fix missing commas between objects
-                    schedule_data = json.loads(json_str)
-            except Exception as parse_error:
-                print(f"❌ JSON parse failed: {str(parse_error)}")
-                
-                # FALLBACK: Generate a basic default schedule
-                print("⚠️ Using fallback schedule generation...")
-                
-                try:
-                    exam_dt = datetime.strptime(exam_date, '%Y-%m-%d')
-                    days_until_exam = max(3, min(14, (exam_dt - datetime.now()).days))
-                    
-                    # Create simple fallback schedule
-                    fallback_schedule = {
-                        "title": "AI Study Plan (Fallback Mode)",
-                        "totalTopics": 10,
-                        "examDate": exam_date,
-                        "dailyHours": daily_hours,
-                        "schedule": [],
-                        "cheatSheets": [
-                            {
-                                "title": "Quick Reference - Key Concepts",
-                                "content": "Review your document for key formulas and definitions",
-                                "type": "general"
-                            }
-                        ]
-                    }
-                    
-                    # Generate simple daily schedule
-                    start_date = datetime.now()
-                    for i in range(min(days_until_exam, 7)):
-                        day_date = start_date + timedelta(days=i)
-                        fallback_schedule["schedule"].append({
-                            "day": i + 1,
-                            "date": day_date.strftime('%Y-%m-%d'),
-                            "topics": [
-                                {
-                                    "time": "9:00 AM - 10:00 AM",
-                                    "topic": f"Study Session {i+1}",
-                                    "description": "Review key concepts from your materials",
-                                    "type": "theory" if i < 3 else "review",
-                                    "music": "lofi"
-                                }
-                            ],
-                            "goals": [
-                                "Review main concepts",
-                                "Practice problems",
-                                "Take notes"
-                            ]
-                        })
-                    
-                    print("✅ Fallback schedule generated")
-                    return jsonify(fallback_schedule)
-                    
-                except Exception as fallback_error:
-                    print(f"❌ Fallback also failed: {str(fallback_error)}")
-                    return jsonify({
-                        "error": "Failed to parse AI response as JSON",
-                        "details": str(parse_error),
-                        "raw_response": schedule_json_str[:1000],
-                        "hint": "AI returned malformed JSON. Try again or reduce content size."
-                    }), 500
-        
-        # Validate required fields
-        if not schedule_data or 'schedule' not in schedule_data:
-            return jsonify({
-                "error": "Invalid schedule data structure",
-                "details": "Missing 'schedule' field in response",
-                "received_keys": list(schedule_data.keys()) if isinstance(schedule_data, dict) else "Not a dict",
-                "raw_response": schedule_json_str[:800]
-            }), 500
+            # FALLBACK: Generate a basic default schedule
+            print("⚠️ Using fallback schedule generation...")
+            return jsonify(build_fallback_schedule(exam_date, daily_hours))
         
         print(f"✅ Successfully generated schedule with {len(schedule_data.get('schedule', []))} days")
-        
+
+        schedule_data["docId"] = doc_id
+        schedule_data["artifactId"] = save_artifact(artifact, schedule_data)
+        schedule_data["stats"] = {"routing": routing_stats(), "compression": compression}
         return jsonify(schedule_data)
         
     except json.JSONDecodeError as e:
@@ -573,7 +2829,6 @@ Start with {{ now:"""
         }), 500
     except Exception as e:
         print(f"❌ Schedule Generation Error: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({
             "error": f"Schedule generation failed: {str(e)}",
@@ -592,42 +2847,38 @@ def podcast():
     """Podcast mode page route"""
     return render_template('podcast.html')
 
-@app.route('/api/generate-podcast-script', methods=['POST'])
-def generate_podcast_script():
-    """Generate AI-powered podcast script from document content"""
-    try:
-        data = request.get_json(silent=True) or {}
-        
-        # Extract parameters
-        summary_text = data.get('summaryText', '')
-        source_text = data.get('sourceText', '')
-        duration = data.get('duration', 5)  # default 5 minutes; supported: 3, 5, 10
-        style = data.get('style', 'educational')
-        pace = data.get('pace', 'normal')
-        tone = data.get('tone', 'calm')
-        language = data.get('language', 'en')
-        
-        if not summary_text and not source_text:
-            return jsonify({"error": "No document content provided"}), 400
-        
-        # Build context (limit size to avoid token overflow)
-        context = ""
-        if summary_text:
-            context += f"DOCUMENT SUMMARY:\n{summary_text[:2000]}\n\n"
-        if source_text:
-            context += f"FULL DOCUMENT TEXT:\n{source_text[:2000]}\n\n"
-        
-        # Calculate word count target
-        target_words = duration * 150
-        
-        # AI prompt - EMPHASIZE plain text output
-        system_prompt = (
-            "You are an expert podcast scriptwriter. "
-            "Output ONLY the spoken script - NO JSON, NO metadata, NO code blocks. "
-            "Just write the actual words that will be spoken in the podcast."
-        )
-        
-        user_prompt = f"""Create a {duration}-minute podcast script about this content:
+def build_podcast_request(data):
+    """Build the podcast-script completion arguments and settings from request JSON."""
+    # Extract parameters
+    summary_text = data.get('summaryText', '')
+    source_text = data.get('sourceText', '')
+    duration = data.get('duration', 5)  # default 5 minutes; supported: 3, 5, 10
+    style = data.get('style', 'educational')
+    pace = data.get('pace', 'normal')
+    tone = data.get('tone', 'calm')
+    language = data.get('language', 'en')
+
+    if not summary_text and not source_text:
+        raise ValueError("No document content provided")
+
+    # Build context (limit size to avoid token overflow)
+    context = ""
+    if summary_text:
+        context += f"DOCUMENT SUMMARY:\n{summary_text[:2000]}\n\n"
+    if source_text:
+        context += f"FULL DOCUMENT TEXT:\n{source_text[:2000]}\n\n"
+
+    # Calculate word count target
+    target_words = duration * 150
+
+    # AI prompt - EMPHASIZE plain text output
+    system_prompt = (
+        "You are an expert podcast scriptwriter. "
+        "Output ONLY the spoken script - NO JSON, NO metadata, NO code blocks. "
+        "Just write the actual words that will be spoken in the podcast."
+    )
+
+    user_prompt = f"""Create a {duration}-minute podcast script about this content:
 
 {context}
 
@@ -646,18 +2897,41 @@ For single narrator, just write naturally without labels.
 
 Begin the script now:"""
 
-        # Token budget scaled for ~150 words/min
-        max_tokens_map = {3: 900, 5: 1500, 10: 2500}
+    # Token budget scaled for ~150 words/min
+    max_tokens_map = {3: 900, 5: 1500, 10: 2500}
+
+    completion_kwargs = dict(
+        model="openai/gpt-oss-20b",
+        route=True,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        max_tokens=max_tokens_map.get(duration, 3000),
+        temperature=0.7
+    )
+    settings = {
+        "duration": duration,
+        "style": style,
+        "pace": pace,
+        "tone": tone,
+        "language": language
+    }
+    return completion_kwargs, settings
+
+
+@app.route('/api/generate-podcast-script', methods=['POST'])
+def generate_podcast_script():
+    """Generate AI-powered podcast script from document content"""
+    try:
+        data = request.get_json(silent=True) or {}
         
-        response = client.chat.completions.create(
-            model="openai/gpt-oss-20b",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=max_tokens_map.get(duration, 3000),
-            temperature=0.7
-        )
+        try:
+            completion_kwargs, settings = build_podcast_request(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        response = llm.create(**completion_kwargs)
         
         script = response.choices[0].message.content.strip()
         
@@ -687,26 +2961,889 @@ Begin the script now:"""
             "script": script,
             "wordCount": word_count,
             "estimatedDuration": estimated_duration,
-            "settings": {
-                "duration": duration,
-                "style": style,
-                "pace": pace,
-                "tone": tone,
-                "language": language
-            }
+            "settings": settings,
+            "stats": {"routing": routing_stats()}
         })
     except Exception as e:
-        print(f"Podcast error: {str(e)}")
-        return jsonify({"error": f"Podcast script generation failed: {str(e)}"}), 500
+        print(f"Podcast error: {str(e)}")
+        return jsonify({"error": f"Podcast script generation failed: {str(e)}"}), 500
+
+# ---------------------------------------------------------------------------
+# TTS engine registry: pooled clients, rate limits, health tracking, fallback
+# ---------------------------------------------------------------------------
+DEFAULT_ELEVENLABS_VOICE = os.getenv("ELEVENLABS_VOICE_ID", "21m00Tcm4TlvDq8ikWAM")
+TTS_FALLBACK_ORDER = [e.strip() for e in os.getenv("TTS_FALLBACK_ORDER", "elevenlabs,gtts,local").split(",") if e.strip()]
+TTS_ROUTING = os.getenv("TTS_ROUTING", "ordered")  # "ordered" or "fastest"
+PODCAST_TTS_ENGINE = os.getenv("PODCAST_TTS_ENGINE", "gtts")
+TTS_FAILURE_THRESHOLD = 3    # consecutive errors before an engine is benched
+TTS_COOLDOWN_SECONDS = 30.0
+
+
+def _parse_engine_settings(value):
+    """Parse 'gtts=4,elevenlabs=2' style env settings into a dict of floats."""
+    settings = {}
+    for part in (value or "").split(","):
+        if "=" in part:
+            name, number = part.split("=", 1)
+            settings[name.strip()] = float(number)
+    return settings
+
+
+GTTS_TLDS = frozenset(t.strip() for t in os.getenv(
+    "GTTS_TLDS", "com,co.uk,com.au,ca,co.in,ie,co.za,us,com.ng,com.br,pt,com.mx,es,fr").split(",") if t.strip())
+TTS_CONCURRENCY = {"elevenlabs": 2, "gtts": 4, "local": 2, **_parse_engine_settings(os.getenv("TTS_CONCURRENCY"))}
+TTS_RATE_LIMITS = {"elevenlabs": 3.0, "gtts": 5.0, **_parse_engine_settings(os.getenv("TTS_RATE_LIMITS"))}
+
+
+class TTSEngine:
+    """Base TTS engine: concurrency cap, requests/sec limit and latency/error tracking.
+
+    Subclasses implement `available()` and `_synthesize(text, voice, lang) -> bytes` (MP3).
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self.concurrency = max(1, int(TTS_CONCURRENCY.get(self.name, 2)))
+        self.rate = TTS_RATE_LIMITS.get(self.name)
+        self._semaphore = threading.BoundedSemaphore(self.concurrency)
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.latency_ewma = None
+        self.benched_until = 0.0
+
+    def available(self):
+        return True
+
+    def voice_allowed(self, voice):
+        """Whether a client may pick `voice` for this engine (None means the engine's default)."""
+        return True
+
+    def healthy(self):
+        return self.available() and _time.monotonic() >= self.benched_until
+
+    def _wait_for_rate_slot(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = _time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            job_sleep(slot - now)
+
+    def synthesize(self, text, voice=None, lang='en'):
+        check_job(JOB_MIN_CALL_SECONDS)
+        acquire_in_job(self._semaphore)
+        try:
+            self._wait_for_rate_slot()
+            start = _time.perf_counter()
+            TTS_CHARACTERS.inc(current_endpoint(), self.name, amount=len(text))
+            try:
+                audio = self._synthesize(text, voice, lang)
+            except JobCancelled:
+                # Not the engine's fault: no error count, no cooldown
+                TTS_SECONDS.observe(_time.perf_counter() - start, current_endpoint(), self.name, "cancelled")
+                add_span(f"tts.{self.name}", start, _time.perf_counter(), chars=len(text), status="cancelled")
+                raise
+            except Exception:
+                TTS_SECONDS.observe(_time.perf_counter() - start, current_endpoint(), self.name, "error")
+                add_span(f"tts.{self.name}", start, _time.perf_counter(), chars=len(text), status="error")
+                with self._lock:
+                    self.calls += 1
+                    self.errors += 1
+                    self.consecutive_errors += 1
+                    if self.consecutive_errors >= TTS_FAILURE_THRESHOLD:
+                        self.benched_until = _time.monotonic() + TTS_COOLDOWN_SECONDS
+                raise
+            elapsed = _time.perf_counter() - start
+            TTS_SECONDS.observe(elapsed, current_endpoint(), self.name, "ok")
+            add_span(f"tts.{self.name}", start, start + elapsed, chars=len(text))
+            with self._lock:
+                self.calls += 1
+                self.consecutive_errors = 0
+                self.latency_ewma = elapsed if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * elapsed
+            return audio
+        finally:
+            self._semaphore.release()
+
+    def stats(self):
+        return {
+            "available": self.available(),
+            "healthy": self.healthy(),
+            "calls": self.calls,
+            "errors": self.errors,
+            "latencyEwma": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "concurrency": self.concurrency,
+            "ratePerSec": self.rate,
+        }
+
+
+class ElevenLabsEngine(TTSEngine):
+    name = "elevenlabs"
+
+    def __init__(self):
+        super().__init__()
+        self._client = None
+
+    def available(self):
+        return bool(ELEVENLABS_API_KEY)
+
+    def client(self):
+        # One client per process, backed by a pooled keep-alive HTTP connection pool
+        with self._lock:
+            if self._client is None:
+                self._client = elevenlabs.ElevenLabs(
+                    api_key=ELEVENLABS_API_KEY,
+                    base_url=ELEVENLABS_BASE_URL,
+                    httpx_client=httpx.Client(
+                        timeout=240,
+                        limits=httpx.Limits(max_connections=self.concurrency,
+                                            max_keepalive_connections=self.concurrency),
+                    ),
+                )
+                print("✅ ElevenLabs client initialized")
+            return self._client
+
+    def _synthesize(self, text, voice, lang):
+        job = active_job()
+        # Audio is read chunk by chunk, so a cancelled job drops the connection mid-synthesis
+        return b"".join(in_job(self.client().text_to_speech.convert(
+            voice_id=voice or DEFAULT_ELEVENLABS_VOICE,
+            model_id="eleven_turbo_v2",
+            text=text,
+            output_format="mp3_44100_128",
+            request_options={"timeout_in_seconds": max(1, math.ceil(job.remaining()))} if job is not None else None
+        )))
+
+
+class _JobCheckedBuffer(BytesIO):
+    """BytesIO that stops a writer between chunks once the current job is cancelled."""
+
+    def write(self, data):
+        check_job()
+        return super().write(data)
+
+
+class GTTSEngine(TTSEngine):
+    """gTTS voices are Google Translate domains (translate.google.<tld>), so only known accents are accepted."""
+
+    name = "gtts"
+
+    def voice_allowed(self, voice):
+        return voice is None or voice in GTTS_TLDS
+
+    def _synthesize(self, text, voice, lang):
+        if not self.voice_allowed(voice):
+            raise ValueError(f"Unknown gTTS accent: {voice}")
+        # write_to_fp fetches and writes one text chunk at a time, so a cancelled job stops after the current chunk
+        buffer = _JobCheckedBuffer()
+        gtts.gTTS(text=text, lang=lang, tld=voice or "com", slow=False).write_to_fp(buffer)
+        return buffer.getvalue()
+
+
+LOCAL_TTS_WORKERS = int(os.getenv("LOCAL_TTS_WORKERS", 2))
+PIPER_MODEL = os.getenv("PIPER_MODEL", "")
+# Named piper voices a request may pick with 'local:<name>', e.g. 'amy=/models/en_US-amy.onnx,alan=/models/en_GB-alan.onnx'
+PIPER_VOICES = {name.strip(): path.strip() for name, _, path in
+                (part.partition("=") for part in os.getenv("PIPER_VOICES", "").split(",")) if name.strip() and path.strip()}
+_ESPEAK_VOICE_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9_+-]{0,31}")  # e.g. en-gb, en-us+f3; never an option or a path
+
+
+def _local_tts_render(kind, text, voice, lang, encoder):
+    """Run a local synthesizer (inside the worker pool) and return MP3, or WAV if no encoder exists."""
+    with tempfile.TemporaryDirectory(prefix="local_tts_") as tmp:
+        wav_path = os.path.join(tmp, "speech.wav")
+        if kind == "piper":
+            cmd = ["piper", "--model", PIPER_VOICES[voice] if voice else PIPER_MODEL, "--output_file", wav_path]
+        else:
+            voice = voice or (lang if _ESPEAK_VOICE_RE.fullmatch(lang or "") else "en")
+            cmd = [kind, "-v", voice, "-w", wav_path, "--stdin"]
+        subprocess.run(cmd, input=text.encode("utf-8"), capture_output=True, check=True, timeout=300)
+
+        if encoder == "ffmpeg":
+            mp3_path = os.path.join(tmp, "speech.mp3")
+            subprocess.run(["ffmpeg", "-loglevel", "error", "-y", "-i", wav_path,
+                            "-codec:a", "libmp3lame", "-b:a", "64k", mp3_path],
+                           capture_output=True, check=True, timeout=300)
+            wav_path = mp3_path
+        elif encoder == "lame":
+            mp3_path = os.path.join(tmp, "speech.mp3")
+            subprocess.run(["lame", "--quiet", "-b", "64", wav_path, mp3_path],
+                           capture_output=True, check=True, timeout=300)
+            wav_path = mp3_path
+        with open(wav_path, "rb") as f:
+            return f.read()
+
+
+class LocalTTSEngine(TTSEngine):
+    """Offline synthesis with piper or espeak-ng in a worker process pool: no network, no per-character cost.
+
+    Without a local synthesizer installed the engine is unavailable. LOCAL_TTS_ENGINE=stub opts in to
+    silent audio of the estimated speaking length, for offline test and benchmark runs.
+    """
+
+    name = "local"
+    _FRAME = bytes([0xFF, 0xFB, 0x90, 0x64]) + b"\x00" * 413  # MPEG-1 L3, 128 kbps, 44.1 kHz
+
+    def __init__(self):
+        super().__init__()
+        self.kind = self._detect_synthesizer()
+        self.encoder = next((tool for tool in ("ffmpeg", "lame") if shutil.which(tool)), None)
+        self._pool = None
+
+    @staticmethod
+    def _detect_synthesizer():
+        forced = os.getenv("LOCAL_TTS_ENGINE")
+        if forced:
+            return forced
+        if PIPER_MODEL and shutil.which("piper"):
+            return "piper"
+        for tool in ("espeak-ng", "espeak"):
+            if shutil.which(tool):
+                return tool
+        return None
+
+    def available(self):
+        return self.kind is not None
+
+    def voice_allowed(self, voice):
+        """Piper voices come from PIPER_VOICES (never a path from the request); espeak takes plain voice names."""
+        if voice is None:
+            return True
+        if self.kind == "piper":
+            return voice in PIPER_VOICES
+        return bool(_ESPEAK_VOICE_RE.fullmatch(voice))
+
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=max(1, LOCAL_TTS_WORKERS))
+            return self._pool
+
+    def _synthesize(self, text, voice, lang):
+        if not self.voice_allowed(voice):
+            raise ValueError(f"Unknown local voice: {voice}")
+        if self.kind == "stub":
+            seconds = max(1.0, len(text.split()) / 150 * 60)
+            return mp3_silence(self._FRAME, seconds)
+        return wait_for_future(self.pool().submit(_local_tts_render, self.kind, text, voice, lang, self.encoder))
+
+    def stats(self):
+        return {**super().stats(), "synthesizer": self.kind, "encoder": self.encoder}
+
+
+TTS_ENGINES = {engine.name: engine for engine in (ElevenLabsEngine(), GTTSEngine(), LocalTTSEngine())}
+
+
+def resolve_voice(voice_id, default_engine=None):
+    """Map a request's voiceId to (engine, voice): 'gtts', 'gtts:co.uk', 'local', 'elevenlabs:<id>' or a bare ElevenLabs id.
+
+    Raises ValueError for a voice the named engine does not accept.
+    """
+    if not voice_id:
+        return default_engine, None
+    engine, _, voice = str(voice_id).partition(":")
+    if engine not in TTS_ENGINES:
+        return "elevenlabs", voice_id
+    if not TTS_ENGINES[engine].voice_allowed(voice or None):
+        raise ValueError(f"Unknown {engine} voice: {voice}")
+    return engine, voice or None
+
+
+def tts_engine_order(preferred=None):
+    """Engines to try: the preferred one first, then the configured fallback order."""
+    order = [name for name in TTS_FALLBACK_ORDER if name in TTS_ENGINES]
+    if TTS_ROUTING == "fastest":
+        order.sort(key=lambda name: TTS_ENGINES[name].latency_ewma or float("inf"))
+    if preferred in TTS_ENGINES:
+        order = [preferred] + [name for name in order if name != preferred]
+    return [name for name in order if TTS_ENGINES[name].healthy()]
+
+
+def tts_synthesize(text, engine=None, voice=None, lang='en'):
+    """Synthesize MP3 bytes with the preferred engine, falling back in order. Returns (audio, engine name)."""
+    last_error = None
+    for name in tts_engine_order(engine):
+        try:
+            # A voice id only means something to the engine it was chosen for
+            audio = TTS_ENGINES[name].synthesize(text, voice if name == engine else None, lang)
+            return audio, name
+        except JobCancelled:
+            raise  # no point trying the next engine
+        except Exception as e:
+            last_error = e
+            print(f"⚠️ TTS engine {name} failed: {e}")
+    if last_error is None:
+        raise RuntimeError("No TTS engine available")
+    raise RuntimeError(f"All TTS engines failed. Last error: {last_error}")
+
+
+@app.route('/api/tts/engines', methods=['GET'])
+def tts_engines():
+    """Health, latency and error counts for each TTS engine"""
+    return jsonify({
+        "fallbackOrder": TTS_FALLBACK_ORDER,
+        "routing": TTS_ROUTING,
+        "engines": {name: engine.stats() for name, engine in TTS_ENGINES.items()}
+    })
+
+
+# ---------------------------------------------------------------------------
+# Streaming podcast pipeline: script generation overlapped with TTS
+# ---------------------------------------------------------------------------
+PODCAST_TTS_CONCURRENCY = int(os.getenv("PODCAST_TTS_CONCURRENCY", 3))
+PODCAST_SEGMENT_MAX_CHARS = 600
+PODCAST_FIRST_SEGMENT_CHARS = 200  # flush the first sentence early so playback starts fast
+PODCAST_MAX_JOBS = 100
+PODCAST_STREAM_IDLE_TIMEOUT = 120  # seconds without a new segment before a cross-worker audio stream gives up
+PODCAST_JOB_TTL = int(os.getenv("PODCAST_JOB_TTL", 24 * 3600))  # seconds a finished job's audio is kept
+PODCAST_PRUNE_INTERVAL = 600
+
+_SPEAKER_RE = re.compile(r"^\s*((?:HOST|SPEAKER)\s+[A-Z0-9]+|NARRATOR)\s*:\s*", re.IGNORECASE)
+_SENTENCE_END_RE = re.compile(r"[.!?][\"')\]]?\s")
+
+podcast_jobs = {}
+podcast_jobs_lock = threading.Lock()
+_podcast_pruned_at = 0.0
+
+
+def split_script_segments(buffer, final=False, first=False):
+    """Split streamed script text into complete segments (paragraphs or speaker turns).
+
+    Returns (segments, remainder); the remainder is kept until more text arrives,
+    unless `final` is set.
+    """
+    segments = []
+    while True:
+        # A paragraph break or a new speaker label closes the current segment
+        cut = -1
+        para = buffer.find("\n\n")
+        if para != -1:
+            cut = para
+        for match in re.finditer(r"\n", buffer):
+            if _SPEAKER_RE.match(buffer[match.end():]) and (cut == -1 or match.start() < cut):
+                cut = match.start()
+                break
+        limit = PODCAST_FIRST_SEGMENT_CHARS if first and not segments else PODCAST_SEGMENT_MAX_CHARS
+        if cut == -1 and len(buffer) > limit:
+            # Long paragraph: cut at the last sentence end inside the window
+            ends = [m.end() for m in _SENTENCE_END_RE.finditer(buffer[:PODCAST_SEGMENT_MAX_CHARS])]
+            if ends:
+                cut = ends[-1]
+        if cut == -1:
+            break
+        piece, buffer = buffer[:cut].strip(), buffer[cut:].lstrip("\n ")
+        if piece:
+            segments.append(piece)
+    if final and buffer.strip():
+        segments.append(buffer.strip())
+        buffer = ""
+    return segments, buffer
+
+
+def parse_speaker(segment, default_speaker="NARRATOR"):
+    """Split a 'HOST A: text' segment into (speaker, spoken text)."""
+    match = _SPEAKER_RE.match(segment)
+    if match:
+        return match.group(1).upper(), segment[match.end():].strip()
+    return default_speaker, segment.strip()
+
+
+# Speaker -> voice mapping for dialogue scripts. gTTS "voices" are regional accents (tld);
+# ElevenLabs voices are voice ids. Override with PODCAST_VOICES='{"HOST A": {...}, ...}'.
+PODCAST_VOICES = json.loads(os.getenv("PODCAST_VOICES") or json.dumps({
+    "HOST A": {"engine": "gtts", "voice": "com"},
+    "HOST B": {"engine": "gtts", "voice": "co.uk"},
+    "NARRATOR": {"engine": "gtts", "voice": "com"},
+}))
+PODCAST_TURN_GAP = float(os.getenv("PODCAST_TURN_GAP", 0.4))
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join(DATA_DIR, "tts_cache"))
+
+
+def voice_for_speaker(speaker):
+    """Look up the configured voice for a speaker label, falling back to the narrator voice."""
+    voices = PODCAST_VOICES
+    return voices.get(speaker) or voices.get("NARRATOR") or {"engine": "gtts", "voice": "com"}
+
+
+def synthesize_speech(text, lang='en', engine='gtts', voice=None):
+    """Render text to MP3 bytes through the engine registry, cached per (engine, voice, text)."""
+    key = hashlib.sha256(f"{engine}|{voice}|{lang}|{text}".encode("utf-8")).hexdigest()
+    for ext in ("mp3", "wav"):
+        cache_path = os.path.join(TTS_CACHE_DIR, f"{key}.{ext}")
+        if os.path.exists(cache_path):
+            CACHE_LOOKUPS.inc(current_endpoint(), "tts", "hit")
+            with open(cache_path, "rb") as f:
+                return f.read()
+    CACHE_LOOKUPS.inc(current_endpoint(), "tts", "miss")
+
+    audio, served_by = tts_synthesize(text, engine=engine, voice=voice, lang=lang)
+
+    # Only cache audio in the requested voice, not a fallback engine's stand-in
+    if served_by == engine:
+        try:
+            os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+            with open(os.path.join(TTS_CACHE_DIR, f"{key}.{audio_extension(audio)}"), "wb") as f:
+                f.write(audio)
+        except OSError as e:
+            print(f"⚠️ Could not write TTS cache: {e}")
+    return audio
+
+
+def synthesize_turn(speaker, text, lang='en'):
+    """Render one dialogue turn with the speaker's configured voice."""
+    voice = voice_for_speaker(speaker)
+    return synthesize_speech(text, lang=lang, engine=voice.get("engine", "gtts"), voice=voice.get("voice"))
+
+
+# --- MP3 frame helpers (stitching turns without re-encoding) ---
+_MP3_BITRATES = {
+    True: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],  # MPEG-1 Layer III
+    False: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],     # MPEG-2/2.5 Layer III
+}
+_MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def _strip_id3(data):
+    """Drop a leading ID3v2 tag so segments can be concatenated cleanly."""
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        return data[10 + size:]
+    return data
+
+
+def _mp3_frame_info(data, pos):
+    """Parse the Layer III frame header at `pos`; returns (length, samples, sample_rate) or None."""
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+        return None
+    version = (data[pos + 1] >> 3) & 3
+    layer = (data[pos + 1] >> 1) & 3
+    bitrate_idx = data[pos + 2] >> 4
+    rate_idx = (data[pos + 2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_idx in (0, 15) or rate_idx == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[mpeg1][bitrate_idx] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_idx]
+    padding = (data[pos + 2] >> 1) & 1
+    length = (144 if mpeg1 else 72) * bitrate // sample_rate + padding
+    return length, (1152 if mpeg1 else 576), sample_rate
+
+
+def _first_mp3_frame(data):
+    for pos in range(min(len(data), 8192)):
+        if _mp3_frame_info(data, pos):
+            return pos
+    return -1
+
+
+def mp3_duration(data):
+    """Duration in seconds, from walking the frame headers."""
+    data = _strip_id3(data)
+    pos = _first_mp3_frame(data)
+    seconds = 0.0
+    while pos >= 0:
+        info = _mp3_frame_info(data, pos)
+        if not info:
+            break
+        length, samples, sample_rate = info
+        seconds += samples / sample_rate
+        pos += length
+    return seconds
+
+
+def mp3_silence(like, seconds):
+    """Silent frames matching the format of the MP3 `like`, so concatenation stays decodable."""
+    data = _strip_id3(like)
+    pos = _first_mp3_frame(data)
+    if pos < 0 or seconds <= 0:
+        return b""
+    header = bytearray(data[pos:pos + 4])
+    header[1] |= 0x01   # no CRC
+    header[2] &= ~0x02  # no padding
+    length, samples, sample_rate = _mp3_frame_info(bytes(header), 0)
+    frame = bytes(header) + b"\x00" * (length - 4)  # zeroed side info decodes as silence
+    return frame * max(1, int(round(seconds * sample_rate / samples)))
+
+
+def stitch_mp3(parts, gap_seconds=0.0):
+    """Concatenate MP3 segments with a configurable silent gap between them."""
+    out = bytearray()
+    for i, part in enumerate(parts):
+        part = _strip_id3(part)
+        if i and gap_seconds:
+            out += mp3_silence(part, gap_seconds)
+        out += part
+    return bytes(out)
+
+
+def audio_extension(data):
+    """'wav' for RIFF/WAVE data (local engine without an MP3 encoder), otherwise 'mp3'."""
+    return "wav" if data[:4] == b"RIFF" else "mp3"
+
+
+def _read_wav(data):
+    with wave.open(BytesIO(data), "rb") as w:
+        return w.getparams(), w.readframes(w.getnframes())
+
+
+def audio_duration(data):
+    """Duration in seconds for MP3 or WAV audio."""
+    if audio_extension(data) == "wav":
+        params, _ = _read_wav(data)
+        return params.nframes / float(params.framerate)
+    return mp3_duration(data)
+
+
+def stitch_wav(parts, gap_seconds=0.0):
+    """Concatenate WAV clips of the same format with silent gaps."""
+    params, _ = _read_wav(parts[0])
+    out = BytesIO()
+    with wave.open(out, "wb") as w:
+        w.setparams(params)
+        silence = b"\x00" * (int(params.framerate * gap_seconds) * params.sampwidth * params.nchannels)
+        for i, part in enumerate(parts):
+            if i and gap_seconds:
+                w.writeframes(silence)
+            w.writeframes(_read_wav(part)[1])
+    return out.getvalue()
+
+
+def stitch_audio(parts, gap_seconds=0.0):
+    """Stitch MP3 or WAV segments; mixing the two needs an encoder and is rejected."""
+    formats = {audio_extension(part) for part in parts}
+    if formats == {"wav"}:
+        return stitch_wav(parts, gap_seconds)
+    if formats == {"mp3"}:
+        return stitch_mp3(parts, gap_seconds)
+    raise ValueError("Cannot stitch mixed MP3/WAV audio; install ffmpeg or lame for the local engine")
+
+
+def parse_dialogue_turns(script):
+    """Split a HOST A:/HOST B: script into [(speaker, text)]; unlabeled lines continue the current turn."""
+    turns = []
+    for line in script.splitlines():
+        if not line.strip():
+            continue
+        if _SPEAKER_RE.match(line) or not turns:
+            speaker, text = parse_speaker(line)
+            turns.append([speaker, text])
+        else:
+            turns[-1][1] += " " + line.strip()
+    return [(speaker, text) for speaker, text in turns if text]
+
+
+def render_dialogue(turns, lang='en', gap_seconds=PODCAST_TURN_GAP):
+    """Synthesize all turns concurrently (per-engine limits apply) and stitch them in order."""
+    if not turns:
+        return b""
+    workers = max(1, min(len(turns), sum(engine.concurrency for engine in TTS_ENGINES.values())))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [submit_in_context(pool, synthesize_turn, speaker, text, lang) for speaker, text in turns]
+        try:
+            parts = [wait_for_future(future) for future in futures]
+        except JobCancelled:
+            for future in futures:
+                future.cancel()  # turns that have not started yet
+            raise
+    return stitch_audio(parts, gap_seconds)
+
+
+class PodcastJob:
+    """State of one pipelined podcast: streamed script plus audio segments as they render."""
+
+    def __init__(self, job_id, settings):
+        self.id = job_id
+        self.settings = settings
+        self.dir = os.path.join("static/audio", job_id)
+        self.script = ""
+        self.segments = []  # dicts: index, speaker, text, file, duration, ready, error
+        self.status = "running"
+        self.error = None
+        self.created = datetime.now()
+        self.cond = threading.Condition()
+
+    def ready_prefix(self):
+        """Segments that are ready and contiguous from the start (safe to play in order)."""
+        prefix = []
+        for seg in self.segments:
+            if not seg["ready"]:
+                break
+            prefix.append(seg)
+        return prefix
+
+    def publish(self):
+        """Write the playlist and a job.json snapshot, so any worker process can serve this job."""
+        self.write_playlist()
+        tmp = os.path.join(self.dir, "job.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp, os.path.join(self.dir, "job.json"))
+
+    def write_playlist(self):
+        """Write an HLS-style playlist listing the ready prefix of segments."""
+        ready = [seg for seg in self.ready_prefix() if not seg["error"]]
+        target = max([int(seg["duration"]) + 1 for seg in ready] or [10])
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{target}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+        ]
+        for seg in ready:
+            lines.append(f"#EXTINF:{seg['duration']:.2f},")
+            lines.append(seg["file"])
+        if self.status != "running" and len(self.ready_prefix()) == len(self.segments):
+            lines.append("#EXT-X-ENDLIST")
+        tmp = os.path.join(self.dir, "playlist.m3u8.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, os.path.join(self.dir, "playlist.m3u8"))
+
+    def to_dict(self):
+        with self.cond:
+            return {
+                "jobId": self.id,
+                "status": self.status,
+                "error": self.error,
+                "script": self.script,
+                "settings": self.settings,
+                "playlistUrl": f"/{self.dir}/playlist.m3u8",
+                "audioUrl": f"/api/podcast/stream/{self.id}/audio.mp3",
+                "segments": [
+                    {
+                        "index": seg["index"],
+                        "speaker": seg["speaker"],
+                        "text": seg["text"],
+                        "url": f"/{self.dir}/{seg['file']}" if seg["ready"] and not seg["error"] else None,
+                        "duration": seg["duration"],
+                        "ready": seg["ready"],
+                        "error": seg["error"],
+                    }
+                    for seg in self.segments
+                ],
+            }
+
+
+def load_podcast_snapshot(job_id):
+    """Read the job.json a (possibly different) worker process published for this job."""
+    if not re.fullmatch(r"[\w-]+", job_id or ""):
+        return None
+    try:
+        with open(os.path.join("static/audio", job_id, "job.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def prune_podcast_jobs(now=None):
+    """Delete the audio directories (segments, playlist, job.json) of jobs idle for PODCAST_JOB_TTL.
+
+    A running job republishes job.json with every segment, so its snapshot never looks idle.
+    Runs at most every PODCAST_PRUNE_INTERVAL seconds per worker.
+    """
+    global _podcast_pruned_at
+    now = now or _time.time()
+    with podcast_jobs_lock:
+        if now - _podcast_pruned_at < PODCAST_PRUNE_INTERVAL:
+            return
+        _podcast_pruned_at = now
+    cutoff = now - PODCAST_JOB_TTL
+    try:
+        entries = [e for e in os.scandir("static/audio") if e.name.startswith("podcast_") and e.is_dir()]
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            snapshot = os.path.join(entry.path, "job.json")
+            last_update = os.path.getmtime(snapshot) if os.path.exists(snapshot) else entry.stat().st_mtime
+            if last_update >= cutoff:
+                continue
+            with podcast_jobs_lock:
+                podcast_jobs.pop(entry.name, None)
+            shutil.rmtree(entry.path)
+            print(f"🧹 Removed podcast job {entry.name}")
+        except OSError as e:
+            print(f"⚠️ Could not prune podcast job {entry.name}: {e}")
+
+
+def stream_podcast_from_disk(job_id, poll_seconds=0.5, idle_timeout=PODCAST_STREAM_IDLE_TIMEOUT):
+    """Yield a job's segments in order by polling its snapshot; used when another worker owns the job."""
+    index = 0
+    last_progress = _time.monotonic()
+    while _time.monotonic() - last_progress < idle_timeout:
+        snapshot = load_podcast_snapshot(job_id) or {}
+        segments = snapshot.get("segments", [])
+        while index < len(segments) and segments[index]["ready"]:
+            url = segments[index]["url"]
+            index += 1
+            last_progress = _time.monotonic()
+            if url:
+                with open(os.path.join("static/audio", job_id, os.path.basename(url)), "rb") as f:
+                    yield f.read()
+        if snapshot.get("status") != "running" and index >= len(segments):
+            return
+        _time.sleep(poll_seconds)
+
+
+def _render_podcast_segment(job, seg):
+    """Synthesize one segment to disk and publish it (runs in the TTS pool)."""
+    try:
+        audio = synthesize_turn(seg["speaker"], seg["text"], lang=job.settings.get("language", "en"))
+        seg["file"] = f"seg_{seg['index']:03d}.{audio_extension(audio)}"
+        with open(os.path.join(job.dir, seg["file"]), "wb") as f:
+            f.write(audio)
+        seg["duration"] = round(audio_duration(audio), 2) or seg["duration"]
+    except Exception as e:
+        print(f"⚠️ Podcast segment {seg['index']} failed: {e}")
+        seg["error"] = str(e)
+    with job.cond:
+        seg["ready"] = True
+        job.publish()
+        job.cond.notify_all()
+
+
+def run_podcast_pipeline(job, completion_kwargs):
+    """Stream the script from the LLM and hand each finished segment straight to TTS."""
+    os.makedirs(job.dir, exist_ok=True)
+    with job.cond:
+        job.publish()
+    pool = ThreadPoolExecutor(max_workers=max(1, PODCAST_TTS_CONCURRENCY))
+    buffer = ""
+
+    def submit(pieces):
+        for piece in pieces:
+            # Continuations of a long turn keep the previous speaker
+            previous = job.segments[-1]["speaker"] if job.segments else "NARRATOR"
+            speaker, spoken = parse_speaker(piece, default_speaker=previous)
+            if not spoken:
+                continue
+            with job.cond:
+                index = len(job.segments)
+                seg = {
+                    "index": index,
+                    "speaker": speaker,
+                    "text": spoken,
+                    "file": f"seg_{index:03d}.mp3",
+                    "duration": round(len(spoken.split()) / 150 * 60, 2),
+                    "ready": False,
+                    "error": None,
+                }
+                job.segments.append(seg)
+            submit_in_context(pool, _render_podcast_segment, job, seg)
+
+    try:
+        stream = llm.create(stream=True, **completion_kwargs)
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if not delta:
+                continue
+            with job.cond:
+                job.script += delta
+            buffer += delta
+            # Drop code-fence lines if the model ignored instructions
+            buffer = re.sub(r"^```[a-z]*[ \t]*$\n?", "", buffer, flags=re.MULTILINE | re.IGNORECASE)
+            pieces, buffer = split_script_segments(buffer, first=not job.segments)
+            submit(pieces)
+        pieces, buffer = split_script_segments(buffer, final=True)
+        submit(pieces)
+        pool.shutdown(wait=True)
+        with job.cond:
+            job.status = "done"
+    except Exception as e:
+        print(f"❌ Podcast pipeline failed: {e}")
+        pool.shutdown(wait=True)
+        with job.cond:
+            job.status = "error"
+            job.error = str(e)
+    with job.cond:
+        job.publish()
+        job.cond.notify_all()
+
+
+@app.route('/api/podcast/stream', methods=['POST'])
+def start_podcast_stream():
+    """Start a pipelined podcast: each script paragraph is synthesized as soon as it streams in"""
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            completion_kwargs, settings = build_podcast_request(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        prune_podcast_jobs()
+        job_id = f"podcast_{int(datetime.now().timestamp() * 1000)}_{os.urandom(3).hex()}"
+        job = PodcastJob(job_id, settings)
+        with podcast_jobs_lock:
+            podcast_jobs[job_id] = job
+            # Forget the oldest jobs (their audio stays on disk until PODCAST_JOB_TTL)
+            for old_id in list(podcast_jobs)[:-PODCAST_MAX_JOBS]:
+                podcast_jobs.pop(old_id, None)
+
+        threading.Thread(target=contextvars.copy_context().run,
+                         args=(run_podcast_pipeline, job, completion_kwargs), daemon=True).start()
+        return jsonify(job.to_dict()), 202
+    except Exception as e:
+        print(f"Podcast stream error: {str(e)}")
+        return jsonify({"error": f"Podcast stream failed: {str(e)}"}), 500
+
+
+@app.route('/api/podcast/stream/<job_id>', methods=['GET'])
+def podcast_stream_status(job_id):
+    """Script so far plus the audio segments that are ready"""
+    job = podcast_jobs.get(job_id)
+    if job:
+        return jsonify(job.to_dict())
+    # Started by another worker process: serve its on-disk snapshot
+    snapshot = load_podcast_snapshot(job_id)
+    if snapshot is None:
+        return jsonify({"error": "Unknown podcast job"}), 404
+    return jsonify(snapshot)
+
+
+@app.route('/api/podcast/stream/<job_id>/audio.mp3', methods=['GET'])
+def podcast_stream_audio(job_id):
+    """Progressive MP3: segments are written to the response in order as they finish"""
+    job = podcast_jobs.get(job_id)
+    if not job:
+        if load_podcast_snapshot(job_id) is None:
+            return jsonify({"error": "Unknown podcast job"}), 404
+        return Response(stream_with_context(stream_podcast_from_disk(job_id)), mimetype="audio/mpeg")
+
+    def generate():
+        index = 0
+        while True:
+            with job.cond:
+                while index >= len(job.segments) or not job.segments[index]["ready"]:
+                    if job.status != "running" and index >= len(job.segments):
+                        return
+                    job.cond.wait(timeout=1.0)
+                seg = job.segments[index]
+            index += 1
+            if seg["error"]:
+                continue
+            with open(os.path.join(job.dir, seg["file"]), "rb") as f:
+                yield f.read()
+
+    return Response(stream_with_context(generate()), mimetype="audio/mpeg")
 
-from elevenlabs import ElevenLabs
 
-# Initialize ElevenLabs client
-eleven_client = ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
 @app.route('/api/download-flashcards', methods=['POST'])
 def download_flashcards():
     """Generate and download flashcards as a beautifully formatted PDF"""
     try:
+        from reportlab.lib.pagesizes import letter
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib.units import inch
+        from reportlab.lib.enums import TA_CENTER
+        from reportlab.lib.colors import HexColor
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
         data = request.get_json(silent=True) or {}
         flashcards = data.get('flashcards', [])
         title = data.get('title', 'Study Flashcards')
@@ -725,9 +3862,6 @@ def download_flashcards():
             rightMargin=0.75*inch
         )
         
-        from reportlab.lib.colors import HexColor, black, whitesmoke
-        from reportlab.lib.enums import TA_CENTER, TA_LEFT
-        from reportlab.platypus import Table, TableStyle, PageBreak
         
         styles = getSampleStyleSheet()
         
@@ -785,7 +3919,6 @@ def download_flashcards():
         
         # Helper function
         def clean_text(text):
-            from xml.sax.saxutils import escape as xml_escape
             text = xml_escape(str(text))
             text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", text)
             text = re.sub(r"`([^`]+)`", r"<font face='Courier'>\1</font>", text)
@@ -800,7 +3933,6 @@ def download_flashcards():
         story.append(Spacer(1, 0.5*inch))
         
         # Group by category for better organization
-        from collections import defaultdict
         cards_by_category = defaultdict(list)
         for card in flashcards:
             category = card.get('category', 'General')
@@ -861,7 +3993,8 @@ def download_flashcards():
                 story.append(Spacer(1, 0.3*inch))
         
         # Build PDF
-        doc.build(story)
+        with span("pdf.render", flowables=len(story)):
+            doc.build(story)
         buffer.seek(0)
         
         # Generate filename
@@ -877,15 +4010,13 @@ def download_flashcards():
         
     except Exception as e:
         print(f"Flashcard PDF generation error: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({"error": f"Flashcard PDF generation failed: {str(e)}"}), 500
 
 @app.route('/api/text-to-speech', methods=['POST'])
 def text_to_speech():
     """Convert podcast script to audio - FAST version"""
-    import time
-    start_time = time.time()
+    start_time = _time.time()
     
     try:
         data = request.get_json(silent=True) or {}
@@ -894,6 +4025,10 @@ def text_to_speech():
         
         if not script:
             return jsonify({"error": "No script provided"}), 400
+        try:
+            engine, voice = resolve_voice(voice_id)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         print(f"\n{'='*50}")
         print(f"🎙️ TTS REQUEST RECEIVED")
@@ -904,22 +4039,50 @@ def text_to_speech():
         # Ensure directory exists
         os.makedirs("static/audio", exist_ok=True)
         
-        # Generate filename immediately
-        filename = f"podcast_gtts_{int(datetime.now().timestamp())}.mp3"
-        filepath = os.path.join("static/audio", filename)
-        
-        # Use gTTS directly (it's faster and more reliable than ElevenLabs for testing)
-        print("🔊 Generating audio with gTTS...")
+        # Conversational scripts (HOST A:/HOST B:) get one voice per speaker
+        if any(_SPEAKER_RE.match(line) for line in script.splitlines()):
+            turns = parse_dialogue_turns(script)
+            gap = float(data.get('gapSeconds', PODCAST_TURN_GAP))
+            print(f"🎭 Rendering dialogue: {len(turns)} turns, speakers: {sorted({t[0] for t in turns})}")
+            try:
+                audio = render_dialogue(turns, lang=data.get('language', 'en'), gap_seconds=gap)
+                filename = f"podcast_dialogue_{int(datetime.now().timestamp())}.{audio_extension(audio)}"
+                with open(os.path.join("static/audio", filename), "wb") as f:
+                    f.write(audio)
+                generation_time = _time.time() - start_time
+                print(f"✅ Dialogue audio generated in {generation_time:.2f} seconds")
+                return jsonify({
+                    "message": "Audio generated successfully",
+                    "audioUrl": f"/static/audio/{filename}",
+                    "filename": filename,
+                    "generationTime": round(generation_time, 2),
+                    "duration": round(audio_duration(audio), 2),
+                    "turns": len(turns),
+                    "voices": {speaker: voice_for_speaker(speaker) for speaker in sorted({t[0] for t in turns})},
+                    "voiceId": "dialogue",
+                    "model": "dialogue"
+                })
+            except Exception as dialogue_error:
+                print(f"⚠️ Dialogue rendering failed, using single voice: {dialogue_error}")
+
+        # Single voice: gTTS by default (faster for long scripts); voiceId may name another engine
+        if engine == "elevenlabs" and PODCAST_TTS_ENGINE != "elevenlabs" and ':' not in str(voice_id):
+            engine, voice = PODCAST_TTS_ENGINE, None
+        print(f"🔊 Generating audio with {engine}...")
         
         try:
-            # Generate the audio file
-            tts = gTTS(text=script, lang='en', slow=False)
-            tts.save(filepath)
+            audio, served_by = tts_synthesize(script, engine=engine, voice=voice, lang=data.get('language', 'en'))
+
+            # Generate filename
+            filename = f"podcast_{served_by}_{int(datetime.now().timestamp())}.{audio_extension(audio)}"
+            filepath = os.path.join("static/audio", filename)
+            with open(filepath, "wb") as f:
+                f.write(audio)
             
-            generation_time = time.time() - start_time
+            generation_time = _time.time() - start_time
             print(f"✅ Audio generated in {generation_time:.2f} seconds")
             print(f"📁 File saved: {filepath}")
-            print(f"📊 File size: {os.path.getsize(filepath) / 1024:.1f} KB")
+            print(f"📊 File size: {len(audio) / 1024:.1f} KB")
             
             audio_url = f"/static/audio/{filename}"
             
@@ -931,21 +4094,19 @@ def text_to_speech():
                 "audioUrl": audio_url,
                 "filename": filename,
                 "generationTime": round(generation_time, 2),
-                "voiceId": "gtts",
-                "model": "gtts"
+                "voiceId": voice_id if served_by == "elevenlabs" else served_by,
+                "model": served_by
             })
             
-        except Exception as gtts_error:
-            print(f"❌ gTTS Error: {str(gtts_error)}")
-            import traceback
+        except Exception as tts_error:
+            print(f"❌ TTS Error: {str(tts_error)}")
             traceback.print_exc()
             return jsonify({
-                "error": f"Audio generation failed: {str(gtts_error)}"
+                "error": f"Audio generation failed: {str(tts_error)}"
             }), 500
 
     except Exception as e:
         print(f"❌ TTS Error: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({"error": f"TTS failed: {str(e)}"}), 500
 
@@ -961,15 +4122,19 @@ def save_podcast():
             'title': data.get('title', 'Untitled Podcast'),
             'script': data.get('script', ''),
             'settings': data.get('settings', {}),
+            'audioUrl': data.get('audioUrl'),
             'timestamp': datetime.now().isoformat()
         }
-        
-        # In production, save to database
-        # For now, just return success
+        if not podcast_data['script']:
+            return jsonify({"error": "Podcast script is required"}), 400
+
+        podcast_id = artifact_store.save(current_user_id(), "podcast", podcast_data,
+                                         doc_id=data.get('docId'), title=podcast_data['title'],
+                                         artifact_id=data.get('podcastId'))
         return jsonify({
             "success": True,
             "message": "Podcast saved successfully",
-            "podcastId": f"podcast_{int(datetime.now().timestamp())}"
+            "podcastId": podcast_id
         })
         
     except Exception as e:
@@ -978,6 +4143,12 @@ def save_podcast():
 def download_cheatsheet():
     """Generate and download a cheat sheet PDF with improved formatting"""
     try:
+        from reportlab.lib.pagesizes import letter
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib.units import inch
+        from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_JUSTIFY
+        from reportlab.lib.colors import black
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
         data = request.get_json(silent=True) or {}
         title = data.get('title', 'Study Cheat Sheet')
         content = data.get('content', '')
@@ -992,8 +4163,6 @@ def download_cheatsheet():
                               leftMargin=0.75*inch, rightMargin=0.75*inch)
         
         # Import required classes
-        from reportlab.lib.colors import black, darkblue, darkgreen
-        from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY, TA_LEFT
         
         styles = getSampleStyleSheet()
         
@@ -1074,8 +4243,8 @@ def download_cheatsheet():
                     elif line.startswith('- ') or line.startswith('• '):
                         bullet_text = line[2:].strip()
                         # Clean up markdown formatting
-                        bullet_text = bullet_text.replace('**', '<b>').replace('**', '</b>')
-                        bullet_text = bullet_text.replace('*', '<i>').replace('*', '</i>')
+                        bullet_text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", bullet_text)
+                        bullet_text = re.sub(r"\*(.*?)\*", r"<i>\1</i>", bullet_text)
                         story.append(Paragraph(f'• {bullet_text}', list_style))
                     
                     # Handle numbered lists
@@ -1085,15 +4254,16 @@ def download_cheatsheet():
                     # Handle regular paragraphs
                     else:
                         # Clean up markdown formatting
-                        line = line.replace('**', '<b>').replace('**', '</b>')
-                        line = line.replace('*', '<i>').replace('*', '</i>')
+                        line = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", line)
+                        line = re.sub(r"\*(.*?)\*", r"<i>\1</i>", line)
                         story.append(Paragraph(line, body_style))
                 
                 story.append(Spacer(1, 0.15*inch))
         
         # Build PDF with proper error handling
         try:
-            doc.build(story)
+            with span("pdf.render", flowables=len(story)):
+                doc.build(story)
         except Exception as build_error:
             print(f"PDF build error: {str(build_error)}")
             return jsonify({"error": f"PDF generation failed: {str(build_error)}"}), 500
@@ -1109,7 +4279,6 @@ def download_cheatsheet():
         
     except Exception as e:
         print(f"Cheat sheet generation error: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({"error": f"Cheat sheet generation failed: {str(e)}"}), 500
 # Add these routes to your app.py file
@@ -1134,13 +4303,20 @@ def generate_flashcards():
         
         if not summary_text and not source_text:
             return jsonify({"error": "No document content provided"}), 400
-        
-        # Build context
+        try:
+            compression_ratio = parse_compression_ratio(data.get('compressionRatio'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Build context (long sources are cut down to the passages that match the summary's topics,
+        # then sentences the summary already covers are dropped)
+        selected = select_source_text(source_text, summary_text, FLASHCARD_SOURCE_CHARS) if source_text else ""
+        summary_part, selected, compression = compressed_context(summary_text, selected, compression_ratio)
         context = ""
-        if summary_text:
-            context += f"DOCUMENT SUMMARY:\n{summary_text}\n\n"
-        if source_text:
-            context += f"FULL DOCUMENT TEXT:\n{source_text}\n\n"
+        if summary_part:
+            context += f"DOCUMENT SUMMARY:\n{summary_part}\n\n"
+        if selected:
+            context += f"FULL DOCUMENT TEXT:\n{selected}\n\n"
         
         # Difficulty settings
         difficulty_settings = {
@@ -1162,6 +4338,8 @@ def generate_flashcards():
         }
         
         settings = difficulty_settings.get(difficulty, difficulty_settings['medium'])
+        doc_id = data.get('docId') or document_id(source_text or summary_text)
+        artifact = artifact_spec("flashcards", doc_id, data.get('title') or "Flashcards", variant=f"{difficulty}:{count}")
         
         # AI prompt for flashcard generation
         system_prompt = (
@@ -1211,9 +4389,9 @@ RULES:
 
 Output the complete JSON now:"""
 
-        # Call Together AI
-        response = client.chat.completions.create(
+        completion_kwargs = dict(
             model="openai/gpt-oss-20b",
+            route=True,
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
@@ -1221,21 +4399,26 @@ Output the complete JSON now:"""
             max_tokens=3500,
             temperature=0.6
         )
-        print(response.choices[0].message.content)
 
+        # Stream cards to the client as each one finishes parsing
+        if data.get('stream'):
+            return stream_json_completion("flashcards", artifact=artifact, **completion_kwargs)
 
-        
-        flashcards_json_str = response.choices[0].message.content.strip()
-        
-        # Clean up response - remove markdown code blocks if present
-        flashcards_json_str = re.sub(r'^```json\s*', '', flashcards_json_str)
-        flashcards_json_str = re.sub(r'^```\s*', '', flashcards_json_str)
-        flashcards_json_str = re.sub(r'\s*```$', '', flashcards_json_str)
+        # Call Together AI (continued if the cards run past max_tokens)
+        flashcards_json_str, _ = complete_text(**completion_kwargs)
         flashcards_json_str = flashcards_json_str.strip()
         
-        # Parse JSON
-        flashcard_data = json.loads(flashcards_json_str)
+        # Parse JSON (strips code fences, repairs truncated output)
+        flashcard_data = parse_llm_json(flashcards_json_str, "flashcards")
+        if not flashcard_data:
+            return jsonify({
+                "error": "Failed to parse AI response as JSON",
+                "raw_response": flashcards_json_str[:500]
+            }), 500
         
+        flashcard_data["docId"] = doc_id
+        flashcard_data["artifactId"] = save_artifact(artifact, flashcard_data)
+        flashcard_data["stats"] = {"routing": routing_stats(), "compression": compression}
         return jsonify(flashcard_data)
         
     except json.JSONDecodeError as e:
@@ -1261,20 +4444,23 @@ def process_pdf():
     if file is None or file.filename == '':
         return jsonify({"error": "Empty file upload."}), 400
 
-    # Extract text from PDF
-    doc = fitz.open(stream=file.read(), filetype="pdf")
-    text = ""
-    for page in doc:
-        text += page.get_text()
+    # Extract text from PDF (scanned pages fall back to OCR)
+    text, extraction_stats = extract_pdf_text(file.read())
 
     # Guard clause: handle empty PDFs
     if not text.strip():
+        if extraction_stats["ocrPages"] and not extraction_stats["ocrAvailable"]:
+            return jsonify({
+                "error": "No text found in the uploaded PDF.",
+                "hint": "This looks like a scanned PDF. Install Tesseract and pytesseract to enable OCR."
+            }), 400
         return jsonify({"error": "No text found in the uploaded PDF."}), 400
 
     # ✅ Get AI summary from Together model with longer, well-spaced Markdown
     try:
-        response = client.chat.completions.create(
+        response = llm.create(
             model="openai/gpt-oss-120b",
+            route=True,
             messages=[
                 {"role": "system", "content": (
                     "You are an expert document analyst who creates well-structured, comprehensive summaries. "
@@ -1306,25 +4492,41 @@ def process_pdf():
         return jsonify({"error": f"AI processing failed: {str(e)}"}), 500
 
     # Shape response for frontend expectations
-    return jsonify({
+    payload = {
         "result": summary or "",
         "source_text": text or "",
-        "doc_title": file.filename or "Document"
-    })
-
-
-@app.route('/api/smart_summary', methods=['POST'])
-def smart_summary():
-    data = request.get_json(silent=True) or {}
-    text = (data.get('text') or '').strip()
-    level = int(data.get('level') or 1)
-    title = (data.get('title') or 'Document').strip()
-
-    if not text:
-        return jsonify({"error": "Missing 'text'"}), 400
-
-    level = max(1, min(level, 3))
-
+        "doc_title": file.filename or "Document",
+        "extraction": extraction_stats,
+        "docId": document_id(text),
+    }
+    if summary:
+        # The saved copy keeps the docId, not the whole document text
+        saved = {k: v for k, v in payload.items() if k != "source_text"}
+        payload["artifactId"] = save_artifact(
+            artifact_spec("summary", payload["docId"], payload["doc_title"], variant="overview"), saved)
+    payload["stats"] = {"routing": routing_stats()}
+    return jsonify(payload)
+
+
+# ---------------------------------------------------------------------------
+# Summary pyramid: per-section notes merged into Levels 1-4, cached per document
+# ---------------------------------------------------------------------------
+SUMMARY_MODEL = "openai/gpt-oss-20b"
+SUMMARY_LEVELS = (1, 2, 3, 4)
+SUMMARY_SECTION_CHARS = int(os.getenv("SUMMARY_SECTION_CHARS", 12000))
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", 4))
+SUMMARY_PREBUILD = os.getenv("SUMMARY_PREBUILD", "1") != "0"
+SUMMARY_CACHE_DIR = os.getenv("SUMMARY_CACHE_DIR", os.path.join(DATA_DIR, "summary_cache"))
+SUMMARY_MEMORY_ENTRIES = 256
+
+_summary_pool = None
+_summary_lock = threading.Lock()
+_summary_inflight = {}  # cache key -> Future of the build in progress
+_summary_memory_cache = {}
+
+
+def summary_level_spec(level):
+    """Label, instructions and token budget for a smart summary level (1 = essentials, 4 = deep dive)."""
     # Scale factors based on level: 1x, 2x, 5x, 8x (deep understanding)
     scale_map = {1: 1, 2: 2, 3: 5, 4: 8}
     detail_scale = scale_map.get(level, 1)
@@ -1394,12 +4596,160 @@ def smart_summary():
             "max_tokens": min(4200, 1800 + topics_max * 45 + qa_max * 90)
         }
     }
+    return level_specs[level]
+
+
+def split_sections(text, max_chars=None):
+    """Split a document into sections of at most `max_chars`, breaking at paragraph boundaries."""
+    max_chars = max_chars or SUMMARY_SECTION_CHARS
+    text = text.strip()
+    if len(text) <= max_chars:
+        return [text]
+    sections, current = [], ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        # Paragraphs longer than a whole section are cut at the last space before the limit
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind(" ", 0, max_chars)
+            cut = cut if cut > max_chars // 2 else max_chars
+            if current:
+                sections.append(current)
+                current = ""
+            sections.append(paragraph[:cut])
+            paragraph = paragraph[cut:].lstrip()
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            sections.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current.strip():
+        sections.append(current)
+    return sections
+
+
+def _summary_cache_get(key):
+    if key in _summary_memory_cache:
+        return _summary_memory_cache[key]
+    path = os.path.join(SUMMARY_CACHE_DIR, f"{key}.md")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        _summary_remember(key, text)
+        return text
+    return None
+
+
+def _summary_remember(key, text):
+    _summary_memory_cache[key] = text
+    while len(_summary_memory_cache) > SUMMARY_MEMORY_ENTRIES:
+        _summary_memory_cache.pop(next(iter(_summary_memory_cache)), None)
+
+
+def _summary_cache_put(key, text):
+    _summary_remember(key, text)
+    try:
+        os.makedirs(SUMMARY_CACHE_DIR, exist_ok=True)
+        tmp = os.path.join(SUMMARY_CACHE_DIR, f"{key}.md.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, os.path.join(SUMMARY_CACHE_DIR, f"{key}.md"))
+    except OSError as e:
+        print(f"⚠️ Could not write summary cache: {e}")
+
+
+def _summary_once(key, build):
+    """Cached text for `key`; on a miss, run `build()` once even if several requests ask at the same time."""
+    cached = _summary_cache_get(key)
+    if cached is not None:
+        CACHE_LOOKUPS.inc(current_endpoint(), "summary", "hit")
+        return cached
+    with _summary_lock:
+        future = _summary_inflight.get(key)
+        owner = future is None or future.done()
+        if owner:
+            future = _summary_inflight[key] = Future()
+    if not owner:
+        try:
+            return wait_for_future(future)
+        except JobCancelled as e:
+            if e.job is active_job():
+                raise
+        # The owner's request was cancelled, not ours: build it ourselves
+        return _summary_once(key, build)
+
+    CACHE_LOOKUPS.inc(current_endpoint(), "summary", "miss")
+    try:
+        text = build()
+        _summary_cache_put(key, text)
+        future.set_result(text)
+        return text
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _summary_lock:
+            if _summary_inflight.get(key) is future:
+                del _summary_inflight[key]
+
+
+@traced("summary.section")
+def summarize_section(section, index, total, title):
+    """Leaf of the pyramid: dense study notes for one section, detailed enough to write Level 4 from."""
+    response = llm.create(
+        model=SUMMARY_MODEL,
+        route=True,
+        messages=[
+            {"role": "system", "content": (
+                "You are an expert study note writer. Output concise, information-dense Markdown."
+            )},
+            {"role": "user", "content": (
+                f"Write study notes for section {index + 1} of {total} of: {title}.\n\n"
+                "Cover every key topic with its definition, important details, examples and process steps, "
+                "3-6 likely exam questions with short answers, and the facts most worth memorizing. "
+                "Use bullets and sub-bullets; no introduction or conclusion.\n\n"
+                f"Section text:\n\n{section}"
+            )}
+        ],
+        max_tokens=1200,
+        temperature=0.3
+    )
+    return response.choices[0].message.content or ""
 
-    spec = level_specs[level]
 
-    try:
-        response = client.chat.completions.create(
-            model="openai/gpt-oss-20b",
+def summary_leaves(text, title):
+    """Section notes for a document (cached per section). Short documents are their own single leaf."""
+    sections = split_sections(text)
+    if len(sections) == 1:
+        return sections, False
+
+    def leaf(i):
+        key = "section-" + hashlib.sha256(sections[i].encode("utf-8")).hexdigest()[:24]
+        return _summary_once(key, lambda: summarize_section(sections[i], i, len(sections), title))
+
+    workers = max(1, min(SUMMARY_CONCURRENCY, len(sections)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda i: contextvars.copy_context().run(leaf, i), range(len(sections)))), True
+
+
+def _get_summary_pool():
+    """Background pool that prebuilds the other levels after a request asks for one."""
+    global _summary_pool
+    with _summary_lock:
+        if _summary_pool is None:
+            _summary_pool = ThreadPoolExecutor(max_workers=max(1, SUMMARY_CONCURRENCY))
+        return _summary_pool
+
+
+def _build_summary_level(doc_id, level, leaves, condensed, title):
+    spec = summary_level_spec(level)
+    if condensed:
+        body = "\n\n".join(f"### Section {i + 1}\n{notes}" for i, notes in enumerate(leaves))
+        source = "Section-by-section notes (already condensed from the full document; merge them in order)"
+    else:
+        body = leaves[0]
+        source = "Source text (quote and condense as needed)"
+    with span("summary.level", level=level, sections=len(leaves)):
+        response = llm.create(
+            model=SUMMARY_MODEL,
+            route=True,
             messages=[
                 {"role": "system", "content": (
                     "You are an expert study guide writer. Output valid Markdown with good spacing."
@@ -1407,20 +4757,71 @@ def smart_summary():
                 {"role": "user", "content": (
                     f"Create a {spec['label']} for: {title}.\n\n"
                     f"Instructions:\n{spec['instructions']}\n\n"
-                    f"Source text (quote and condense as needed):\n\n{text}"
+                    f"{source}:\n\n{body}"
                 )}
             ],
             max_tokens=spec["max_tokens"],
             temperature=0.3
         )
+    return response.choices[0].message.content or ""
+
+
+def summary_level(text, title, level, prebuild=SUMMARY_PREBUILD):
+    """Level `level` of the document's summary pyramid, plus whether it came from cache.
+
+    On a miss the section notes are built (or reused) first; with `prebuild` the remaining levels
+    are then generated in the background from the same notes, so later level switches are cache hits.
+    """
+    doc_id = document_id(text)
+    key = f"{doc_id}-L{level}"
+    cached = _summary_cache_get(key)
+    if cached is not None:
+        CACHE_LOOKUPS.inc(current_endpoint(), "summary", "hit")
+        return cached, True
+
+    leaves, condensed = summary_leaves(text, title)
+    if prebuild:
+        pool = _get_summary_pool()
+        for other in SUMMARY_LEVELS:
+            other_key = f"{doc_id}-L{other}"
+            if other != level and other_key not in _summary_inflight and _summary_cache_get(other_key) is None:
+                submit_in_context(pool, _prebuild_summary_level, doc_id, other, leaves, condensed, title)
+    return _summary_once(key, lambda: _build_summary_level(doc_id, level, leaves, condensed, title)), False
+
+
+def _prebuild_summary_level(doc_id, level, leaves, condensed, title):
+    try:
+        _summary_once(f"{doc_id}-L{level}", lambda: _build_summary_level(doc_id, level, leaves, condensed, title))
+    except Exception as e:
+        print(f"⚠️ Prebuilding summary level {level} failed: {e}")
+
+
+@app.route('/api/smart_summary', methods=['POST'])
+def smart_summary():
+    data = request.get_json(silent=True) or {}
+    text = (data.get('text') or '').strip()
+    level = int(data.get('level') or 1)
+    title = (data.get('title') or 'Document').strip()
+
+    if not text:
+        return jsonify({"error": "Missing 'text'"}), 400
 
-        result = response.choices[0].message.content
-        return jsonify({"result": result or ""})
+    level = max(1, min(level, 4))
+    spec = summary_level_spec(level)
+
+    try:
+        result, cached = summary_level(text, title, level)
+        doc_id = data.get('docId') or document_id(text)
+        artifact = artifact_spec("summary", doc_id, f"{title} ({spec['label']})", variant=f"level{level}")
+        if cached and artifact_store.exists(artifact["user_id"], artifact["artifact_id"]):
+            artifact_id = artifact["artifact_id"]  # already saved; a cache hit changes nothing
+        else:
+            artifact_id = save_artifact(artifact, result)
+        return jsonify({"result": result or "", "level": level, "cached": cached, "docId": doc_id, "artifactId": artifact_id,
+                        "stats": {"routing": routing_stats()}})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-import re
-from flask import request, jsonify
 
 def clean_response(text):
     """Remove markdown formatting and clean up response text"""
@@ -1444,8 +4845,6 @@ def clean_response(text):
     return text.strip()
 
 
-import re
-from flask import request, jsonify
 
 def clean_response(text):
     """Remove markdown formatting and clean up response text"""
@@ -1469,17 +4868,699 @@ def clean_response(text):
     return text.strip()
 
 
+# ---------------------------------------------------------------------------
+# Embedding index: hashed chunk vectors, memory-mapped per document, top-k by matmul
+# ---------------------------------------------------------------------------
+EMBED_DIM = int(os.getenv("EMBED_DIM", 384))
+EMBED_CHUNK_CHARS = int(os.getenv("EMBED_CHUNK_CHARS", 800))
+EMBED_TOP_K = int(os.getenv("EMBED_TOP_K", 8))
+EMBED_DIR = os.getenv("EMBED_DIR", os.path.join(DATA_DIR, "embeddings"))
+EMBED_MAX_OPEN = 32
+FLASHCARD_SOURCE_CHARS = int(os.getenv("FLASHCARD_SOURCE_CHARS", 24000))
+
+_EMBED_STOPWORDS = frozenset(
+    "the a an and or of to in on for is are was were be been by with as at from that this it its which "
+    "these those their there than then into also can may will not".split()
+)
+_embedding_indexes = {}
+_embedding_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=200_000)
+def _feature_slot(feature, dim):
+    """Stable (index, sign) for a hashed feature; crc32 because hash() differs between processes."""
+    h = zlib.crc32(feature.encode("utf-8"))
+    return h % dim, (1.0 if h & 0x80000000 else -1.0)
+
+
+_STEM_SUFFIXES = ("ations", "ation", "ings", "ing", "ions", "ion", "ies", "es", "ed", "ly", "s")
+
+
+@functools.lru_cache(maxsize=100_000)
+def _stem(word):
+    """Crude suffix stripping so "translation"/"translating" and "ribosome"/"ribosomes" share features."""
+    for suffix in _STEM_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            word = word[:-len(suffix)]
+            break
+    return word[:-1] if word.endswith("e") and len(word) > 4 else word
+
+
+def embed_texts(texts, dim=None):
+    """(len(texts), dim) float32 matrix of L2-normalized hashed word uni/bigram vectors (log TF)."""
+    dim = dim or EMBED_DIM
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = [_stem(w) for w in re.findall(r"[a-z0-9]+", text.lower()) if w not in _EMBED_STOPWORDS]
+        counts = {}
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            counts[feature] = counts.get(feature, 0) + 1
+        vector = matrix[row]
+        for feature, count in counts.items():
+            slot, sign = _feature_slot(feature, dim)
+            vector[slot] += sign * (1.0 + math.log(count))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+@contextmanager
+def _file_lock(path):
+    """Exclusive lock shared by all worker processes (no-op where fcntl is unavailable)."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class EmbeddingIndex:
+    """Chunk vectors for one document: rows appended to vectors.f32 and memory-mapped for search.
+
+    Chunks are keyed by content hash, so indexing the same text again (or concurrently) embeds nothing twice.
+    """
+
+    def __init__(self, directory, dim=None):
+        self.dir = directory
+        self.dim = dim or EMBED_DIM
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._chunks_path = os.path.join(directory, "chunks.jsonl")
+        self._lock = threading.Lock()
+        self.chunks = []
+        self.hashes = {}
+        self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+        self._load()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def _load(self):
+        """(Re)open the on-disk index, trimming a half-written append left by a crashed worker."""
+        if not os.path.exists(self._chunks_path):
+            return
+        with open(self._chunks_path, "r", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        count = min(len(rows), size // row_bytes)
+        if size != count * row_bytes:
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(count * row_bytes)
+        if len(rows) != count:
+            with open(self._chunks_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(row) + "\n" for row in rows[:count])
+        self.chunks = [row["text"] for row in rows[:count]]
+        self.hashes = {row["h"]: i for i, row in enumerate(rows[:count])}
+        if count:
+            self.vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(count, self.dim))
+
+    def add(self, chunks):
+        """Embed and append the chunks not indexed yet; returns how many were new."""
+        keyed = {hashlib.sha1(c.encode("utf-8")).hexdigest(): c for c in chunks if c.strip()}
+        if all(h in self.hashes for h in keyed):
+            return 0
+        with self._lock:
+            os.makedirs(self.dir, exist_ok=True)
+            with _file_lock(os.path.join(self.dir, ".lock")):
+                self._load()  # another worker may have appended meanwhile
+                new = [(h, c) for h, c in keyed.items() if h not in self.hashes]
+                if not new:
+                    return 0
+                with span("embed.chunks", chunks=len(new)):
+                    vectors = embed_texts([c for _, c in new], self.dim)
+                with open(self._vectors_path, "ab") as f:
+                    f.write(vectors.tobytes())
+                with open(self._chunks_path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps({"h": h, "text": c}) + "\n" for h, c in new)
+                self._load()
+        return len(new)
+
+    def search(self, queries, k=None):
+        """Top-k (chunk index, score) per query, from one (queries x chunks) matrix product."""
+        k = min(k or EMBED_TOP_K, len(self.chunks))
+        if not k or not queries:
+            return [[] for _ in queries]
+        with span("embed.search", queries=len(queries), chunks=len(self.chunks)):
+            scores = embed_texts(queries, self.dim) @ self.vectors.T
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            results = []
+            for row, candidates in zip(scores, top):
+                ranked = candidates[np.argsort(-row[candidates])]
+                results.append([(int(i), float(row[i])) for i in ranked])
+        return results
+
+
+def embedding_index(doc_key):
+    """The (cached) index for a document key; keys that are not safe directory names are hashed."""
+    if not re.fullmatch(r"[\w-]{1,64}", doc_key or ""):
+        doc_key = document_id(doc_key or "")
+    with _embedding_lock:
+        index = _embedding_indexes.pop(doc_key, None)
+        if index is None:
+            index = EmbeddingIndex(os.path.join(EMBED_DIR, doc_key))
+        _embedding_indexes[doc_key] = index
+        while len(_embedding_indexes) > EMBED_MAX_OPEN:
+            _embedding_indexes.pop(next(iter(_embedding_indexes)))
+    return index
+
+
+def index_document(text):
+    """Chunk a document and embed whatever is not indexed yet; returns (doc_key, index).
+
+    The key is the hash of the text, so a revised document gets its own index with no stale chunks,
+    and a client-chosen id can never point at someone else's document.
+    """
+    doc_key = document_id(text)
+    index = embedding_index(doc_key)
+    with span("embed.index"):
+        index.add(split_sections(text, EMBED_CHUNK_CHARS))
+    return doc_key, index
+
+
+def relevant_chunks(index, queries, budget_chars, k=None):
+    """Chunks that best match any of `queries`, taken rank by rank across queries, in document order."""
+    chosen, used = set(), 0
+    for rank_hits in itertools.zip_longest(*index.search(queries, k)):
+        for hit in rank_hits:
+            if hit is None or hit[0] in chosen:
+                continue
+            size = len(index.chunks[hit[0]]) + 2
+            if used + size <= budget_chars:
+                chosen.add(hit[0])
+                used += size
+    return [index.chunks[i] for i in sorted(chosen)]
+
+
+def summary_topics(summary_text, limit=64):
+    """Headings and bullets of a Markdown summary, stripped of markup, to use as retrieval queries."""
+    topics = []
+    for line in (summary_text or "").splitlines():
+        line = re.sub(r"^[\s#>*+\-\d.)]+", "", line).replace("**", "").strip()
+        if len(line.split()) >= 2:
+            topics.append(line[:300])
+    return topics[:limit]
+
+
+def select_source_text(source_text, summary_text, budget_chars):
+    """Fit a long source into `budget_chars` by keeping the passages closest to the summary's topics.
+
+    Sources that already fit are returned unchanged; without a summary, chunks are spread evenly.
+    """
+    if len(source_text) <= budget_chars:
+        return source_text
+    _, index = index_document(source_text)
+    topics = summary_topics(summary_text)
+    if topics:
+        chunks = relevant_chunks(index, topics, budget_chars)
+    else:
+        step = max(1, round(len(index.chunks) * EMBED_CHUNK_CHARS / max(budget_chars, 1)))
+        chunks = index.chunks[::step]
+        while chunks and sum(len(c) + 2 for c in chunks) > budget_chars:
+            chunks.pop()
+    return "\n\n".join(chunks)
+
+
+# ---------------------------------------------------------------------------
+# Prompt compression: repeated sentences dropped, then the least informative ones
+# ---------------------------------------------------------------------------
+PROMPT_COMPRESSION = os.getenv("PROMPT_COMPRESSION", "1") != "0"
+PROMPT_COMPRESSION_RATIO = float(os.getenv("PROMPT_COMPRESSION_RATIO", 1.0))  # share of context tokens kept; 1 = repeats only
+PROMPT_SHINGLE_WORDS = 3
+PROMPT_DUPLICATE_OVERLAP = 0.6  # share of a sentence's shingles seen earlier that makes it a repeat
+
+# Function words and discourse filler carry no content: a sentence made of them scores near zero
+_PROMPT_STOPWORDS = _EMBED_STOPWORDS | frozenset(
+    "i we you he she they me us him her them my our your his what who whom when where why how all any both "
+    "each few more most other some such no nor only own same so too very just now here has have had having "
+    "do does did doing would should could might must shall being am if because until while about against "
+    "between through during before after above below up down out off over under again further once one "
+    "thing things lot really quite rather simply basically actually important note noting worth mentioned "
+    "said seen see discussed recall remember point words way course let well".split()
+)
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])")
+_LINE_UNIT_RE = re.compile(r"^(?:#{1,6}\s|[-*•>]\s|\d+[.)]\s|\*\*|[A-Z][^.!?]{0,60}:$)")
+
+
+def split_units(text):
+    """Paragraphs of (separator, unit) pairs. Units are sentences, except that headings and bullets stay whole."""
+    paragraphs = []
+    for para in re.split(r"\n\s*\n", text or ""):
+        units = []
+        for line in para.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if _LINE_UNIT_RE.match(line) or not units:
+                pieces, sep = [line] if _LINE_UNIT_RE.match(line) else _SENTENCE_SPLIT_RE.split(line), "\n"
+            else:
+                # Wrapped line: continues the previous sentence unless that one had ended
+                prev_sep, prev = units[-1]
+                if not _LINE_UNIT_RE.match(prev) and not prev.endswith((".", "!", "?", ":")):
+                    pieces = _SENTENCE_SPLIT_RE.split(f"{prev} {line}")
+                    units[-1] = (prev_sep, pieces[0])
+                    units.extend((" ", p) for p in pieces[1:])
+                    continue
+                pieces, sep = _SENTENCE_SPLIT_RE.split(line), "\n" if _LINE_UNIT_RE.match(prev) else " "
+            units.append((sep, pieces[0]))
+            units.extend((" ", p) for p in pieces[1:])
+        if units:
+            paragraphs.append(units)
+    return paragraphs
+
+
+def _unit_terms(unit):
+    return [_stem(w) for w in re.findall(r"[a-z0-9]+", unit.lower()) if w not in _PROMPT_STOPWORDS]
+
+
+def _shingles(terms):
+    n = PROMPT_SHINGLE_WORDS
+    if len(terms) < n:
+        return {hash(tuple(terms))} if terms else set()
+    return {hash(tuple(terms[i:i + n])) for i in range(len(terms) - n + 1)}
+
+
+@traced("prompt.compress")
+def compress_prompt(blocks, ratio=None):
+    """Shrink context blocks (most condensed first, e.g. [summary, source]) to about `ratio` of their tokens.
+
+    A sentence whose word shingles mostly appeared earlier is a repeat and is dropped, so a source
+    the summary restates loses the restated parts. If that is not enough, sentences of the later
+    blocks are dropped in order of TF-IDF density until the target is met; the first block only
+    loses repeats. Headings and bullets are never dropped. Returns (blocks, report).
+    """
+    ratio = PROMPT_COMPRESSION_RATIO if ratio is None else min(max(float(ratio), 0.1), 1.0)
+    units = []  # [block, paragraph, sep, text, terms, word count]
+    for b, text in enumerate(blocks):
+        for p, para in enumerate(split_units(text)):
+            units.extend([b, p, sep, unit, _unit_terms(unit), len(unit.split())] for sep, unit in para)
+
+    tokens = [estimate_tokens(u[3]) for u in units]
+    before = sum(estimate_tokens(text) for text in blocks)
+    keep = [True] * len(units)
+    seen, duplicates = set(), 0
+    for i, (_, _, _, unit, terms, _) in enumerate(units):
+        shingles = _shingles(terms)
+        if shingles and not _LINE_UNIT_RE.match(unit) and len(shingles & seen) >= PROMPT_DUPLICATE_OVERLAP * len(shingles):
+            keep[i] = False
+            duplicates += 1
+        seen |= shingles
+
+    target = ratio * sum(tokens)
+    kept_tokens = sum(t for t, k in zip(tokens, keep) if k)
+    dropped = 0
+    if kept_tokens > target:
+        df = {}
+        for u in units:
+            for term in set(u[4]):
+                df[term] = df.get(term, 0) + 1
+        idf = {term: math.log((len(units) + 1) / (count + 1)) + 1 for term, count in df.items()}
+
+        def density(u):
+            counts = {}
+            for term in u[4]:
+                counts[term] = counts.get(term, 0) + 1
+            score = sum((1 + math.log(c)) * idf[t] for t, c in counts.items()) / math.sqrt(u[5] + 1)
+            return score * (1.5 if re.search(r"\d|=", u[3]) else 1.0)
+
+        candidates = [i for i, u in enumerate(units) if keep[i] and u[0] > 0 and not _LINE_UNIT_RE.match(u[3])]
+        for i in sorted(candidates, key=lambda i: density(units[i])):
+            if kept_tokens <= target:
+                break
+            keep[i] = False
+            kept_tokens -= tokens[i]
+            dropped += 1
+
+    paragraphs = [defaultdict(list) for _ in blocks]
+    for (b, p, sep, unit, _, _), k in zip(units, keep):
+        if k:
+            paragraphs[b][p].append((sep, unit))
+    compressed = [
+        "\n\n".join("".join((sep if i else "") + unit for i, (sep, unit) in enumerate(para)) for para in paras.values())
+        for paras in paragraphs
+    ]
+    after = sum(estimate_tokens(text) for text in compressed)
+    report = {"tokensBefore": before, "tokensAfter": after, "ratio": round(after / before, 3) if before else 1.0,
+              "duplicatesRemoved": duplicates, "sentencesDropped": dropped}
+    return compressed, report
+
+
+def parse_compression_ratio(value):
+    """A request's compressionRatio: None when absent, else a number in [0.1, 1] (ValueError otherwise)."""
+    if value is None or value == "":
+        return None
+    try:
+        if isinstance(value, bool):
+            raise TypeError
+        ratio = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("compressionRatio must be a number between 0.1 and 1") from None
+    if not math.isfinite(ratio) or not 0.1 <= ratio <= 1.0:
+        raise ValueError("compressionRatio must be a number between 0.1 and 1")
+    return ratio
+
+
+def compressed_context(summary_text, source_text, ratio=None):
+    """(summary, source, report) after compress_prompt, with the savings logged and counted per endpoint.
+
+    The report (None when compression is off) goes into the response stats so callers can see what was cut.
+    """
+    if not PROMPT_COMPRESSION or not (summary_text or source_text):
+        return summary_text, source_text, None
+    (summary_text, source_text), report = compress_prompt([summary_text, source_text], ratio)
+    saved = report["tokensBefore"] - report["tokensAfter"]
+    PROMPT_TOKENS_SAVED.inc(current_endpoint(), amount=max(saved, 0))
+    print(f"🗜️ Compressed context {report['tokensBefore']} → {report['tokensAfter']} tokens "
+          f"({report['duplicatesRemoved']} repeats, {report['sentencesDropped']} low-information sentences)")
+    return summary_text, source_text, report
+
+
+# ---------------------------------------------------------------------------
+# Chat sessions: recent turns verbatim, older turns folded into a rolling summary
+# ---------------------------------------------------------------------------
+CHAT_MODEL = "openai/gpt-oss-20b"
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", 1200))
+CHAT_KEEP_TURNS = int(os.getenv("CHAT_KEEP_TURNS", 2))
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", 300))
+CHAT_CONTEXT_CHARS = 2000
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) for budgeting prompts without a tokenizer."""
+    return (len(text or "") + 3) // 4
+
+
+def _turn_tokens(turn):
+    return estimate_tokens(turn["q"]) + estimate_tokens(turn["a"])
+
+
+def new_chat_session(context, mode):
+    return {"context": context, "mode": mode, "summary": "", "turns": [], "turnCount": 0, "summarizedTurns": 0}
+
+
+def chat_history_fold(session):
+    """How many of the oldest turns to fold into the summary so the verbatim turns fit CHAT_HISTORY_TOKENS.
+
+    Folds down to half the budget so the extra LLM call happens every few turns, not on every turn.
+    At least CHAT_KEEP_TURNS recent turns always stay verbatim.
+    """
+    turns = session["turns"]
+    remaining = sum(_turn_tokens(t) for t in turns)
+    if remaining <= CHAT_HISTORY_TOKENS or len(turns) <= CHAT_KEEP_TURNS:
+        return 0
+    fold = 0
+    while len(turns) - fold > CHAT_KEEP_TURNS and remaining > CHAT_HISTORY_TOKENS // 2:
+        remaining -= _turn_tokens(turns[fold])
+        fold += 1
+    return fold
+
+
+def summarize_chat_turns(session, fold):
+    """The rolling summary rewritten to include the session's `fold` oldest turns."""
+    exchanges = "\n".join(f"Student: {t['q']}\nProfessor: {t['a']}" for t in session["turns"][:fold])
+    response = llm.create(
+        model=CHAT_MODEL,
+        route=True,
+        messages=[
+            {"role": "system", "content": (
+                "You maintain a running summary of a tutoring conversation. Plain text, no markdown."
+            )},
+            {"role": "user", "content": (
+                f"Current summary:\n{session['summary'] or '(none yet)'}\n\n"
+                f"New exchanges:\n{exchanges}\n\n"
+                f"Rewrite the summary to include the new exchanges in at most {CHAT_SUMMARY_TOKENS * 3 // 4} words. "
+                "Keep what the student asked about, the facts and definitions given, and anything they "
+                "struggled with or may refer back to."
+            )}
+        ],
+        max_tokens=CHAT_SUMMARY_TOKENS,
+        temperature=0.2
+    )
+    return (response.choices[0].message.content or "").strip()
+
+
+_chat_pool = None
+_chat_compressing = set()
+
+
+def _get_chat_pool():
+    """Background pool that compresses chat histories after the answer has been returned."""
+    global _chat_pool
+    with _lazy_lock:
+        if _chat_pool is None:
+            _chat_pool = ThreadPoolExecutor(max_workers=2)
+        return _chat_pool
+
+
+@traced("chat.compress")
+def compress_chat_session(user_id, session_id):
+    """Fold a saved session's oldest turns into its summary (runs in the background).
+
+    The summary is written only if no other compression folded turns meanwhile; turns added while
+    the LLM call ran are kept.
+    """
+    _current_job.set(None)  # the request has been answered; its cancellation must not stop this
+    try:
+        saved = artifact_store.get(user_id, session_id)
+        session = saved["data"] if saved is not None and saved["kind"] == "chat" else None
+        fold = chat_history_fold(session) if session is not None else 0
+        summary = summarize_chat_turns(session, fold) if fold else ""
+        if not summary:
+            return
+
+        def apply(current):
+            if current["summarizedTurns"] != session["summarizedTurns"]:
+                return None
+            current["summary"] = summary
+            current["turns"] = current["turns"][fold:]
+            current["summarizedTurns"] += fold
+            return current
+        artifact_store.update(user_id, session_id, "chat", apply)
+    except Exception as e:
+        print(f"⚠️ Chat history compression failed, keeping turns verbatim: {e}")
+    finally:
+        with _lazy_lock:
+            _chat_compressing.discard(session_id)
+
+
+def schedule_chat_compression(user_id, session_id, session):
+    """Compress the session's history in the background once it outgrows CHAT_HISTORY_TOKENS."""
+    if not chat_history_fold(session):
+        return
+    with _lazy_lock:
+        if session_id in _chat_compressing:
+            return
+        _chat_compressing.add(session_id)
+    submit_in_context(_get_chat_pool(), compress_chat_session, user_id, session_id)
+
+
+def record_chat_turn(current, session, turn):
+    """Apply a turn, and the context/mode this request set, to the session as currently stored."""
+    for key in ("context", "mode", "docKey"):
+        if key in session:
+            current[key] = session[key]
+        else:
+            current.pop(key, None)
+    current["turns"].append(turn)
+    current["turnCount"] += 1
+    return current
+
+
+def chat_history_messages(session):
+    """Newest verbatim turns that fit CHAT_HISTORY_TOKENS, as chat messages.
+
+    The rolling summary of older turns is not included here; chat() appends it
+    to the system prompt.
+    """
+    recent, used = [], 0
+    for turn in reversed(session["turns"]):
+        used += _turn_tokens(turn)
+        if used > CHAT_HISTORY_TOKENS and recent:
+            break
+        recent.insert(0, turn)
+    messages = []
+    for turn in recent:
+        messages.append({"role": "user", "content": turn["q"]})
+        messages.append({"role": "assistant", "content": turn["a"]})
+    return messages
+
+
+# ---------------------------------------------------------------------------
+# Semantic answer cache: near-duplicate questions about the same document share an answer
+# ---------------------------------------------------------------------------
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") != "0"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.88))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 7 * 24 * 3600))
+ANSWER_CACHE_MAX_PER_DOC = int(os.getenv("ANSWER_CACHE_MAX_PER_DOC", 500))
+ANSWER_CACHE_MAX_DOCS = int(os.getenv("ANSWER_CACHE_MAX_DOCS", 200))
+ANSWER_CACHE_DIM = 1024
+
+_QUESTION_FILLER = {
+    "please", "pls", "can", "could", "would", "you", "me", "tell", "explain", "describe", "i", "want",
+    "to", "know", "the", "a", "an", "of", "in", "on", "about", "is", "are", "was", "were", "do", "does", "did",
+    "briefly", "quickly", "exactly", "actually", "just", "again", "this", "document",
+}
+_QUESTION_SYNONYMS = {"what's": "what", "whats": "what", "define": "what", "definition": "what", "meaning": "what"}
+_QUESTION_WORDS = {"what", "why", "how", "when", "where", "who", "which"}
+
+
+def normalize_question(question):
+    """Lowercase, strip punctuation and filler words so rephrasings of a question compare equal.
+
+    "Explain entropy", "what's entropy?" and "What is entropy" all become "what entropy".
+    """
+    words = [_QUESTION_SYNONYMS.get(w, w) for w in re.findall(r"[a-z0-9]+(?:'[a-z]+)?", question.lower())]
+    kept = [w for w in words if w not in _QUESTION_FILLER] or words
+    if not _QUESTION_WORDS.intersection(kept):
+        kept = ["what"] + kept
+    return " ".join(kept)
+
+
+def question_vector(normalized):
+    """L2-normalized signed feature-hashing vector of word uni/bigrams and character trigrams."""
+    vector = np.zeros(ANSWER_CACHE_DIM, dtype=np.float32)
+    words = normalized.split()
+    padded = f" {normalized} "
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+    for feature in features:
+        slot, sign = _feature_slot(feature, ANSWER_CACHE_DIM)
+        vector[slot] += sign
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
+
+
+class AnswerCache:
+    """Per-document store of (question vector, answer), searched with one matrix-vector product.
+
+    Documents are evicted least-recently-used beyond ANSWER_CACHE_MAX_DOCS, answers per document
+    beyond ANSWER_CACHE_MAX_PER_DOC (least recently hit first), and entries expire after ANSWER_CACHE_TTL.
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL,
+                 max_per_doc=ANSWER_CACHE_MAX_PER_DOC, max_docs=ANSWER_CACHE_MAX_DOCS):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_per_doc = max_per_doc
+        self.max_docs = max_docs
+        self._docs = {}  # doc key -> {"vectors": ndarray (n, dim), "questions" (normalized), "answers", "created", "used"}
+        self._lock = threading.Lock()
+
+    def _expire(self, entry, now):
+        keep = [i for i, created in enumerate(entry["created"]) if now - created < self.ttl]
+        if len(keep) < len(entry["created"]):
+            entry["vectors"] = entry["vectors"][keep]
+            for field in ("questions", "answers", "created", "used"):
+                entry[field] = [entry[field][i] for i in keep]
+
+    def lookup(self, doc_key, question):
+        """Return (answer, similarity) for the closest cached question above the threshold, else (None, best).
+
+        Numbers must match exactly: "World War 1" and "World War 2" hash to nearly the same vector.
+        """
+        normalized = normalize_question(question)
+        numbers = re.findall(r"\d+", normalized)
+        vector = question_vector(normalized)
+        now = _time.time()
+        with self._lock:
+            entry = self._docs.pop(doc_key, None)
+            if entry is None:
+                return None, 0.0
+            self._docs[doc_key] = entry  # most recently used document goes last
+            self._expire(entry, now)
+            if not entry["answers"]:
+                return None, 0.0
+            scores = entry["vectors"] @ vector
+            best_similarity = float(scores.max())
+            for best in np.argsort(-scores):
+                similarity = float(scores[best])
+                if similarity < self.threshold:
+                    break
+                if re.findall(r"\d+", entry["questions"][best]) == numbers:
+                    entry["used"][best] = now
+                    return entry["answers"][best], similarity
+            return None, best_similarity
+
+    def store(self, doc_key, question, answer):
+        normalized = normalize_question(question)
+        vector = question_vector(normalized)
+        now = _time.time()
+        with self._lock:
+            entry = self._docs.pop(doc_key, None) or {
+                "vectors": np.zeros((0, ANSWER_CACHE_DIM), dtype=np.float32),
+                "questions": [], "answers": [], "created": [], "used": [],
+            }
+            self._docs[doc_key] = entry
+            if len(entry["answers"]) >= self.max_per_doc:
+                self._expire(entry, now)
+            if len(entry["answers"]) >= self.max_per_doc:
+                drop = int(np.argmin(entry["used"]))
+                entry["vectors"] = np.delete(entry["vectors"], drop, axis=0)
+                for field in ("questions", "answers", "created", "used"):
+                    del entry[field][drop]
+            entry["vectors"] = np.vstack([entry["vectors"], vector[None, :]])
+            entry["questions"].append(normalized)
+            entry["answers"].append(answer)
+            entry["created"].append(now)
+            entry["used"].append(now)
+            while len(self._docs) > self.max_docs:
+                self._docs.pop(next(iter(self._docs)))
+
+    def stats(self):
+        with self._lock:
+            return {"documents": len(self._docs), "answers": sum(len(e["answers"]) for e in self._docs.values())}
+
+
+answer_cache = AnswerCache()
+
+
+def answer_cache_key(session, mode):
+    return f"{session.get('docKey') or document_id(session['context'])}:{mode}"
+
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     data = request.get_json(silent=True) or {}
     question = (data.get('question') or '').strip()
     context_text = (data.get('summary_text') or '').strip()
     source_text = (data.get('source_text') or '').strip()
-    mode = (data.get('mode') or 'professor').strip()
+    session_id = (data.get('sessionId') or '').strip() or None
 
     if not question:
         return jsonify({"error": "Missing 'question'"}), 400
 
+    # Follow-ups send only sessionId + question; context and history live server-side
+    user_id = current_user_id()
+    session = None
+    if session_id:
+        try:
+            saved = artifact_store.get(user_id, session_id)
+        except sqlite3.Error as e:
+            return jsonify({"error": f"Could not load chat session: {str(e)}", "status": "error"}), 500
+        if saved is None or saved["kind"] != "chat":
+            return jsonify({"error": "Chat session not found", "status": "error"}), 404
+        session = saved["data"]
+    context = source_text[:CHAT_CONTEXT_CHARS] if source_text else context_text[:1000]
+    if session is None:
+        session = new_chat_session(context, (data.get('mode') or 'professor').strip())
+    elif context:
+        session["context"] = context
+        session.pop("docKey", None)
+    mode = (data.get('mode') or session["mode"]).strip()
+
+    # Long documents are indexed once; each turn then retrieves the passages relevant to the question
+    if len(source_text) > CHAT_CONTEXT_CHARS:
+        session["docKey"], _ = index_document(source_text)
+    if session.get("docKey"):
+        queries = [question] + [turn["q"] for turn in session["turns"][-1:]]
+        chunks = relevant_chunks(embedding_index(session["docKey"]), queries, CHAT_CONTEXT_CHARS)
+        if chunks:
+            context = "\n\n".join(chunks)
+    context = context or session["context"]
+
     # Build concise system prompt
     system_prompt = (
         "You are an expert professor who explains concepts clearly and concisely.\n\n"
@@ -1495,34 +5576,77 @@ def chat():
         "You are a helpful assistant. Keep responses very concise (2-3 sentences) and use plain text only - no markdown formatting."
     )
 
+    # Only questions asked without earlier turns are shared: a follow-up depends on its conversation
+    standalone = not session["turns"] and not session["summary"]
+    cache_key = answer_cache_key(session, mode)
+    cached_answer = None
+    if ANSWER_CACHE_ENABLED and standalone:
+        with span("chat.answer_cache"):
+            cached_answer, similarity = answer_cache.lookup(cache_key, question)
+        CACHE_LOOKUPS.inc(current_endpoint(), "answer", "hit" if cached_answer is not None else "miss")
+
+    if session["summary"]:
+        system_prompt += f"\n\nSummary of the earlier conversation:\n{session['summary']}"
+
     # Build user prompt with context
-    user_prompt = f"Context:\n{source_text[:2000] if source_text else context_text[:1000]}\n\nQuestion: {question}"
+    user_prompt = f"Context:\n{context}\n\nQuestion: {question}"
 
     try:
-        # Call the LLM API
-        response = client.chat.completions.create(
-            model="openai/gpt-oss-20b",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=200,  # Limit response length
-            temperature=0.4
-        )
-        
-        # Extract the AI response
-        ai_response = response.choices[0].message.content if response and response.choices else ""
-        
-        # Clean the response to remove any markdown
-        cleaned_answer = clean_response(ai_response)
-        
-        # Optionally truncate if still too long
-        if len(cleaned_answer) > 500:
-            cleaned_answer = cleaned_answer[:497] + "..."
-        
+        if cached_answer is not None:
+            cleaned_answer = cached_answer
+        else:
+            # Call the LLM API (recent turns verbatim so follow-up questions resolve)
+            response = llm.create(
+                model=CHAT_MODEL,
+                route=True,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    *chat_history_messages(session),
+                    {"role": "user", "content": user_prompt}
+                ],
+                max_tokens=200,  # Limit response length
+                temperature=0.4
+            )
+
+            # Extract the AI response
+            ai_response = response.choices[0].message.content if response and response.choices else ""
+
+            # Clean the response to remove any markdown
+            cleaned_answer = clean_response(ai_response)
+
+            # Optionally truncate if still too long
+            if len(cleaned_answer) > 500:
+                cleaned_answer = cleaned_answer[:497] + "..."
+
+            if ANSWER_CACHE_ENABLED and standalone and cleaned_answer:
+                answer_cache.store(cache_key, question, cleaned_answer)
+
+        session["mode"] = mode
+        turn = {"q": question, "a": cleaned_answer}
+        try:
+            # Applied to the stored session, not the copy loaded above: concurrent turns must not overwrite each other
+            updated = None
+            if session_id:
+                updated = artifact_store.update(user_id, session_id, "chat",
+                                                lambda current: record_chat_turn(current, session, turn))
+            if updated is None:
+                session = record_chat_turn(session, session, turn)
+                session_id = artifact_store.save(user_id, "chat", session, doc_id=data.get('docId'),
+                                                 title=question[:80] if session["turnCount"] == 1 else None)
+            else:
+                session = updated
+            schedule_chat_compression(user_id, session_id, session)
+        except sqlite3.Error as e:
+            print(f"⚠️ Could not save chat session: {e}")
+            session_id = None
+
         return jsonify({
             "response": cleaned_answer,
-            "status": "success"
+            "status": "success",
+            "sessionId": session_id,
+            "turn": session["turnCount"],
+            "cached": cached_answer is not None,
+            "stats": {"routing": routing_stats()}
         })
         
     except Exception as e:
@@ -1562,13 +5686,18 @@ def generate_ultimate_cheatsheet():
         
         if not summary_text and not source_text:
             return jsonify({"error": "No document content provided"}), 400
+        try:
+            compression_ratio = parse_compression_ratio(data.get('compressionRatio'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        # Build context
+        # Build context (sentences the summary already covers, and with compressionRatio < 1 low-information ones, are dropped)
+        summary_part, source_part, compression = compressed_context(summary_text, source_text, compression_ratio)
         context = ""
-        if summary_text:
-            context += f"DOCUMENT SUMMARY:\n{summary_text}\n\n"
-        if source_text:
-            context += f"FULL DOCUMENT TEXT:\n{source_text}\n\n"
+        if summary_part:
+            context += f"DOCUMENT SUMMARY:\n{summary_part}\n\n"
+        if source_part:
+            context += f"FULL DOCUMENT TEXT:\n{source_part}\n\n"
         
         # Calculate content density based on detail level and page count
         # Rough estimate: 500 words per page at normal density
@@ -1713,9 +5842,10 @@ Generate the complete cheat sheet now (Markdown format):"""
         # Calculate appropriate max_tokens
         max_tokens_estimate = min(8000, int(target_words * 1.5))
         
-        # Call Together AI
-        response = client.chat.completions.create(
+        # Call Together AI (continued if the sheet runs past max_tokens)
+        cheatsheet_content, continuation = complete_text(
             model="openai/gpt-oss-20b",
+            route=True,
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
@@ -1723,22 +5853,30 @@ Generate the complete cheat sheet now (Markdown format):"""
             max_tokens=max_tokens_estimate,
             temperature=0.4
         )
-        
-        cheatsheet_content = response.choices[0].message.content.strip()
+        cheatsheet_content = cheatsheet_content.strip()
         
         # Calculate actual stats
         word_count = len(cheatsheet_content.split())
         estimated_pages = round(word_count / 500, 1)
         
-        return jsonify({
+        result = {
             "content": cheatsheet_content,
             "stats": {
                 "wordCount": word_count,
                 "estimatedPages": estimated_pages,
                 "detailLevel": detail_level,
-                "requestedPages": page_count
-            }
-        })
+                "requestedPages": page_count,
+                **continuation
+            },
+            "docId": data.get('docId') or document_id(source_text or summary_text)
+        }
+        result["artifactId"] = save_artifact(
+            artifact_spec("cheatsheet", result["docId"], data.get('title') or "Ultimate Cheat Sheet",
+                          variant=f"{detail_level}:{page_count}:{json.dumps(include_sections, sort_keys=True)}"),
+            result)
+        result["stats"]["routing"] = routing_stats()
+        result["stats"]["compression"] = compression
+        return jsonify(result)
         
     except Exception as e:
         return jsonify({"error": f"Cheat sheet generation failed: {str(e)}"}), 500
@@ -1748,6 +5886,11 @@ Generate the complete cheat sheet now (Markdown format):"""
 def download_ultimate_cheatsheet():
     """Generate and download the ultimate cheat sheet as PDF"""
     try:
+        from reportlab.lib.pagesizes import letter
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib.units import inch
+        from reportlab.lib.enums import TA_LEFT
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
         data = request.get_json(silent=True) or {}
         title = data.get('title', 'Ultimate Cheat Sheet')
         content = data.get('content', '')
@@ -1823,8 +5966,6 @@ def download_ultimate_cheatsheet():
         story = []
         
         # Helpers for safe inline formatting
-        import re
-        from xml.sax.saxutils import escape as xml_escape
 
         def clean_inline(text: str) -> str:
             # Escape HTML entities first
@@ -1832,7 +5973,7 @@ def download_ultimate_cheatsheet():
             # Bold: **text** -> <b>text</b>
             text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", text)
             # Inline code: `code` -> <font face="Courier">code</font>
-            text = re.sub(r"`([^`]+)`", r"<font face=\"Courier\">\1</font>", text)
+            text = re.sub(r"`([^`]+)`", r"<font face='Courier'>\1</font>", text)
             return text
 
         # Parse markdown-like content
@@ -1877,7 +6018,8 @@ def download_ultimate_cheatsheet():
                 story.append(Paragraph(text, body_style))
         
         # Build PDF
-        doc.build(story)
+        with span("pdf.render", flowables=len(story)):
+            doc.build(story)
         buffer.seek(0)
         
         # Generate filename
@@ -1893,9 +6035,6 @@ def download_ultimate_cheatsheet():
         
     except Exception as e:
         return jsonify({"error": f"PDF generation failed: {str(e)}"}), 500
-from bs4 import BeautifulSoup
-from urllib.parse import quote_plus, urlparse
-import time
 
 # Add this route to your app.py
 
@@ -1919,15 +6058,15 @@ def web_research():
         print(f"\n🔍 Starting web research for: {query}")
         
         # Use DuckDuckGo search (no API key needed)
-        search_url = f"https://html.duckduckgo.com/html/?q={quote_plus(query)}"
+        search_url = f"{SEARCH_URL}?q={quote_plus(query)}"
         
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
         
         try:
-            response = requests.get(search_url, headers=headers, timeout=10)
-            soup = BeautifulSoup(response.content, 'html.parser')
+            response = timed_get(search_url, headers=headers, timeout=10)
+            soup = bs4.BeautifulSoup(response.content, 'html.parser')
             
             # Extract search results
             results = []
@@ -1973,7 +6112,227 @@ def web_research():
     except Exception as e:
         return jsonify({"error": f"Web research failed: {str(e)}"}), 500
 
-# Updated generate_research_paper function with better model and token limits
+# ---------------------------------------------------------------------------
+# Sectioned research papers: outline first, body sections in parallel, abstract and conclusion last
+# ---------------------------------------------------------------------------
+# Tried in order; a model that is unavailable or failing falls through to the next
+RESEARCH_MODELS = [
+    "meta-llama/Llama-3.3-70B-Instruct-Turbo",          # preferred (Together model ID)
+    "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo",     # common alt
+    "meta-llama/Llama-3.1-70B-Instruct-Turbo",          # alias alt
+    "meta-llama/Meta-Llama-3-70B-Instruct",             # older naming
+    "openai/gpt-oss-20b"                                # stable fallback
+]
+RESEARCH_SYSTEM_PROMPT = """You are an expert academic researcher and technical writer with PhDs in multiple fields. 
+
+Your research papers are known for:
+- Exceptional depth and clarity
+- Rigorous academic standards
+- Comprehensive coverage of all aspects
+- Clear explanations of complex concepts
+- Well-structured logical flow
+- Proper citations and references
+- Balanced perspectives
+- Practical applications and examples
+
+Write in an authoritative yet accessible academic style. Use proper Markdown formatting for structure."""
+RESEARCH_SECTIONED_DEPTHS = set(os.getenv("RESEARCH_SECTIONED_DEPTHS", "detailed,comprehensive").split(","))
+RESEARCH_SECTION_CONCURRENCY = int(os.getenv("RESEARCH_SECTION_CONCURRENCY", 12))
+RESEARCH_DIGEST_CHARS = 24000  # assembled body shown to the abstract and conclusion writers
+
+FURTHER_READING = {
+    "heading": "Further Reading & Resources",
+    "points": ["### Academic Papers: key papers in the field", "### Books & Guides: recommended textbooks",
+               "### Online Resources: tutorials, courses, documentation, communities",
+               "### Video Content: educational videos, lectures and talks, demonstrations"],
+    "numbered": False,
+}
+
+
+def research_completion(messages, max_tokens, temperature=0.7, models=None):
+    """complete_text() over RESEARCH_MODELS (or `models`) in order. Returns (text, continuation, model)."""
+    last_error = None
+    for model_id in models or RESEARCH_MODELS:
+        try:
+            print(f"Trying model: {model_id}")
+            text, continuation = complete_text(model=model_id, messages=messages, max_tokens=max_tokens,
+                                               temperature=temperature)
+            return text, continuation, model_id
+        except JobCancelled:
+            raise
+        except Exception as e:
+            err_str = str(e)
+            last_error = err_str
+            if any(tok in err_str.lower() for tok in ["model_not_available", "model not available", "404", "not found", "invalid_request_error"]):
+                print(f"Model unavailable: {model_id} -> {err_str}")
+                continue
+            print(f"Model failed: {model_id} -> {err_str}")
+    raise RuntimeError(f"No available model from fallback list. Last error: {last_error}")
+
+
+def _models_from(model):
+    """RESEARCH_MODELS with the model that already answered first, so sections do not retry dead models first."""
+    return [model] + [m for m in RESEARCH_MODELS if m != model]
+
+
+@traced("research.outline")
+def plan_research_outline(topic, context, config):
+    """One short call that fixes the body section headings and key points. Returns (sections, model)."""
+    prompt = f"""Plan the body of a {config['label']} research paper.
+
+TOPIC: {topic}
+
+RESEARCH CONTEXT:
+{context}
+
+Return ONLY this JSON:
+{{"sections": [{{"heading": "Introduction", "points": ["key point", "key point", "key point"]}}]}}
+
+Exactly {config['body_sections']} sections in reading order, starting with Introduction and covering: {config['sections']}.
+Do NOT include Abstract, Conclusion, References or Further Reading; they are written separately.
+Give each section 3-5 specific key points, and make sure no two sections cover the same point."""
+    text, _, model = research_completion(
+        [{"role": "system", "content": RESEARCH_SYSTEM_PROMPT}, {"role": "user", "content": prompt}],
+        max_tokens=1500, temperature=0.4)
+    data = parse_llm_json(text) or {}
+    sections = [
+        {"heading": str(s["heading"]).strip().lstrip("#0123456789. ").strip(), "points": [str(p) for p in s.get("points") or []]}
+        for s in data.get("sections") or [] if isinstance(s, dict) and s.get("heading")
+    ]
+    if not sections:
+        raise ValueError("Failed to parse research outline")
+    return sections, model
+
+
+def _outline_text(outline):
+    return "\n".join(f"{i}. {s['heading']}: " + "; ".join(s["points"]) for i, s in enumerate(outline, 1))
+
+
+@traced("research.section")
+def write_research_section(index, plan, models):
+    """Body of one section, written from the shared context and the whole outline (so it stays in its lane)."""
+    outline = plan["outline"]
+    section = outline[index] if index < len(outline) else FURTHER_READING
+    label = f"section {index + 1}. {section['heading']}" if section.get("numbered", True) else f"the '{section['heading']}' section"
+    prompt = f"""You are writing {label} of a research paper on: {plan['topic']}.
+
+RESEARCH CONTEXT:
+{plan['context']}
+
+FULL PAPER OUTLINE (other sections are written separately; do not cover their points):
+{_outline_text(outline)}
+
+THIS SECTION: {section['heading']}
+Key points to cover:
+""" + "\n".join(f"- {p}" for p in section["points"]) + f"""
+
+Write ~{plan['sectionWords']} words of Markdown. Start directly with the content: do not repeat the section
+heading, and do not write an abstract, conclusion or reference list. Use ### subheadings, **bold** key terms,
+concrete examples and data, and cite the web sources in the context as [Source Title](URL)."""
+    # research_completion already falls back across models, so a failure here means none of them could write it
+    text, _, _ = research_completion(
+        [{"role": "system", "content": RESEARCH_SYSTEM_PROMPT}, {"role": "user", "content": prompt}],
+        max_tokens=min(plan["maxTokens"], int(plan["sectionWords"] * 2) + 300), models=models)
+    text = re.sub(r"^\s*#{1,3}\s*[\d.]*\s*" + re.escape(section["heading"]) + r"\s*\n", "", text.strip(), flags=re.IGNORECASE)
+    if not text.strip():
+        raise RuntimeError("empty response")
+    return text.strip()
+
+
+@traced("research.summary")
+def write_research_summary(kind, plan, body_sections, models):
+    """Abstract or conclusion, written last from a digest of the assembled body."""
+    per_section = RESEARCH_DIGEST_CHARS // max(1, len(body_sections))
+    digest = "\n\n".join(f"## {s['heading']}\n{s['content'][:per_section]}" for s in body_sections)
+    instructions = {
+        "abstract": "Write the Abstract: 150-250 words covering the problem, scope, approach and key findings.",
+        "conclusion": "Write the Conclusion: summary of key points, main contributions, final insights and "
+                      "recommendations (250-400 words).",
+    }[kind]
+    text, _, _ = research_completion(
+        [{"role": "system", "content": RESEARCH_SYSTEM_PROMPT},
+         {"role": "user", "content": f"Research paper on: {plan['topic']}\n\nPAPER BODY:\n{digest}\n\n{instructions}\n"
+                                     "Output only the section text in Markdown, without its heading."}],
+        max_tokens=900, models=models)
+    return re.sub(r"^\s*#{1,3}\s*[\d.]*\s*" + kind + r"\s*\n", "", text.strip(), flags=re.IGNORECASE)
+
+
+def assemble_research_paper(plan, web_sources):
+    """Markdown paper from the plan's written parts, numbered like the single-call layout."""
+    body = [s for s in plan["sections"] if s.get("numbered", True)]
+    parts = [f"# {plan['topic']}", "*A Comprehensive Research Analysis*", "---", f"## Abstract\n{plan.get('abstract', '')}"]
+    parts += [f"## {i}. {s['heading']}\n\n{s['content']}" for i, s in enumerate(body, 1)]
+    parts.append(f"## {len(body) + 1}. Conclusion\n\n{plan.get('conclusion', '')}")
+    if web_sources:
+        parts.append("## References\n" + "\n".join(
+            f"- {s.get('title', 'Unknown')}, [{s.get('url', 'N/A')}]({s.get('url', '')})" for s in web_sources[:10]))
+    parts += [f"## {s['heading']}\n\n{s['content']}" for s in plan["sections"] if not s.get("numbered", True)]
+    return "\n\n".join(parts)
+
+
+def _failed_section(section, error):
+    print(f"⚠️ Research section '{section['heading']}' failed: {error}")
+    return {"heading": section["heading"], "numbered": section.get("numbered", True), "error": error,
+            "content": "*This section could not be generated. Regenerate it on its own from the saved paper.*"}
+
+
+def research_section_stats(plan):
+    """Section count and the indexes that still hold a placeholder (regenerate them one by one)."""
+    return {
+        "sections": len(plan["sections"]),
+        "failedSections": [{"index": i, "heading": s["heading"]} for i, s in enumerate(plan["sections"]) if s.get("error")],
+    }
+
+
+def write_sectioned_paper(plan):
+    """Fill in `plan` (topic, context, outline, sectionWords, maxTokens, model): body sections concurrently,
+    then abstract and conclusion together. Failed sections get a placeholder and an `error`; if no body
+    section succeeds at all, RuntimeError is raised instead of returning a paper of placeholders."""
+    models = _models_from(plan["model"])
+    tasks = plan["outline"] + [FURTHER_READING]
+    sections = [None] * len(tasks)
+    workers = max(1, min(RESEARCH_SECTION_CONCURRENCY, len(tasks)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {submit_in_context(pool, write_research_section, i, plan, models): i
+                   for i in range(len(tasks))}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                sections[i] = {"heading": tasks[i]["heading"], "numbered": tasks[i].get("numbered", True),
+                               "content": future.result()}
+            except JobCancelled:
+                raise
+            except Exception as e:
+                sections[i] = _failed_section(tasks[i], str(e))
+    plan["sections"] = sections
+
+    if not any(s.get("numbered", True) and not s.get("error") for s in sections):
+        raise RuntimeError(f"No research section could be generated ({sections[0]['error']})")
+    write_research_summaries(plan, models)
+    return plan
+
+
+def write_research_summaries(plan, models):
+    """(Re)write the abstract and conclusion together from the plan's body sections.
+
+    A summary that fails keeps its previous text (empty on a first write). Returns the kinds that failed.
+    """
+    body = [s for s in plan["sections"] if s.get("numbered", True) and not s.get("error")]
+    failed = []
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = {kind: submit_in_context(pool, write_research_summary, kind, plan, body, models)
+                   for kind in ("abstract", "conclusion")}
+        for kind, future in futures.items():
+            try:
+                plan[kind] = future.result()
+            except JobCancelled:
+                raise
+            except Exception as e:
+                print(f"⚠️ Research {kind} failed: {e}")
+                plan.setdefault(kind, "")
+                failed.append(kind)
+    return failed
+
 
 @app.route('/api/generate-research-paper', methods=['POST'])
 def generate_research_paper():
@@ -1990,6 +6349,9 @@ def generate_research_paper():
         pdf_content = data.get('pdfContent', '').strip()
         web_sources = data.get('webSources', [])
         depth_level = data.get('depthLevel', 'detailed')  # quick, detailed, comprehensive
+        sectioned = data.get('sectioned')  # default: RESEARCH_SECTIONED_DEPTHS
+        if isinstance(sectioned, str):
+            sectioned = sectioned.strip().lower() not in ("0", "false", "no", "off") if sectioned.strip() else None
         
         if not topic:
             return jsonify({"error": "Topic is required"}), 400
@@ -2028,6 +6390,7 @@ def generate_research_paper():
                 'label': 'Quick Overview',
                 'word_target': 2000,
                 'max_tokens': 3000,  # Increased from 2500
+                'body_sections': 4,
                 'detail': 'concise overview with key points',
                 'sections': 'Abstract, Introduction, Main Discussion (3-4 sections), Conclusion, Key References'
             },
@@ -2035,6 +6398,7 @@ def generate_research_paper():
                 'label': 'Detailed Analysis',
                 'word_target': 5000,
                 'max_tokens': 7000,  # Increased from 5000
+                'body_sections': 7,
                 'detail': 'comprehensive analysis with examples and explanations',
                 'sections': 'Abstract, Introduction, Literature Review, Detailed Analysis (5-7 sections), Case Studies, Discussion, Conclusion, References, Further Reading'
             },
@@ -2042,6 +6406,7 @@ def generate_research_paper():
                 'label': 'Comprehensive Research',
                 'word_target': 8000,
                 'max_tokens': 12000,  # Increased from 7500
+                'body_sections': 10,
                 'detail': 'exhaustive research with deep analysis, multiple perspectives, and extensive examples',
                 'sections': 'Abstract, Introduction, Background, Literature Review, Theoretical Framework, Detailed Analysis (8-10 sections), Methodology, Case Studies, Comparative Analysis, Applications, Challenges & Solutions, Future Directions, Conclusion, References, Appendices, Recommended Resources'
             }
@@ -2049,21 +6414,6 @@ def generate_research_paper():
         
         config = depth_configs.get(depth_level, depth_configs['detailed'])
         
-        # System prompt remains the same
-        system_prompt = """You are an expert academic researcher and technical writer with PhDs in multiple fields. 
-
-Your research papers are known for:
-- Exceptional depth and clarity
-- Rigorous academic standards
-- Comprehensive coverage of all aspects
-- Clear explanations of complex concepts
-- Well-structured logical flow
-- Proper citations and references
-- Balanced perspectives
-- Practical applications and examples
-
-Write in an authoritative yet accessible academic style. Use proper Markdown formatting for structure."""
-
         # User prompt (keeping your existing detailed prompt)
         user_prompt = f"""Generate a {config['label']} research paper on the following topic.
 
@@ -2237,46 +6587,42 @@ Generate the complete research paper now following ALL guidelines above. Make it
         print(f"🎯 Target: ~{config['word_target']} words")
         print(f"🔢 Max Tokens: {config['max_tokens']}")
         
-        # Try multiple models with graceful fallback if a model is not available
-        models_to_try = [
-            "meta-llama/Llama-3.3-70B-Instruct-Turbo",          # preferred (Together model ID)
-            "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo",     # common alt
-            "meta-llama/Llama-3.1-70B-Instruct-Turbo",          # alias alt
-            "meta-llama/Meta-Llama-3-70B-Instruct",             # older naming
-            "openai/gpt-oss-20b"                                # stable fallback
-        ]
-
-        response = None
-        selected_model = None
-        last_error = None
+        if sectioned is None:
+            sectioned = depth_level in RESEARCH_SECTIONED_DEPTHS
+        start_time = _time.time()
+        plan = None
+        continuation = {}
 
-        for model_id in models_to_try:
+        if sectioned:
             try:
-                print(f"Trying model: {model_id}")
-                response = client.chat.completions.create(
-                    model=model_id,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    max_tokens=config['max_tokens'],
-                    temperature=0.7
-                )
-                selected_model = model_id
-                break
+                outline, selected_model = plan_research_outline(topic, full_context, config)
+                print(f"🧩 Writing {len(outline)} sections in parallel")
+                plan = write_sectioned_paper({
+                    "topic": topic,
+                    "depthLevel": depth_level,
+                    "context": full_context,
+                    "outline": outline,
+                    "sectionWords": int(config['word_target'] * 0.85 / len(outline)),
+                    "maxTokens": config['max_tokens'],
+                    "model": selected_model,
+                    "webSources": web_sources[:10],
+                })
+            except JobCancelled:
+                raise
             except Exception as e:
-                err_str = str(e)
-                last_error = err_str
-                if any(tok in err_str.lower() for tok in ["model_not_available", "model not available", "404", "not found", "invalid_request_error"]):
-                    print(f"Model unavailable: {model_id} -> {err_str}")
-                    continue
-                print(f"Model failed: {model_id} -> {err_str}")
-                continue
+                print(f"⚠️ Sectioned research paper failed, writing it in one call: {e}")
 
-        if not response:
-            return jsonify({"error": f"No available model from fallback list. Last error: {last_error}"}), 500
+        if plan:
+            paper_content = assemble_research_paper(plan, web_sources)
+        else:
+            try:
+                paper_content, continuation, selected_model = research_completion(
+                    [{"role": "system", "content": RESEARCH_SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}],
+                    max_tokens=config['max_tokens'])
+            except RuntimeError as e:
+                return jsonify({"error": str(e)}), 500
 
-        paper_content = response.choices[0].message.content.strip()
+        paper_content = paper_content.strip()
 
         # Calculate stats
         word_count = len(paper_content.split())
@@ -2286,21 +6632,128 @@ Generate the complete research paper now following ALL guidelines above. Make it
         if selected_model:
             print(f"Model used: {selected_model}")
 
-        return jsonify({
+        result = {
             "paper": paper_content,
             "stats": {
                 "wordCount": word_count,
                 "estimatedPages": estimated_pages,
                 "depthLevel": depth_level,
                 "sourceCount": len(web_sources),
-                "model": selected_model or "unknown"
+                "model": selected_model or "unknown",
+                "mode": "sectioned" if plan else "single",
+                "generationTime": round(_time.time() - start_time, 2),
+                **(research_section_stats(plan) if plan else {}),
+                **continuation
             },
             "metadata": {
                 "topic": topic,
                 "generatedAt": datetime.now().isoformat(),
                 "sourcesUsed": len(web_sources)
             }
-        })
+        }
+        doc_id = data.get('docId') or (document_id(pdf_content) if pdf_content else None)
+        # The plan is kept with the saved paper so single sections can be regenerated later
+        saved = {**result, "plan": plan} if plan else result
+        result["artifactId"] = save_artifact(artifact_spec("paper", doc_id, topic, variant=f"{topic}:{depth_level}"), saved)
+        return jsonify(result)
+
+    except Exception as e:
+        print(f"Research paper error: {str(e)}")
+        return jsonify({"error": f"Research paper generation failed: {str(e)}"}), 500
+
+
+@app.route('/api/research-paper/<artifact_id>/sections/<int:index>', methods=['POST'])
+def regenerate_research_section(artifact_id, index):
+    """Rewrite one section of a saved sectioned paper (e.g. one that failed) and save the reassembled paper.
+
+    The abstract and conclusion are rewritten too when a body section changes, unless refreshSummaries is false.
+    """
+    user_id = current_user_id()
+    data = request.get_json(silent=True) or {}
+    refresh_summaries = str(data.get('refreshSummaries', True)).strip().lower() not in ("0", "false", "no", "off")
+    try:
+        artifact = artifact_store.get(user_id, artifact_id)
+    except sqlite3.Error as e:
+        return jsonify({"error": f"Artifact store error: {str(e)}"}), 500
+    if artifact is None or artifact["kind"] != "paper":
+        return jsonify({"error": "Research paper not found"}), 404
+    saved = artifact["data"]
+    plan = saved.get("plan")
+    if not plan:
+        return jsonify({"error": "Only papers generated in sectioned mode can be regenerated by section"}), 400
+    if not 0 <= index < len(plan["sections"]):
+        return jsonify({"error": f"Section index must be between 0 and {len(plan['sections']) - 1}"}), 400
+
+    section = plan["sections"][index]
+    print(f"🔁 Regenerating research section {index}: {section['heading']}")
+    start_time = _time.time()
+    try:
+        content = write_research_section(index, plan, _models_from(plan["model"]))
+    except Exception as e:
+        return jsonify({"error": f"Section regeneration failed: {str(e)}"}), 500
+    plan["sections"][index] = {"heading": section["heading"], "numbered": section.get("numbered", True), "content": content}
+
+    # The abstract and conclusion summarize the body, so they are stale once a body section changes
+    summaries_refreshed = False
+    if refresh_summaries and section.get("numbered", True):
+        try:
+            summaries_refreshed = not write_research_summaries(plan, _models_from(plan["model"]))
+        except JobCancelled:
+            raise
+        except Exception as e:
+            print(f"⚠️ Could not refresh research summaries: {e}")
+
+    paper = assemble_research_paper(plan, plan.get("webSources", []))
+    word_count = len(paper.split())
+    result = {k: v for k, v in saved.items() if k != "plan"}
+    result["paper"] = paper
+    result["stats"] = {
+        **result.get("stats", {}),
+        "wordCount": word_count,
+        "estimatedPages": round(word_count / 500, 1),
+        **research_section_stats(plan),
+        "regeneratedSection": index,
+        "summariesRefreshed": summaries_refreshed,
+        "generationTime": round(_time.time() - start_time, 2),
+    }
+    try:
+        artifact_store.save(user_id, "paper", {**result, "plan": plan}, doc_id=artifact["docId"],
+                            title=artifact["title"], artifact_id=artifact_id)
+    except sqlite3.Error as e:
+        print(f"⚠️ Could not save paper artifact: {e}")
+    result["artifactId"] = artifact_id
+    return jsonify(result)
+
+
+@app.route('/api/download-research-paper', methods=['POST'])
+def download_research_paper():
+    """Render a generated research paper (Markdown) to PDF"""
+    try:
+        from reportlab.lib.pagesizes import letter
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib.units import inch
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+
+        data = request.get_json(silent=True) or {}
+        title = data.get('title', 'Research Paper')
+        content = data.get('content', '')
+        author = xml_escape(data.get('author', 'Re:Search AI'))
+
+        if not content:
+            return jsonify({"error": "No content provided"}), 400
+
+        buffer = BytesIO()
+        doc = SimpleDocTemplate(
+            buffer,
+            pagesize=letter,
+            topMargin=inch,
+            bottomMargin=inch,
+            leftMargin=inch,
+            rightMargin=inch
+        )
+        styles = getSampleStyleSheet()
+
+        # Title page
         title_style = ParagraphStyle(
             'ResearchTitle',
             parent=styles['Heading1'],
@@ -2363,7 +6816,6 @@ Generate the complete research paper now following ALL guidelines above. Make it
         
         # Helper function for safe text processing
         def clean_inline(text: str) -> str:
-            from xml.sax.saxutils import escape as xml_escape
             text = xml_escape(text)
             text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", text)
             text = re.sub(r"`([^`]+)`", r"<font face='Courier'>\1</font>", text)
@@ -2440,7 +6892,8 @@ Generate the complete research paper now following ALL guidelines above. Make it
                 story.append(Paragraph(text, body_style))
         
         # Build PDF
-        doc.build(story)
+        with span("pdf.render", flowables=len(story)):
+            doc.build(story)
         buffer.seek(0)
         
         # Generate filename
@@ -2455,13 +6908,47 @@ Generate the complete research paper now following ALL guidelines above. Make it
         )
 
     except Exception as e:
-        import traceback
         traceback.print_exc()
         return jsonify({"error": f"PDF generation failed: {str(e)}"}), 500
 
 
+# ---------------------------------------------------------------------------
+# Process lifecycle (see gunicorn.conf.py)
+# ---------------------------------------------------------------------------
+def reset_after_fork():
+    """Give a freshly forked worker its own connection pools, process pools, SQLite connections and locks.
+
+    With preload_app the master imports this module once; HTTP keep-alive sockets, executor
+    processes and held locks must not be shared between workers.
+    """
+    global client, llm, _ocr_pool, _ocr_pool_lock, artifact_store, _summary_pool, _summary_lock, _embedding_lock
+    global _chat_pool
+    global _jobs_lock, _job_watcher
+    client = None
+    llm = LLMGateway()
+    artifact_store = ArtifactStore(ARTIFACT_DB)
+    _summary_pool = None
+    _chat_pool = None
+    _chat_compressing.clear()
+    _summary_lock = threading.Lock()
+    _summary_inflight.clear()
+    _embedding_lock = threading.Lock()
+    _embedding_indexes.clear()
+    _ocr_pool = None
+    _ocr_pool_lock = threading.Lock()
+    for name, engine in list(TTS_ENGINES.items()):
+        TTS_ENGINES[name] = type(engine)()
+    with podcast_jobs_lock:
+        podcast_jobs.clear()
+    _jobs.clear()
+    _jobs_lock = threading.Lock()
+    _job_watcher = None  # threads do not survive fork; the first job starts a new one
+    print(f"✅ Worker {os.getpid()} initialized")
+
+
 if __name__ == "__main__":
     # Start the Flask development server when running this file directly
     # Example: Running will print the link like: http://127.0.0.1:5000
     port = int(os.getenv("PORT", 5000))
+    install_trace_log_ids()
     app.run(host="127.0.0.1", port=port, debug=True)
\ No newline at end of file
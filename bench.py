@@ -0,0 +1,1227 @@
+"""Offline performance benchmarks for OuchMyBrain.io.
+
+Usage:
+    python bench.py ocr --pages 20 --dpi 200
+    python bench.py gateway --requests 40 --distinct 5
+    python bench.py api --requests 20 --concurrency 4 [--only process_50p,chat] [--baseline old.json]
+    python bench.py compare bench_results/api-abc123.json bench_results/api-def456.json
+    python bench.py serve --requests 200 --concurrency 32
+    python bench.py importtime --budget-ms 400
+    python bench.py artifacts --rows 1000,20000 --lookups 2000
+    python bench.py embeddings --chunks 100000 --queries 2000 --batch 32
+    python bench.py normalize [lecture.pdf ...]
+    python bench.py compress --ratios 1,0.8,0.6,0.4 [lecture.pdf ...]
+    python bench.py tiers --policies routed,fixed,small,large [--only process_5p,chat]
+    python bench.py cancel --requests 6 --client-timeout 3
+"""
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from types import SimpleNamespace
+
+import fitz  # PyMuPDF
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_scanned_pdf(pages: int, dpi: int = 150) -> bytes:
+    """Build an image-only PDF (no text layer) that mimics a scanned handout."""
+    text_doc = fitz.open()
+    for i in range(pages):
+        page = text_doc.new_page()
+        body = (
+            f"Lecture {i + 1}: Thermodynamics\n\n"
+            "The first law states that energy is conserved. Heat added to a system\n"
+            "equals the change in internal energy plus the work done by the system.\n"
+            "Entropy of an isolated system never decreases over time.\n"
+        )
+        page.insert_text((72, 96), body, fontsize=12)
+
+    scanned = fitz.open()
+    for page in text_doc:
+        pix = page.get_pixmap(dpi=dpi)
+        out = scanned.new_page(width=page.rect.width, height=page.rect.height)
+        out.insert_image(out.rect, stream=pix.tobytes("png"))
+    return scanned.tobytes()
+
+
+def bench_ocr(args):
+    import app
+
+    if app.pytesseract is None:
+        print("pytesseract is not installed; install it (and Tesseract) to benchmark OCR.")
+        return 1
+
+    pdf_bytes = make_scanned_pdf(args.pages)
+    cache_dir = tempfile.mkdtemp(prefix="ocr_bench_")
+    app.OCR_CACHE_DIR = cache_dir
+    app.OCR_DPI = args.dpi
+
+    try:
+        results = {}
+        for label in ("cold", "warm"):
+            start = time.perf_counter()
+            text, stats = app.extract_pdf_text(pdf_bytes)
+            elapsed = time.perf_counter() - start
+            results[label] = {
+                "seconds": round(elapsed, 3),
+                "pagesPerSec": round(args.pages / elapsed, 2),
+                "ocrPages": stats["ocrPages"],
+                "cacheHits": stats["ocrCacheHits"],
+                "chars": len(text),
+            }
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print(json.dumps({
+        "benchmark": "ocr",
+        "pages": args.pages,
+        "dpi": args.dpi,
+        "workers": app.OCR_WORKERS,
+        "results": results,
+    }, indent=2))
+    return 0
+
+
+def percentiles(samples):
+    """p50/p95/p99 of a list of seconds, in milliseconds."""
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99)}
+
+
+class RateLimitedUpstream:
+    """Fake chat-completions API: fixed latency, 429s once more than `capacity` calls are in flight."""
+
+    def __init__(self, latency, capacity):
+        self.latency = latency
+        self.capacity = capacity
+        self.active = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def create(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+            self.active += 1
+            overloaded = self.active > self.capacity
+        try:
+            if overloaded:
+                error = RuntimeError("429 Too Many Requests")
+                error.status_code = 429
+                raise error
+            time.sleep(self.latency)
+            message = SimpleNamespace(content="ok")
+            return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")])
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+def bench_gateway(args):
+    import app
+
+    prompts = [
+        {"model": "openai/gpt-oss-120b", "messages": [{"role": "user", "content": f"Summarize document {i % args.distinct}"}]}
+        for i in range(args.requests)
+    ]
+    report = {}
+    for label in ("direct", "gateway"):
+        upstream = RateLimitedUpstream(args.latency, args.capacity)
+        app.client = SimpleNamespace(chat=SimpleNamespace(completions=upstream))
+        gateway = app.LLMGateway()
+        call = upstream.create if label == "direct" else gateway.create
+        latencies, errors = [], 0
+
+        def one(kwargs):
+            start = time.perf_counter()
+            try:
+                call(**kwargs)
+                return time.perf_counter() - start, None
+            except Exception as e:
+                return time.perf_counter() - start, e
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.requests) as pool:
+            for elapsed, error in pool.map(one, prompts):
+                latencies.append(elapsed)
+                errors += error is not None
+        report[label] = {
+            "wallSeconds": round(time.perf_counter() - start, 3),
+            "upstreamCalls": upstream.calls,
+            "errors": errors,
+            "latencyMs": percentiles(latencies),
+        }
+        if label == "gateway":
+            report[label]["gatewayStats"] = gateway.stats()
+
+    print(json.dumps({
+        "benchmark": "gateway",
+        "requests": args.requests,
+        "distinctPrompts": args.distinct,
+        "upstreamCapacity": args.capacity,
+        "results": report,
+    }, indent=2))
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# API suite: every /api/* route against a local mock Together/ElevenLabs/search server
+# ---------------------------------------------------------------------------
+FIXTURE_PAGES = (5, 50, 200, 1000)
+_MP3_SILENT_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413  # MPEG-1 Layer III, 128 kbps, 44.1 kHz
+_WORDS = ("entropy energy system heat work cell protein market demand theorem proof network "
+          "signal memory learning gradient model data sample process law force").split()
+
+
+def mock_completion_text(messages, words):
+    """Shape the mock reply after the prompt, so JSON endpoints get JSON they can parse."""
+    prompt = messages[-1]["content"] if messages else ""
+    filler = lambda n: " ".join(_WORDS[i % len(_WORDS)] for i in range(n))
+    match = re.search(r"Plan a (\d+)-slide", prompt)
+    if match:
+        count = int(match.group(1))
+        return json.dumps({"outline": [{"slideNumber": i + 1, "title": f"Topic {i + 1}", "focus": filler(8)}
+                                       for i in range(count)]})
+    match = re.search(r"writing slide (\d+)", prompt)
+    if match:
+        return json.dumps({"title": f"Topic {match.group(1)}", "content": [filler(10) for _ in range(4)],
+                           "narration": filler(min(words, 120))})
+    match = re.search(r"Create (\d+) high-quality flashcards", prompt)
+    if match:
+        count = int(match.group(1))
+        return json.dumps({"flashcards": [{"question": f"What is {filler(3)}?", "answer": filler(15),
+                                           "difficulty": "medium", "category": "core"} for _ in range(count)]})
+    match = re.search(r"Exactly (\d+) sections", prompt)
+    if match:
+        return json.dumps({"sections": [{"heading": f"Section {i + 1}", "points": [filler(6) for _ in range(3)]}
+                                        for i in range(int(match.group(1)))]})
+    if "study schedule" in prompt:
+        return json.dumps({"schedule": [{"day": d + 1, "topics": [filler(3)], "hours": 2, "tasks": [filler(6)]}
+                                        for d in range(7)]})
+    if "podcast script" in prompt:
+        return "\n\n".join(f"HOST {'AB'[i % 2]}: {filler(40)}" for i in range(max(2, words // 40)))
+    return "# Summary\n\n" + "\n\n".join(f"- **Point {i + 1}**: {filler(20)}" for i in range(max(1, words // 20)))
+
+
+class MockUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        cfg = self.server.config
+        if self.path.startswith("/search"):
+            time.sleep(cfg.search_latency)
+            results = "".join(
+                f'<div class="result"><a class="result__a" href="https://example{i}.edu/page">Result {i}</a>'
+                f'<a class="result__snippet">Snippet {i} about the topic.</a></div>'
+                for i in range(10)
+            )
+            return self._send(200, f"<html><body>{results}</body></html>".encode("utf-8"), "text/html")
+        self._send(404, b"{}", "application/json")
+
+    def do_POST(self):
+        cfg = self.server.config
+        body = self._body()
+        if self.path.endswith("/chat/completions"):
+            return self._chat(json.loads(body or b"{}"), cfg)
+        if "/text-to-speech/" in self.path:
+            text = json.loads(body or b"{}").get("text", "")
+            seconds = len(text.split()) / 150 * 60
+            time.sleep(cfg.tts_latency + len(text) / cfg.tts_chars_per_sec)
+            return self._send(200, _MP3_SILENT_FRAME * max(1, int(seconds / 0.0261)), "audio/mpeg")
+        self._send(404, b"{}", "application/json")
+
+    def _count(self, tokens):
+        with self.server.count_lock:
+            self.server.tokens_generated += tokens
+
+    def _chat(self, payload, cfg):
+        with self.server.count_lock:
+            self.server.active_calls += 1
+        try:
+            self._generate(payload, cfg)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client hung up: stop generating, like a real provider
+        finally:
+            with self.server.count_lock:
+                self.server.active_calls -= 1
+
+    def _generate(self, payload, cfg):
+        words = min(cfg.completion_tokens, int(payload.get("max_tokens") or cfg.completion_tokens))
+        text = mock_completion_text(payload.get("messages", []), words)
+        tokens = text.split(" ")
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in payload.get("messages", [])) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens)}
+        base = {"id": "mock", "created": int(time.time()), "model": payload.get("model", "mock")}
+        # Optional per-model speeds ({model: SimpleNamespace(ttft, tokens_per_sec, prefill_tokens_per_sec)})
+        cfg = getattr(cfg, "models", {}).get(payload.get("model")) or cfg
+        time.sleep(cfg.ttft + prompt_tokens / getattr(cfg, "prefill_tokens_per_sec", float("inf")))
+        if not payload.get("stream"):
+            time.sleep(len(tokens) / cfg.tokens_per_sec)
+            self._count(len(tokens))
+            reply = dict(base, object="chat.completion", usage=usage, choices=[{
+                "index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}])
+            return self._send(200, json.dumps(reply).encode("utf-8"), "application/json")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        step = 8
+        for i in range(0, len(tokens), step):
+            delta = " ".join(tokens[i:i + step]) + (" " if i + step < len(tokens) else "")
+            chunk = dict(base, object="chat.completion.chunk", choices=[{
+                "index": 0, "delta": {"role": "assistant", "content": delta}, "finish_reason": None}])
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            self._count(len(tokens[i:i + step]))
+            time.sleep(step / cfg.tokens_per_sec)
+        final = dict(base, object="chat.completion.chunk", usage=usage, choices=[{
+            "index": 0, "delta": {"content": ""}, "finish_reason": "stop"}])
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+
+def start_mock_upstream(config):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockUpstreamHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.count_lock = threading.Lock()
+    server.tokens_generated = 0  # completion tokens actually produced (streams stop when the client hangs up)
+    server.active_calls = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def mock_upstream_env(port, data_dir):
+    """Environment that points app.py at the mock server and keeps caches out of the repo."""
+    base = f"http://127.0.0.1:{port}"
+    voice = {"engine": "elevenlabs", "voice": "mock"}
+    return {
+        "TOGETHER_API_KEY": "bench",
+        "TOGETHER_BASE_URL": f"{base}/v1",
+        "ELEVENLABS_API_KEY": "bench",
+        "ELEVENLABS_BASE_URL": base,
+        "SEARCH_URL": f"{base}/search",
+        "TTS_FALLBACK_ORDER": "elevenlabs",
+        "PODCAST_TTS_ENGINE": "elevenlabs",
+        "PODCAST_VOICES": json.dumps({"HOST A": voice, "HOST B": voice, "NARRATOR": voice}),
+        "DATA_DIR": data_dir,
+        "TRACE_SAMPLE_RATE": "0",
+    }
+
+
+def fixture_pdf(pages, directory):
+    """Text PDF with `pages` lecture-style pages, generated once and reused."""
+    path = os.path.join(directory, f"lecture_{pages}p.pdf")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        doc = fitz.open()
+        for i in range(pages):
+            page = doc.new_page()
+            lines = [f"Chapter {i // 10 + 1} - Page {i + 1}", ""]
+            lines += [" ".join(_WORDS[(i + j + k) % len(_WORDS)] for k in range(12)) for j in range(30)]
+            page.insert_text((72, 72), "\n".join(lines), fontsize=10)
+        doc.save(path)
+    return path
+
+
+def _json_payload(build):
+    return lambda i, ctx: {"json": build(i, ctx)}
+
+
+def _pdf_upload(pages):
+    def build(i, ctx):
+        with open(ctx["fixtures"][pages], "rb") as f:
+            return {"data": {"file": (BytesIO(f.read()), f"lecture_{pages}p.pdf")},
+                    "content_type": "multipart/form-data"}
+    return build
+
+
+_SUMMARY = "# Thermodynamics\n\n" + "\n".join(f"- **Point {n}**: " + " ".join(_WORDS) for n in range(30))
+_PAPER = "# Paper\n\n## Abstract\n" + "\n\n".join(
+    f"## {n}. Section\n- **Key**: {' '.join(_WORDS)}\n> Quote `code`\n1. Step" for n in range(40))
+
+# Rephrasings of a few questions a class keeps asking (served by the semantic answer cache after the first)
+_COMMON_QUESTIONS = ["What is entropy?", "Explain entropy", "what's entropy??", "How does heat become work?",
+                     "how does heat become work", "What is the law of demand?", "Define the law of demand"]
+
+# name -> (method, path, request builder(i, ctx) -> test-client kwargs). `i` varies prompts so identical
+# concurrent requests are not all coalesced by the gateway.
+API_SCENARIOS = {
+    **{f"process_{pages}p": ("POST", "/api/process", _pdf_upload(pages)) for pages in FIXTURE_PAGES},
+    "smart_summary": ("POST", "/api/smart_summary", _json_payload(lambda i, ctx: {"text": f"{i} {_SUMMARY}", "level": 2})),
+    "smart_summary_levels": ("POST", "/api/smart_summary", _json_payload(lambda i, ctx: {"text": _PAPER, "level": i % 4 + 1})),
+    "chat": ("POST", "/api/chat", _json_payload(lambda i, ctx: {"question": f"Explain point {i}", "summary_text": _SUMMARY})),
+    "chat_common": ("POST", "/api/chat", _json_payload(lambda i, ctx: {
+        "question": _COMMON_QUESTIONS[i % len(_COMMON_QUESTIONS)], "summary_text": _SUMMARY})),
+    "generate_flashcards": ("POST", "/api/generate-flashcards", _json_payload(lambda i, ctx: {"summaryText": f"{i} {_SUMMARY}", "count": 20})),
+    "download_flashcards": ("POST", "/api/download-flashcards", _json_payload(lambda i, ctx: {
+        "flashcards": [{"question": f"Q{n}?", "answer": " ".join(_WORDS)} for n in range(40)]})),
+    "generate_slides": ("POST", "/api/generate-professor-slides", _json_payload(lambda i, ctx: {"summaryText": f"{i} {_SUMMARY}", "slideCount": 8})),
+    "generate_professor_audio": ("POST", "/api/generate-professor-audio", _json_payload(lambda i, ctx: {
+        "slides": [{"title": f"Slide {n}", "narration": f"{i} " + " ".join(_WORDS)} for n in range(5)], "voiceId": "elevenlabs:mock"})),
+    "generate_schedule": ("POST", "/api/generate-schedule", _json_payload(lambda i, ctx: {
+        "summaryText": f"{i} {_SUMMARY}", "examDate": (datetime.now() + timedelta(days=14)).strftime("%Y-%m-%d"), "dailyHours": 2})),
+    "schedule_alias": ("POST", "/api/schedule", _json_payload(lambda i, ctx: {
+        "summaryText": f"{i} {_SUMMARY}", "examDate": (datetime.now() + timedelta(days=14)).strftime("%Y-%m-%d")})),
+    "generate_podcast_script": ("POST", "/api/generate-podcast-script", _json_payload(lambda i, ctx: {"summaryText": f"{i} {_SUMMARY}", "duration": 3})),
+    "text_to_speech": ("POST", "/api/text-to-speech", _json_payload(lambda i, ctx: {
+        "script": f"HOST A: Welcome {i}. " + " ".join(_WORDS) + "\nHOST B: " + " ".join(_WORDS), "voiceId": "elevenlabs:mock"})),
+    "podcast_stream_start": ("POST", "/api/podcast/stream", _json_payload(lambda i, ctx: {"summaryText": f"{i} {_SUMMARY}", "duration": 3})),
+    "save_podcast": ("POST", "/api/save-podcast", _json_payload(lambda i, ctx: {"title": f"Podcast {i}", "script": _SUMMARY})),
+    "download_cheatsheet": ("POST", "/api/download-cheatsheet", _json_payload(lambda i, ctx: {"title": "Sheet", "content": _PAPER})),
+    "generate_ultimate_cheatsheet": ("POST", "/api/generate-ultimate-cheatsheet", _json_payload(lambda i, ctx: {"summaryText": f"{i} {_SUMMARY}"})),
+    "download_ultimate_cheatsheet": ("POST", "/api/download-ultimate-cheatsheet", _json_payload(lambda i, ctx: {"title": "Sheet", "content": _PAPER})),
+    "web_research": ("POST", "/api/web-research", _json_payload(lambda i, ctx: {"query": f"thermodynamics {i}"})),
+    "generate_research_paper": ("POST", "/api/generate-research-paper", _json_payload(lambda i, ctx: {"topic": f"Entropy {i}", "depthLevel": "quick"})),
+    "research_paper_sectioned": ("POST", "/api/generate-research-paper", _json_payload(lambda i, ctx: {"topic": f"Entropy {i}", "depthLevel": "comprehensive"})),
+    "research_paper_single": ("POST", "/api/generate-research-paper", _json_payload(lambda i, ctx: {"topic": f"Entropy {i}", "depthLevel": "comprehensive", "sectioned": False})),
+    "download_research_paper": ("POST", "/api/download-research-paper", _json_payload(lambda i, ctx: {"title": "Paper", "content": _PAPER})),
+    "tts_engines": ("GET", "/api/tts/engines", lambda i, ctx: {}),
+    "list_artifacts": ("GET", "/api/artifacts", lambda i, ctx: {}),
+}
+
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def bench_api_worker(args):
+    """Child process: import the app against the mock server and drive one scenario."""
+    sys.path.insert(0, REPO_DIR)
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")  # app.py logs every request
+    try:
+        import app
+        rss_after_import = peak_rss_mb()
+        method, path, build = API_SCENARIOS[args.scenario]
+        ctx = {"fixtures": {pages: fixture_pdf(pages, args.fixtures) for pages in FIXTURE_PAGES
+                            if args.scenario == f"process_{pages}p"}}
+
+        def one(i):
+            start = time.perf_counter()
+            response = app.app.test_client().open(path, method=method, **build(i, ctx))
+            response.get_data()  # drain streamed bodies
+            return time.perf_counter() - start, response.status_code
+
+        for i in range(args.warmup):
+            one(-1 - i)
+        latencies, statuses = [], {}
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for elapsed, status in pool.map(one, range(args.requests)):
+                latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+        wall = time.perf_counter() - start
+        spend = {}
+        for line in app.LLM_COST_USD.render():
+            model = re.search(r'model="([^"]*)"', line).group(1)
+            spend[model] = spend.get(model, 0) + float(line.rsplit(" ", 1)[1])
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+
+    result = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "statuses": statuses,
+        "latencyMs": percentiles(latencies),
+        "throughputRps": round(args.requests / wall, 2),
+        "rssAfterImportMB": rss_after_import,
+        "peakRssMB": peak_rss_mb(),
+        "llmCostUsd": {model: round(cost, 6) for model, cost in spend.items()},
+    }
+    with open(args.result_file, "w") as f:
+        json.dump(result, f)
+    return 0
+
+
+def compare_results(baseline, current, tolerance):
+    """Print per-scenario deltas; returns the scenarios whose p95 or throughput regressed beyond `tolerance`."""
+    regressions = []
+    print(f"{'scenario':32} {'p50 ms':>16} {'p95 ms':>16} {'rps':>14} {'peak MB':>14}")
+    for name, now in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if not before or "latencyMs" not in now or "latencyMs" not in before:
+            continue
+
+        def cell(old, new):
+            return f"{old}->{new}" if old is not None and new is not None else "-"
+        p95_old, p95_new = before["latencyMs"]["p95"], now["latencyMs"]["p95"]
+        slower = p95_old and p95_new > p95_old * (1 + tolerance)
+        fewer = before["throughputRps"] and now["throughputRps"] < before["throughputRps"] * (1 - tolerance)
+        flag = "  REGRESSION" if slower or fewer else ""
+        if flag:
+            regressions.append(name)
+        print(f"{name:32} {cell(before['latencyMs']['p50'], now['latencyMs']['p50']):>16} "
+              f"{cell(p95_old, p95_new):>16} {cell(before['throughputRps'], now['throughputRps']):>14} "
+              f"{cell(before.get('peakRssMB'), now.get('peakRssMB')):>14}{flag}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_api_worker(name, server, args, env_overrides=None, label=None):
+    """Run one scenario in a fresh interpreter against the mock server; returns its result dict."""
+    workdir = tempfile.mkdtemp(prefix="api_bench_")  # static/audio and data/ caches land here
+    env = {**os.environ, **mock_upstream_env(server.server_port, os.path.join(workdir, "data")), **(env_overrides or {})}
+    result_file = os.path.join(workdir, "result.json")
+    cmd = [sys.executable, os.path.abspath(__file__), "api-worker", "--scenario", name,
+           "--requests", str(args.requests), "--concurrency", str(args.concurrency),
+           "--warmup", str(args.warmup), "--fixtures", os.path.abspath(args.fixtures),
+           "--result-file", result_file]
+    proc = subprocess.run(cmd, cwd=workdir, env=env, capture_output=True, text=True)
+    label = label or name
+    if proc.returncode == 0 and os.path.exists(result_file):
+        with open(result_file) as f:
+            result = json.load(f)
+        print(f"  {label:32} p50 {result['latencyMs']['p50']:>9} ms  p95 {result['latencyMs']['p95']:>9} ms  "
+              f"{result['throughputRps']:>7} req/s  peak {result['peakRssMB']} MB  {result['statuses']}", file=sys.stderr)
+    else:
+        result = {"error": (proc.stderr or proc.stdout)[-2000:]}
+        print(f"  {label:32} failed: {result['error'][-300:]}", file=sys.stderr)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def bench_api(args):
+    names = args.only.split(",") if args.only else list(API_SCENARIOS)
+    unknown = [name for name in names if name not in API_SCENARIOS]
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(unknown)}. Available: {', '.join(API_SCENARIOS)}")
+        return 2
+
+    config = SimpleNamespace(ttft=args.ttft, tokens_per_sec=args.tokens_per_sec, completion_tokens=args.completion_tokens,
+                             tts_latency=args.tts_latency, tts_chars_per_sec=args.tts_chars_per_sec,
+                             search_latency=args.search_latency)
+    server = start_mock_upstream(config)
+    os.makedirs(args.fixtures, exist_ok=True)
+    for pages in FIXTURE_PAGES:
+        if any(name == f"process_{pages}p" for name in names):
+            fixture_pdf(pages, args.fixtures)
+
+    results = {}
+    try:
+        for name in names:
+            results[name] = run_api_worker(name, server, args)
+    finally:
+        server.shutdown()
+
+    report = {
+        "benchmark": "api",
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {key: getattr(args, key) for key in (
+            "requests", "concurrency", "warmup", "ttft", "tokens_per_sec", "completion_tokens",
+            "tts_latency", "tts_chars_per_sec", "search_latency")},
+        "results": results,
+    }
+    out = args.out or os.path.join("bench_results", f"api-{report['commit']}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_results(json.load(f), report, args.tolerance)
+        if regressions:
+            print(f"Regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+def bench_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    return 1 if compare_results(baseline, current, args.tolerance) else 0
+
+
+# ---------------------------------------------------------------------------
+# Serving: Flask dev server vs. gunicorn under a mixed HTTP load
+# ---------------------------------------------------------------------------
+SERVE_COMMANDS = {
+    "dev": lambda: [sys.executable, os.path.join(REPO_DIR, "app.py")],
+    "gunicorn": lambda: [sys.executable, "-m", "gunicorn", "-c", os.path.join(REPO_DIR, "gunicorn.conf.py"), "wsgi:app"],
+}
+
+
+def _wait_for_server(url, proc, timeout=60):
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            return False
+        try:
+            requests.get(url, timeout=1)
+            return True
+        except requests.RequestException:
+            time.sleep(0.25)
+    return False
+
+
+def run_http_load(base_url, mix, requests_total, concurrency):
+    """Fire `requests_total` JSON requests round-robin over `mix` scenarios; per-scenario latencies."""
+    import requests
+    local = threading.local()
+
+    def one(i):
+        name = mix[i % len(mix)]
+        method, path, build = API_SCENARIOS[name]
+        kwargs = build(i, {})
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = local.session.request(method, base_url + path, json=kwargs.get("json"),
+                                             headers=kwargs.get("headers"), timeout=300)
+            response.content
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        return name, time.perf_counter() - start, ok
+
+    samples = {name: [] for name in mix}
+    errors = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for name, elapsed, ok in pool.map(one, range(requests_total)):
+            samples[name].append(elapsed)
+            errors += not ok
+    wall = time.perf_counter() - start
+    return {
+        "throughputRps": round(requests_total / wall, 2),
+        "errors": errors,
+        "latencyMs": percentiles([s for values in samples.values() for s in values]),
+        "byScenario": {name: percentiles(values) for name, values in samples.items()},
+    }
+
+
+def bench_serve(args):
+    mix = args.mix.split(",")
+    unknown = [name for name in mix if name not in API_SCENARIOS or API_SCENARIOS[name][2].__name__ == "build"]
+    if unknown:
+        print(f"Scenarios must be JSON/GET routes from the api suite: {', '.join(unknown)}")
+        return 2
+
+    config = SimpleNamespace(ttft=args.ttft, tokens_per_sec=args.tokens_per_sec, completion_tokens=args.completion_tokens,
+                             tts_latency=args.tts_latency, tts_chars_per_sec=args.tts_chars_per_sec, search_latency=0.2)
+    upstream = start_mock_upstream(config)
+    report = {}
+    try:
+        for offset, label in enumerate(args.servers.split(",")):
+            port = args.port + offset
+            workdir = tempfile.mkdtemp(prefix="serve_bench_")
+            env = {**os.environ, **mock_upstream_env(upstream.server_port, os.path.join(workdir, "data")),
+                   "PORT": str(port), "PYTHONPATH": REPO_DIR, "GUNICORN_ACCESS_LOG": "",
+                   "GUNICORN_BIND": f"127.0.0.1:{port}"}
+            if args.workers:
+                env["WEB_CONCURRENCY"] = str(args.workers)
+            log_path = os.path.join(workdir, "server.log")
+            with open(log_path, "w") as log:
+                proc = subprocess.Popen(SERVE_COMMANDS[label](), cwd=workdir, env=env, start_new_session=True,
+                                        stdout=log, stderr=subprocess.STDOUT)
+            base_url = f"http://127.0.0.1:{port}"
+            try:
+                if not _wait_for_server(base_url + "/api/tts/engines", proc):
+                    with open(log_path) as log:
+                        report[label] = {"error": "server did not start: " + log.read()[-1000:]}
+                    print(f"  {label:9} {report[label]['error']}", file=sys.stderr)
+                    continue
+                run_http_load(base_url, mix, len(mix), 1)  # warm-up
+                report[label] = run_http_load(base_url, mix, args.requests, args.concurrency)
+                r = report[label]
+                print(f"  {label:9} {r['throughputRps']:>7} req/s  p50 {r['latencyMs']['p50']} ms  "
+                      f"p95 {r['latencyMs']['p95']} ms  errors {r['errors']}", file=sys.stderr)
+            finally:
+                try:
+                    os.killpg(proc.pid, 15)
+                except ProcessLookupError:
+                    pass
+                proc.wait(timeout=30)
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        upstream.shutdown()
+
+    print(json.dumps({
+        "benchmark": "serve",
+        "mix": mix,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "results": report,
+    }, indent=2))
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Import-time budget: `import app` must stay cheap and must not load the heavy SDKs
+# ---------------------------------------------------------------------------
+LAZY_MODULES = ("fitz", "pymupdf", "reportlab", "together", "gtts", "elevenlabs", "bs4", "requests", "httpx",
+                "pytesseract", "numpy")
+
+
+def measure_import(module="app"):
+    """Run `python -X importtime -c "import <module>"` in a fresh interpreter; returns parsed rows."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=REPO_DIR,
+                          capture_output=True, text=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if match:
+            rows.append({"selfUs": int(match.group(1)), "cumulativeUs": int(match.group(2)),
+                         "depth": len(match.group(3)) // 2, "module": match.group(4)})
+    return rows
+
+
+def bench_importtime(args):
+    runs = [measure_import() for _ in range(args.runs)]
+    totals = [next(r["cumulativeUs"] for r in rows if r["module"] == "app") / 1000 for rows in runs]
+    best = runs[totals.index(min(totals))]
+    loaded = {r["module"].split(".")[0] for r in best}
+    eager = [name for name in LAZY_MODULES if name in loaded]
+    slowest = sorted((r for r in best if r["depth"] == 1), key=lambda r: -r["cumulativeUs"])[:args.top]
+
+    ok = min(totals) <= args.budget_ms and not eager
+    print(json.dumps({
+        "benchmark": "importtime",
+        "appImportMs": round(min(totals), 1),
+        "runsMs": [round(t, 1) for t in totals],
+        "budgetMs": args.budget_ms,
+        "eagerHeavyModules": eager,
+        "slowestImports": [{"module": r["module"], "ms": round(r["cumulativeUs"] / 1000, 1)} for r in slowest],
+        "ok": ok,
+    }, indent=2))
+    return 0 if ok else 1
+
+
+# ---------------------------------------------------------------------------
+# Artifact store: save/get/list latency as the table grows
+# ---------------------------------------------------------------------------
+def _artifact_bodies():
+    """Representative payloads: a Markdown summary, a flashcard deck and a long paper."""
+    summary = _SUMMARY
+    deck = {"flashcards": [{"id": n, "question": f"Q{n}: " + " ".join(_WORDS[:8]), "answer": " ".join(_WORDS),
+                            "category": _WORDS[n % len(_WORDS)], "difficulty": "medium", "hint": ""} for n in range(40)]}
+    paper = {"paper": _PAPER * 3, "stats": {"wordCount": len((_PAPER * 3).split())}}
+    return [("summary", summary), ("flashcards", deck), ("paper", paper)]
+
+
+def bench_artifacts(args):
+    import app
+
+    bodies = _artifact_bodies()
+    raw_bytes = sum(app.ArtifactStore._encode(body)[2] for _, body in bodies)
+    stored_bytes = sum(len(app.ArtifactStore._encode(body)[3]) for _, body in bodies)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        store = app.ArtifactStore(os.path.join(tmp, "artifacts.db"))
+        ids, rows = [], 0
+        for target in sorted(int(n) for n in args.rows.split(",")):
+            save_times = []
+            while rows < target:
+                kind, body = bodies[rows % len(bodies)]
+                start = time.perf_counter()
+                ids.append(store.save(f"user{rows % args.users}", kind, body, doc_id=f"doc{rows % 500}"))
+                save_times.append(time.perf_counter() - start)
+                rows += 1
+
+            get_times, list_times = [], []
+            for n in range(args.lookups):
+                index = (n * 7919) % len(ids)
+                start = time.perf_counter()
+                assert store.get(f"user{index % args.users}", ids[index]) is not None
+                get_times.append(time.perf_counter() - start)
+            for n in range(max(1, args.lookups // 10)):
+                start = time.perf_counter()
+                store.list(f"user{n % args.users}", kind="flashcards", limit=50)
+                list_times.append(time.perf_counter() - start)
+            results[str(target)] = {
+                "saveMs": percentiles(save_times),
+                "getMs": percentiles(get_times),
+                "listMs": percentiles(list_times),
+                "dbMb": round(sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp)) / 1e6, 1),
+            }
+
+    print(json.dumps({
+        "benchmark": "artifacts",
+        "users": args.users,
+        "lookups": args.lookups,
+        "compressionRatio": round(raw_bytes / stored_bytes, 1),
+        "results": results,
+    }, indent=2))
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Embedding index: build rate, incremental re-index and top-k queries/sec
+# ---------------------------------------------------------------------------
+def synthetic_chunks(count, words_per_chunk=120, seed=7):
+    """Lecture-like chunks over a vocabulary large enough that hashed vectors are not all alike."""
+    rng = random.Random(seed)
+    vocab = list(_WORDS) + [f"{w}{n}" for w in _WORDS for n in range(200)]
+    return [f"Chunk {i}. " + " ".join(rng.choice(vocab) for _ in range(words_per_chunk)) for i in range(count)]
+
+
+def bench_embeddings(args):
+    import app
+
+    chunks = synthetic_chunks(args.chunks)
+    # Each query is 8 words lifted from one chunk, so the top hit should be that chunk
+    targets = random.Random(1).sample(range(len(chunks)), min(args.queries, len(chunks)))
+    queries = [" ".join(chunks[i].split()[2:10]) for i in targets]
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        index = app.EmbeddingIndex(os.path.join(tmp, "doc"), dim=args.dim)
+        start = time.perf_counter()
+        for i in range(0, len(chunks), 10_000):
+            index.add(chunks[i:i + 10_000])
+        build = time.perf_counter() - start
+
+        extra = synthetic_chunks(max(1, args.chunks // 100), seed=99)
+        start = time.perf_counter()
+        added = index.add(chunks + extra)
+        incremental = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = app.EmbeddingIndex(index.dir, dim=args.dim)
+        reopen = time.perf_counter() - start
+
+        single, found = [], 0
+        for target, q in zip(targets, queries):
+            t = time.perf_counter()
+            top = index.search([q], args.k)[0]
+            single.append(time.perf_counter() - t)
+            found += bool(top) and top[0][0] == target
+
+        start = time.perf_counter()
+        for i in range(0, len(queries), args.batch):
+            index.search(queries[i:i + args.batch], args.k)
+        batched = time.perf_counter() - start
+
+        report = {
+            "chunks": len(index),
+            "dim": args.dim,
+            "indexMb": round(os.path.getsize(os.path.join(index.dir, "vectors.f32")) / 1e6, 1),
+            "buildChunksPerSec": round(len(chunks) / build, 1),
+            "incremental": {"newChunks": added, "seconds": round(incremental, 3)},
+            "reopenSeconds": round(reopen, 3),
+            "singleQuery": {"qps": round(len(queries) / sum(single), 1), "latencyMs": percentiles(single)},
+            "batchedQuery": {"batch": args.batch, "qps": round(len(queries) / batched, 1)},
+            "recallAt1": round(found / len(queries), 3),
+        }
+
+    print(json.dumps({"benchmark": "embeddings", "k": args.k, **report}, indent=2))
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Text normalization: prompt tokens saved per document
+# ---------------------------------------------------------------------------
+def boilerplate_pdf(kind, pages, directory):
+    """PDF with running header, footer and page numbers on every page.
+
+    "textbook" pages are dense paragraphs with words hyphenated across line ends;
+    "slides" pages are a title and a few short bullets, where the boilerplate is a larger share.
+    """
+    path = os.path.join(directory, f"{kind}_{pages}p.pdf")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        rng = random.Random(pages)
+        doc = fitz.open()
+        for i in range(pages):
+            page = doc.new_page()
+            if kind == "slides":
+                header = "CS 101: Introduction to Systems \u2014 Week 3 \u2014 Prof. Example"
+                body = [f"Slide topic {i + 1}: {rng.choice(_WORDS)} and {rng.choice(_WORDS)}", ""]
+                body += ["\u2022 " + " ".join(rng.choice(_WORDS) for _ in range(6)) for _ in range(5)]
+            else:
+                header = f"Principles of Thermodynamics    Chapter {i // 12 + 1}"
+                body = []
+                for _ in range(24):
+                    body.append(" ".join(rng.choice(_WORDS) for _ in range(10)) + " classi-")
+                    body.append("fication " + " ".join(rng.choice(_WORDS) for _ in range(4)))
+            lines = [header, "", *body, "", "\u00a9 2025 Example University. All rights reserved.", f"{i + 1} / {pages}"]
+            page.insert_text((60, 50), "\n".join(lines), fontsize=9)
+        doc.save(path)
+    return path
+
+
+def bench_normalize(args):
+    import app
+
+    paths = args.pdfs or [boilerplate_pdf("slides", 40, args.fixtures), boilerplate_pdf("textbook", 40, args.fixtures),
+                          fixture_pdf(50, args.fixtures)]
+    documents = []
+    for path in paths:
+        with open(path, "rb") as f:
+            doc = fitz.open(stream=f.read(), filetype="pdf")
+        raw = [page.get_text() for page in doc]
+        start = time.perf_counter()
+        _, report = app.normalize_pages(raw)
+        documents.append({"file": os.path.basename(path), "pages": len(raw),
+                          "normalizeMs": round((time.perf_counter() - start) * 1000, 1), **report})
+    print(json.dumps({"benchmark": "normalize", "documents": documents}, indent=2))
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Prompt compression: tokens kept vs. facts kept, per target ratio
+# ---------------------------------------------------------------------------
+_FILLER = (
+    "As we have seen, this is very important.", "It is worth noting this point.",
+    "In other words, this is what we discussed before.", "Let us now turn to the next point.",
+    "This will be covered in more detail later.", "Remember this, because it comes up again.",
+)
+
+
+def synthetic_lecture(facts=120, seed=3):
+    """(summary, source, facts) where each fact is an (entity, value) pair stated once in the source.
+
+    The source mixes facts, elaborations and discourse filler; the summary restates every other fact,
+    the way a generated summary restates its source.
+    """
+    rng = random.Random(seed)
+    props = ("boiling point", "half-life", "yield", "threshold", "capacity", "rate constant")
+    units = ("K", "s", "%", "mV", "GB", "per second")
+    rows = [(f"{w.capitalize()}-{i}", rng.choice(props), f"{rng.randint(2, 999)} {rng.choice(units)}",
+             rng.choice(_WORDS), rng.choice(_WORDS)) for i, w in enumerate(rng.choice(_WORDS) for _ in range(facts))]
+    paragraphs, summary = [], ["## Key facts"]
+    for i in range(0, facts, 4):
+        sentences = []
+        for entity, prop, value, a, b in rows[i:i + 4]:
+            sentences.append(f"The {prop} of {entity} is {value}.")
+            sentences.append(f"{entity} is closely linked to {a} and {b} in most {rng.choice(_WORDS)} models.")
+            sentences.append(rng.choice(_FILLER))
+        paragraphs.append(" ".join(sentences))
+    for entity, prop, value, _, _ in rows[::2]:
+        summary.append(f"- The {prop} of {entity} is {value}.")
+    return "\n".join(summary), "\n\n".join(paragraphs), [(r[0], r[2]) for r in rows]
+
+
+def _content_terms(app, text):
+    return {app._stem(w) for w in re.findall(r"[a-z0-9]+", text.lower()) if w not in app._PROMPT_STOPWORDS}
+
+
+def bench_compress(args):
+    import app
+
+    documents = []
+    if args.pdfs:
+        for path in args.pdfs:
+            with open(path, "rb") as f:
+                source, _ = app.extract_pdf_text(f.read())
+            # Stand-in summary: the lead sentence of every paragraph, which is what summaries tend to restate
+            leads = [p.split(". ")[0].strip()[:300] + "." for p in source.split("\n\n") if p.strip()]
+            documents.append((os.path.basename(path), "\n".join(leads), source, None))
+    else:
+        summary, source, facts = synthetic_lecture(args.facts)
+        documents.append(("synthetic_lecture", summary, source, facts))
+
+    results = []
+    for name, summary, source, facts in documents:
+        terms = _content_terms(app, summary + " " + source)
+        for ratio in args.ratios:
+            start = time.perf_counter()
+            blocks, report = app.compress_prompt([summary, source], ratio)
+            elapsed = time.perf_counter() - start
+            kept = "\n".join(blocks)
+            row = {"document": name, "targetRatio": ratio, **report, "compressMs": round(elapsed * 1000, 1),
+                   "termCoverage": round(len(_content_terms(app, kept) & terms) / max(len(terms), 1), 3),
+                   "estPrefillMs": round(report["tokensAfter"] / args.prefill_tokens_per_sec * 1000)}
+            if facts:
+                row["factRecall"] = round(sum(e in kept and v in kept for e, v in facts) / len(facts), 3)
+            results.append(row)
+    print(json.dumps({"benchmark": "compress", "prefillTokensPerSec": args.prefill_tokens_per_sec,
+                      "results": results}, indent=2))
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Model tiering: latency and LLM spend per routing policy
+# ---------------------------------------------------------------------------
+SMALL_MODEL, LARGE_MODEL = "openai/gpt-oss-20b", "openai/gpt-oss-120b"
+TIER_SCENARIOS = "process_5p,process_50p,process_200p,chat,generate_flashcards,generate_ultimate_cheatsheet"
+TIER_POLICIES = {
+    "routed": {},  # MODEL_TIERS defaults: small unless the input or max_tokens outgrows it
+    "fixed": {"MODEL_ROUTING": "0"},  # each call site's hard-coded model, as before routing
+    "small": {"MODEL_TIERS": json.dumps([{"name": "small", "model": SMALL_MODEL}])},
+    "large": {"MODEL_TIERS": json.dumps([{"name": "large", "model": LARGE_MODEL}])},
+}
+
+
+def _speed(value):
+    ttft, tokens_per_sec, prefill = (float(v) for v in value.split(","))
+    return SimpleNamespace(ttft=ttft, tokens_per_sec=tokens_per_sec, prefill_tokens_per_sec=prefill)
+
+
+def bench_tiers(args):
+    names = args.only.split(",")
+    policies = args.policies.split(",")
+    config = SimpleNamespace(ttft=0.3, tokens_per_sec=400, completion_tokens=args.completion_tokens,
+                             tts_latency=0.2, tts_chars_per_sec=2000, search_latency=0.2,
+                             models={SMALL_MODEL: args.small, LARGE_MODEL: args.large})
+    server = start_mock_upstream(config)
+    for pages in FIXTURE_PAGES:
+        if f"process_{pages}p" in names:
+            fixture_pdf(pages, args.fixtures)
+
+    results = {}
+    try:
+        for name in names:
+            for policy in policies:
+                r = run_api_worker(name, server, args, TIER_POLICIES[policy], label=f"{name} [{policy}]")
+                if "error" not in r:
+                    r = {"latencyMs": r["latencyMs"], "throughputRps": r["throughputRps"], "statuses": r["statuses"],
+                         "costPer1kRequestsUsd": round(sum(r["llmCostUsd"].values()) / (args.requests + args.warmup) * 1000, 4),
+                         "models": sorted(r["llmCostUsd"])}
+                results.setdefault(name, {})[policy] = r
+    finally:
+        server.shutdown()
+
+    print(json.dumps({"benchmark": "tiers", "requests": args.requests, "concurrency": args.concurrency,
+                      "speeds": {SMALL_MODEL: vars(args.small), LARGE_MODEL: vars(args.large)},
+                      "results": results}, indent=2))
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Cancellation: upstream tokens spent on requests whose client gave up
+# ---------------------------------------------------------------------------
+CANCEL_SCENARIOS = "generate_ultimate_cheatsheet,research_paper_sectioned"
+
+
+def _abandoned_requests(base_url, names, total, client_timeout):
+    """Fire `total` requests that the client abandons after `client_timeout` seconds; returns status counts."""
+    import requests
+    statuses = {}
+
+    def one(i):
+        method, path, build = API_SCENARIOS[names[i % len(names)]]
+        kwargs = build(i, {})
+        try:
+            # No session: a timed-out connection is closed, like a browser tab going away
+            return str(requests.request(method, base_url + path, json=kwargs.get("json"), timeout=client_timeout).status_code)
+        except requests.Timeout:
+            return "abandoned"
+
+    with ThreadPoolExecutor(max_workers=total) as pool:
+        for status in pool.map(one, range(total)):
+            statuses[status] = statuses.get(status, 0) + 1
+    return statuses
+
+
+def bench_cancel(args):
+    names = args.only.split(",")
+    config = SimpleNamespace(ttft=args.ttft, tokens_per_sec=args.tokens_per_sec, completion_tokens=args.completion_tokens,
+                             tts_latency=0.2, tts_chars_per_sec=2000, search_latency=0.2)
+    upstream = start_mock_upstream(config)
+    report = {}
+    try:
+        for offset, (label, flag) in enumerate((("cancel", "1"), ("no-cancel", "0"))):
+            port = args.port + offset
+            workdir = tempfile.mkdtemp(prefix="cancel_bench_")
+            env = {**os.environ, **mock_upstream_env(upstream.server_port, os.path.join(workdir, "data")),
+                   "PORT": str(port), "PYTHONPATH": REPO_DIR, "REQUEST_CANCELLATION": flag}
+            log_path = os.path.join(workdir, "server.log")
+            with open(log_path, "w") as log:
+                proc = subprocess.Popen(SERVE_COMMANDS["dev"](), cwd=workdir, env=env, start_new_session=True,
+                                        stdout=log, stderr=subprocess.STDOUT)
+            base_url = f"http://127.0.0.1:{port}"
+            try:
+                if not _wait_for_server(base_url + "/api/tts/engines", proc):
+                    with open(log_path) as log:
+                        report[label] = {"error": "server did not start: " + log.read()[-1000:]}
+                    continue
+                with upstream.count_lock:
+                    upstream.tokens_generated = 0
+                start = time.perf_counter()
+                statuses = _abandoned_requests(base_url, names, args.requests, args.client_timeout)
+                # Upstream keeps generating for abandoned requests until the app closes the connection
+                while upstream.active_calls and time.perf_counter() - start < 600:
+                    time.sleep(0.1)
+                report[label] = {"statuses": statuses, "completionTokens": upstream.tokens_generated,
+                                 "upstreamBusySeconds": round(time.perf_counter() - start, 2)}
+                print(f"  {label:9} {upstream.tokens_generated:>8} completion tokens  upstream busy "
+                      f"{report[label]['upstreamBusySeconds']}s  {statuses}", file=sys.stderr)
+            finally:
+                try:
+                    os.killpg(proc.pid, 15)
+                except ProcessLookupError:
+                    pass
+                proc.wait(timeout=30)
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        upstream.shutdown()
+
+    print(json.dumps({"benchmark": "cancel", "scenarios": names, "requests": args.requests,
+                      "clientTimeout": args.client_timeout, "results": report}, indent=2))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OuchMyBrain.io benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    ocr = sub.add_parser("ocr", help="OCR throughput (pages/sec) on a synthetic scanned PDF")
+    ocr.add_argument("--pages", type=int, default=20)
+    ocr.add_argument("--dpi", type=int, default=int(os.getenv("OCR_DPI", 200)))
+    ocr.set_defaults(func=bench_ocr)
+
+    gateway = sub.add_parser("gateway", help="Bursty identical LLM calls: direct vs. gateway (coalescing, caps, retries)")
+    gateway.add_argument("--requests", type=int, default=40)
+    gateway.add_argument("--distinct", type=int, default=5, help="number of distinct prompts in the burst")
+    gateway.add_argument("--latency", type=float, default=0.3, help="fake upstream latency in seconds")
+    gateway.add_argument("--capacity", type=int, default=4, help="upstream concurrency before it returns 429")
+    gateway.set_defaults(func=bench_gateway)
+
+    api = sub.add_parser("api", help="Every /api/* route against a mock LLM/TTS/search server; saves JSON results")
+    api.add_argument("--requests", type=int, default=20, help="timed requests per scenario")
+    api.add_argument("--concurrency", type=int, default=4)
+    api.add_argument("--warmup", type=int, default=1)
+    api.add_argument("--only", help="comma-separated scenario names")
+    api.add_argument("--ttft", type=float, default=0.3, help="mock LLM time to first token (s)")
+    api.add_argument("--tokens-per-sec", type=float, default=400, help="mock LLM generation rate")
+    api.add_argument("--completion-tokens", type=int, default=400, help="mock LLM reply length (words)")
+    api.add_argument("--tts-latency", type=float, default=0.2, help="mock ElevenLabs base latency (s)")
+    api.add_argument("--tts-chars-per-sec", type=float, default=2000)
+    api.add_argument("--search-latency", type=float, default=0.2)
+    api.add_argument("--fixtures", default=os.path.join("data", "bench_fixtures"), help="fixture PDF directory")
+    api.add_argument("--out", help="results file (default bench_results/api-<commit>.json)")
+    api.add_argument("--baseline", help="earlier results file to compare against")
+    api.add_argument("--tolerance", type=float, default=0.15, help="allowed p95/throughput regression")
+    api.set_defaults(func=bench_api)
+
+    worker = sub.add_parser("api-worker", help=argparse.SUPPRESS)
+    worker.add_argument("--scenario", required=True)
+    worker.add_argument("--requests", type=int, default=20)
+    worker.add_argument("--concurrency", type=int, default=4)
+    worker.add_argument("--warmup", type=int, default=1)
+    worker.add_argument("--fixtures", required=True)
+    worker.add_argument("--result-file", required=True)
+    worker.set_defaults(func=bench_api_worker)
+
+    serve = sub.add_parser("serve", help="Mixed HTTP load: Flask dev server vs. gunicorn (gunicorn.conf.py)")
+    serve.add_argument("--servers", default="dev,gunicorn")
+    serve.add_argument("--mix", default="chat,text_to_speech,download_research_paper,tts_engines",
+                       help="api suite scenarios to round-robin (JSON/GET routes)")
+    serve.add_argument("--requests", type=int, default=200)
+    serve.add_argument("--concurrency", type=int, default=32)
+    serve.add_argument("--workers", type=int, help="gunicorn WEB_CONCURRENCY override")
+    serve.add_argument("--port", type=int, default=5077)
+    serve.add_argument("--ttft", type=float, default=0.3)
+    serve.add_argument("--tokens-per-sec", type=float, default=400)
+    serve.add_argument("--completion-tokens", type=int, default=200)
+    serve.add_argument("--tts-latency", type=float, default=1.0, help="slow TTS upstream, like a gTTS call")
+    serve.add_argument("--tts-chars-per-sec", type=float, default=2000)
+    serve.set_defaults(func=bench_serve)
+
+    importtime = sub.add_parser("importtime", help="Fail if `import app` exceeds a time budget or loads heavy SDKs eagerly")
+    importtime.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", 400)))
+    importtime.add_argument("--runs", type=int, default=3, help="best of N fresh interpreters")
+    importtime.add_argument("--top", type=int, default=10)
+    importtime.set_defaults(func=bench_importtime)
+
+    artifacts = sub.add_parser("artifacts", help="Artifact store save/get/list latency at growing table sizes")
+    artifacts.add_argument("--rows", default="1000,10000", help="comma-separated table sizes to measure at")
+    artifacts.add_argument("--lookups", type=int, default=2000)
+    artifacts.add_argument("--users", type=int, default=50)
+    artifacts.set_defaults(func=bench_artifacts)
+
+    embeddings = sub.add_parser("embeddings", help="Embedding index build rate and top-k queries/sec")
+    embeddings.add_argument("--chunks", type=int, default=100_000)
+    embeddings.add_argument("--queries", type=int, default=2000)
+    embeddings.add_argument("--batch", type=int, default=32)
+    embeddings.add_argument("--k", type=int, default=8)
+    embeddings.add_argument("--dim", type=int, default=int(os.getenv("EMBED_DIM", 384)))
+    embeddings.set_defaults(func=bench_embeddings)
+
+    normalize = sub.add_parser("normalize", help="Prompt tokens saved by PDF text normalization, per document")
+    normalize.add_argument("pdfs", nargs="*", help="PDFs to measure (default: generated textbook and lecture fixtures)")
+    normalize.add_argument("--fixtures", default=os.path.join("data", "bench_fixtures"))
+    normalize.set_defaults(func=bench_normalize)
+
+    compress = sub.add_parser("compress", help="Prompt compression: tokens kept vs. fact recall and term coverage per ratio")
+    compress.add_argument("pdfs", nargs="*", help="PDFs to measure (default: a synthetic lecture with known facts)")
+    compress.add_argument("--ratios", type=lambda s: [float(r) for r in s.split(",")], default=[1.0, 0.8, 0.6, 0.4])
+    compress.add_argument("--facts", type=int, default=120)
+    compress.add_argument("--prefill-tokens-per-sec", type=float, default=2000,
+                          help="upstream prompt processing rate used for the prefill latency estimate")
+    compress.set_defaults(func=bench_compress)
+
+    tiers = sub.add_parser("tiers", help="Latency and LLM cost per model routing policy (routed, fixed, all-small, all-large)")
+    tiers.add_argument("--only", default=TIER_SCENARIOS, help="comma-separated api scenarios")
+    tiers.add_argument("--policies", default=",".join(TIER_POLICIES))
+    tiers.add_argument("--requests", type=int, default=6)
+    tiers.add_argument("--concurrency", type=int, default=2)
+    tiers.add_argument("--warmup", type=int, default=0)
+    tiers.add_argument("--completion-tokens", type=int, default=600, help="mock LLM reply length (words)")
+    tiers.add_argument("--small", type=_speed, default=_speed("0.2,600,20000"),
+                       help="gpt-oss-20b mock speed: ttft seconds, tokens/sec, prefill tokens/sec")
+    tiers.add_argument("--large", type=_speed, default=_speed("0.5,200,6000"), help="gpt-oss-120b mock speed")
+    tiers.add_argument("--fixtures", default=os.path.join("data", "bench_fixtures"))
+    tiers.set_defaults(func=bench_tiers)
+
+    cancel = sub.add_parser("cancel", help="Upstream tokens spent after clients give up, with and without request cancellation")
+    cancel.add_argument("--only", default=CANCEL_SCENARIOS, help="comma-separated api scenarios")
+    cancel.add_argument("--requests", type=int, default=6, help="requests fired at once, all abandoned")
+    cancel.add_argument("--client-timeout", type=float, default=3.0, help="seconds before the client hangs up")
+    cancel.add_argument("--ttft", type=float, default=0.3)
+    cancel.add_argument("--tokens-per-sec", type=float, default=100, help="slow upstream, so requests outlive the client")
+    cancel.add_argument("--completion-tokens", type=int, default=4000)
+    cancel.add_argument("--port", type=int, default=5087)
+    cancel.set_defaults(func=bench_cancel)
+
+    compare = sub.add_parser("compare", help="Compare two saved api results files")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--tolerance", type=float, default=0.15)
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+"""Gunicorn settings for OuchMyBrain.io. Every value can be overridden from the environment.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '5000')}")
+
+# Requests mostly wait on the LLM/TTS APIs, so each process runs a thread pool ("gthread");
+# several processes let CPU-bound work (PDF parsing, ReportLab rendering) use more than one core.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", min(multiprocessing.cpu_count(), 8)))
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+# Import app.py (and its heavy dependencies) once in the master; workers share those pages via fork.
+# Per-process pools and clients are rebuilt in post_fork.
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") != "0"
+
+# Recycle workers gradually to bound memory growth; jitter keeps them from restarting together.
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 100))
+
+# Research papers and podcasts can take minutes upstream.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 300))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-") or None  # empty disables the access log
+errorlog = "-"
+
+
+def when_ready(server):
+    # Runs in the master before the first fork: import the lazily-loaded SDKs once so workers share them.
+    if preload_app:
+        from app import warm_up
+        warm_up()
+
+
+def post_fork(server, worker):
+    from app import reset_after_fork
+    reset_after_fork()
@@ -0,0 +1,22 @@
+import pytest
+
+import app
+
+FRAME = app.LocalTTSEngine._FRAME  # one 128 kbps / 44.1 kHz MPEG-1 Layer III frame
+
+
+def test_stitch_audio_joins_two_mp3_parts_with_gap():
+    first, second = FRAME * 40, FRAME * 20
+    stitched = app.stitch_audio([first, second], gap_seconds=0.5)
+
+    assert stitched.startswith(first)
+    assert stitched.endswith(second)
+    expected = app.mp3_duration(first) + app.mp3_duration(second) + 0.5
+    assert abs(app.mp3_duration(stitched) - expected) < 0.05
+
+
+def test_resolve_voice_rejects_hosts_paths_and_options():
+    assert app.resolve_voice("gtts:co.uk") == ("gtts", "co.uk")
+    for voice_id in ("gtts:com.attacker.io", "local:/etc/passwd", "local:--help"):
+        with pytest.raises(ValueError):
+            app.resolve_voice(voice_id)
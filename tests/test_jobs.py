@@ -0,0 +1,40 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import app
+
+
+def _run_in_job(job, fn):
+    token = app._current_job.set(job)
+    try:
+        return fn()
+    finally:
+        app._current_job.reset(token)
+
+
+def _resolve_later(future, seconds, value):
+    timer = threading.Timer(seconds, future.set_result, args=(value,))
+    timer.start()
+    return timer
+
+
+def test_wait_for_future_polls_past_the_poll_interval_inside_a_job():
+    job = app.Job("job-wait-slow", "user", "test", timeout=30)
+    future = Future()
+    _resolve_later(future, app.JOB_POLL_SECONDS * 3, "done")
+
+    assert _run_in_job(job, lambda: app.wait_for_future(future)) == "done"
+
+
+def test_wait_for_future_stops_when_the_job_is_cancelled():
+    job = app.Job("job-wait-cancel", "user", "test", timeout=30)
+    future = Future()
+    threading.Timer(app.JOB_POLL_SECONDS, job.cancel, args=("cancelled",)).start()
+
+    start = time.monotonic()
+    with pytest.raises(app.JobCancelled):
+        _run_in_job(job, lambda: app.wait_for_future(future))
+    assert time.monotonic() - start < 2
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+import app
+
+
+def test_parse_llm_json_strips_only_the_outer_code_fence():
+    text = '```json\n{"front": "what is ```py x```", "back": "a fenced snippet"}\n```'
+
+    assert app.parse_llm_json(text) == {"front": "what is ```py x```", "back": "a fenced snippet"}
+
+
+def test_parse_llm_json_closes_a_truncated_object_and_array():
+    text = 'Here you go:\n{"outline": [{"title": "Intro"}, {"title": "Cells", "points": ["a", "b"'
+
+    assert app.parse_llm_json(text) == {
+        "outline": [{"title": "Intro"}, {"title": "Cells", "points": ["a", "b"]}],
+    }
+
+
+def test_parse_llm_json_tolerates_trailing_and_missing_commas():
+    text = '{"flashcards": [{"question": "q1", "answer": "a1",} {"question": "q2", "answer": "a2"},],}'
+
+    assert app.parse_llm_json(text, "flashcards") == {
+        "flashcards": [{"question": "q1", "answer": "a1"}, {"question": "q2", "answer": "a2"}],
+    }
+
+
+def test_parse_llm_json_closes_an_unterminated_string():
+    assert app.parse_llm_json('{"title": "Mitosis", "content": "Cells div') == {
+        "title": "Mitosis", "content": "Cells div",
+    }
+
+
+def test_parse_llm_json_drops_items_missing_required_keys():
+    text = '{"schedule": [{"day": 1, "topics": ["x"]}, {"day": 2}]}'
+
+    assert app.parse_llm_json(text, "schedule") == {"schedule": [{"day": 1, "topics": ["x"]}]}
+    assert app.parse_llm_json('{"title": "t", "content": "c"}', "slide") is None
+    assert app.parse_llm_json("no json at all") is None
+
+
+def test_incremental_parser_backs_off_to_the_last_complete_element():
+    parser = app.IncrementalJSONParser()
+    parser.feed('{"outline": [{"title": "A"}, {"title": "B", "points": [1, 2], "no')
+
+    assert not parser.done
+    assert parser.result() == {"outline": [{"title": "A"}, {"title": "B", "points": [1, 2]}]}
+
+
+@pytest.mark.parametrize("schema_name", [name for name, schema in app.JSON_SCHEMAS.items() if "items" in schema])
+def test_incremental_parser_emits_each_item_as_it_closes(schema_name):
+    schema = app.JSON_SCHEMAS[schema_name]
+    first = {key: f"{key} {{1}}, [\"quoted\"]" for key in schema["item_required"]}
+    second = {key: f"{key} 2" for key in schema["item_required"]}
+    text = json.dumps({"note": "braces { in } strings", schema["items"]: [first, second]})
+    cut = text.index(json.dumps(second))
+
+    parser = app.IncrementalJSONParser(items_key=schema["items"])
+    emitted = [parser.feed(text[i:min(i + 7, cut)]) for i in range(0, cut, 7)]
+    assert [item for batch in emitted for item in batch] == [first]
+
+    assert parser.feed(text[cut:]) == [second]
+    assert parser.done
+    assert app.validate_json(parser.result(), schema_name) == {"note": "braces { in } strings",
+                                                                schema["items"]: [first, second]}
+
+
+def test_join_continuation_trims_restated_overlap_and_reopened_fence():
+    text = "The mitochondria is the powerhouse of the cell and"
+    assert app.join_continuation(text, "powerhouse of the cell and it makes ATP.") == (
+        "The mitochondria is the powerhouse of the cell and it makes ATP."
+    )
+    assert app.join_continuation(text, "\n  powerhouse of the cell and it makes ATP.") == (
+        "The mitochondria is the powerhouse of the cell and it makes ATP."
+    )
+    assert app.join_continuation(text, " it makes ATP.") == text + " it makes ATP."
+
+    fenced = '```json\n{"title": "A", "content": "long'
+    assert app.join_continuation(fenced, '```json\n text"}\n```') == fenced + ' text"}\n```'
@@ -0,0 +1,9 @@
+"""WSGI entry point for production servers.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from app import app, install_trace_log_ids
+
+install_trace_log_ids()
+
+__all__ = ["app"]